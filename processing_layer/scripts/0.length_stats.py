@@ -1,36 +1,34 @@
 # Print read length percentiles (Min, 5%, 10%, 15%, 20%, 25%, Max)
+# Optionally write the full QC profile of the file (length, quality, base composition and expected error distributions) as JSON
 
-import argparse, util
+import argparse, qcprofile
 import numpy as np
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-f', help = 'Input FASTA file', default = '')
 parser.add_argument('-q', help = 'Input FASTQ file', default = '')
-parser.add_argument('-n', help = 'Number of sequences to evaluate', default = 100000, type = int)
+parser.add_argument('-a', help = 'ASCII encoding of quality scores', default = 33, type = int)
+parser.add_argument('-n', help = 'Number of sequences to evaluate (0 = all)', default = 0, type = int)
+parser.add_argument('-o', help = 'Output QC profile (JSON)', default = '')
 args = parser.parse_args()
 
 if args.f != '':
     fn = args.f
-    iter_seq = util.iter_fst
+    fmt = 'fasta'
 
 if args.q != '':
     fn = args.q
-    iter_seq = util.iter_fsq
+    fmt = 'fastq'
 
-x = []
-for record in iter_seq(fn):
-    sid, seq = record[:2]
-    if args.n > 0:
-        args.n = args.n - 1
-    else:
-        break
-    x.append(len(seq))
+profile = qcprofile.profile_file(fn, fmt=fmt, ascii_encoding=args.a, n=args.n)
+if args.o:
+    profile.write(args.o)
 
-x = np.array(x)
-print '\nMin = %d' %(min(x))
-print 'Max = %d\n' %(max(x))
-print '5%% = %d' %(np.percentile(x, 5))
-print '10%% = %d' %(np.percentile(x, 10))
-print '15%% = %d' %(np.percentile(x, 15))
-print '20%% = %d' %(np.percentile(x, 20))
-print '25%% = %d\n' %(np.percentile(x, 25))
+x = profile.length_hist
+print '\nMin = %d' %(np.flatnonzero(x)[0])
+print 'Max = %d\n' %(np.flatnonzero(x)[-1])
+print '5%% = %d' %(qcprofile.hist_percentile(x, 5))
+print '10%% = %d' %(qcprofile.hist_percentile(x, 10))
+print '15%% = %d' %(qcprofile.hist_percentile(x, 15))
+print '20%% = %d' %(qcprofile.hist_percentile(x, 20))
+print '25%% = %d\n' %(qcprofile.hist_percentile(x, 25))
@@ -1,7 +1,7 @@
-import argparse, primer, sys, util
-from string import maketrans
+import argparse, stages, sys
 
 # Demultiplex FASTA/FASTQ file
+# Command line wrapper around stages.split_by_barcodes
 
 def parse_args():
     
@@ -13,8 +13,10 @@ def parse_args():
     parser.add_argument('-B', default='', help='Barcodes file format', choices=['fasta', 'tab'], required=True)
     parser.add_argument('-i', default='', help='Index file (seqs -> barcodes)')
     parser.add_argument('-I', default='', help='Index file format', choices=['fasta', 'tab'])
+    parser.add_argument('--index_order', default='auto', help='Index file in the [same] order as the reads, in [any] order, or [auto]detect', choices=['auto', 'same', 'any'])
     parser.add_argument('-d', default=0, help='Max barcode differences', type=int)
     parser.add_argument('-w', default=5, help='Search positions 1-w for barcode', type=int)
+    parser.add_argument('-e', default=False, action='store_true', help='Allow indels (max edit distance instead of mismatches)')
     parser.add_argument('--mode', default=1, type=int, help='Barcodes in [1] seqids, [2] seqs, [3] index file', choices=[1,2,3], required=True)
     parser.add_argument('--rc', default=False, action='store_true', help='Reverse complement barcodes?')
     parser.add_argument('-o', help='Output file', required=True)
@@ -25,153 +27,31 @@ def parse_args():
         quit('Error: must specify FASTA or FASTQ file')
     if args.i and not args.I:
         quit('Error: must specify index file format')
+    if args.mode == 3 and not args.i:
+        quit('Error: must specify index file in mode 3')
     return args
 
 
-rctab = maketrans('ACGTacgt','TGCAtgca')
-def reverse_complement(x):
-    # Reverse complement a sequence
-    return x[::-1].translate(rctab)
-
-
-def parse_barcodes_file(map_fn, format='fasta', rc=False):
-    # Map barcodes to samples
-    b2s = {} # maps barcodes to samples
-    # Case 1: barcodes file is FASTA format
-    if format == 'fasta':
-        for [s,b] in util.iter_fst(map_fn):
-            if rc == True:
-                seq = reverse_complement(s)
-            b2s[b] = s
-    # Case 2: barcodes file is tab-delimited
-    elif format == 'tab':
-        with open(map_fn) as fid:
-            all_lines = fid.readlines()
-        for line in open(map_fn):
-            [s,b] = line.rstrip().split()
-            if rc == True:
-                b = reverse_complement(b)
-            b2s[b] = s
-    # Return map of barcodes to samples
-    return b2s
-
-
-def parse_index_file(index_fn, format='fasta'):
-    # Map FASTQ sequences to their barcodes
-    s2b = {} # maps sequences to barcodes
-    # Case 1: index file is FASTA format
-    if format=='fasta':
-        for [s,b] in util.iter_fst(index_fn):
-            s2b[s] = b
-    # Case 2: index file is tab-delimited
-    elif format=='tab':
-        for line in open(index_fn):
-            [s,b] = line.rstrip().split()
-            s2b[s] = b
-    return s2b
-
-
-def extract_barcode_from_id(line):
-    # for this type of fasta line:
-    # @MISEQ:1:1101:14187:1716#ATAGGTGG/1
-    bcode = line.split('#')[-1].split('/')[0]
-    return bcode
-
-
-def mismatches(seq, subseq, w):
-    # Calculate the number of mismatches between a sequence and a given subsequence
-    # Searches in a sliding window that starts at position 1 and ends at position w
-    best_i = 0 # index (start position)
-    best_d = len(seq) # edit distance
-    # for every start position
-    for i in range(w):
-        # calculate edit distance to the given subsequence
-        if len(seq[i:]) < len(subseq):
-            continue
-        d = primer.MatchPrefix(seq[i:], subseq)
-        # keep track of the best index and edit distance
-        if d < best_d:
-            best_i = i
-            best_d = d
-    return [best_i, best_d]
-
-
-def find_best_match(seq, b2s, w, max_diff):
-    # Find the sample with the best matching barcode
-    best_i = ''
-    best_b = '' # barcode
-    best_d = len(seq) # edit distance
-    # Calculate edit distance to every barcode
-    for b in b2s:
-        [i,d] = mismatches(seq, b, w) # index, edit distance
-        if d < best_d:
-            best_i = i
-            best_b = b
-            best_d = d
-    # Return [index, edit distance, barcode, sample id] of best match
-    if best_d <= max_diff:
-        return [best_i, best_d, best_b, b2s[best_b]]
-    else:
-        return ['', '', '', '']
-
-
 def run():
     # Maps FASTQ sequences to samples by finding the best matching barcodes
     # Create new sequence ids of the form: sample_count, for compatibility with QIIME etc.
     
     # Initialize variables
     args = parse_args()
-    b2s = parse_barcodes_file(args.b, format=args.B, rc=args.rc) # barcodes to samples
-    s2b = parse_index_file(args.i, format=args.I) # samples to barcodes
-    s2c = {} # count number for a given sample
-    out = open(args.o, 'w')
+    b2s = stages.read_barcodes(args.b, format=args.B, rc=args.rc) # barcodes to samples
     
-    # Get FASTA, FASTQ filenames and iterators
+    # Get FASTA, FASTQ file
     if args.f:
-        fn = args.f
-        iter_fst = util.iter_fst
+        [fn, fmt] = [args.f, 'fasta']
     if args.q:
-        fn = args.q
-        iter_fst = util.iter_fsq
+        [fn, fmt] = [args.q, 'fastq']
+    
+    # Demultiplex
+    [n_seqs, s2c, n_ambiguous] = stages.split_by_barcodes(fn, args.o, b2s, args.mode, fmt=fmt, w=args.w, max_diff=args.d, indels=args.e,
+                                                          index_fn=args.i, index_format=args.I, index_order=args.index_order)
     
-    # For every record in FASTA/FASTQ file...
-    for record in iter_fst(fn):
-        sid = record[0][1:] # id
-        seq = record[1] # sequence
-        qual = ''
-        if len(record) > 2:
-            qual = record[3]
-        
-        # Case 1: barcodes are in the sample IDs
-        if args.mode == 1:
-            # Extract barcode from sequence id
-            barcode = extract_barcode_from_id(record[0])
-            # Find best matching sample
-            [i,d,b,s] = find_best_match(barcode, b2s, args.w, args.d)
-        
-        # Case 2: barcodes are in the sequences
-        elif args.mode == 2:
-            # Search sequence for best barcode
-            [i,d,b,s] = find_best_match(seq, b2s, args.w, args.d)
-            # Trim barcode from sequence
-            if i != '':
-                record[1] = seq[i+len(b):]
-                if qual != '':
-                    record[3] = qual[i+len(b):]
-        
-        # Case 3: barcodes are in index file
-        elif args.mode == 3:
-            # Get barcode from index file
-            b = s2b[sid]
-            # Find best matching sample
-            [i,d,b,s] = find_best_match(b, b2s, args.w, args.d)
-        
-        # If sample found, replace seqid with new seqid
-        if s:
-            s2c[s] = s2c.get(s, 0) + 1 # Increment sample count
-            new_sid = '@%s_%d' %(s, s2c[s])
-            record[0] = new_sid
-            out.write('\n'.join(record) + '\n')
-    out.close()
+    # Print statistics
+    n_assigned = sum(s2c.values())
+    print 'Assigned %d of %d total sequences to %d samples (%d ambiguous)' %(n_assigned, n_seqs, len(s2c), n_ambiguous)
 
 run()
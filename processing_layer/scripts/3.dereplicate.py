@@ -1,6 +1,7 @@
 # Dereplicate sequences in fasta file
+# Command line wrapper around stages.dereplicate
 
-import util, argparse, re, os, seqdb
+import argparse, multiprocessing, stages
 
 def parse_args():
     # Parse command line arguments
@@ -13,68 +14,27 @@ def parse_args():
     parser.add_argument('-M', help='Min count', default=10, type=int)
     parser.add_argument('-S', help='Min samples', default=1, type=int)
     parser.add_argument('-l', help='Trim length', type=int, default=0)
+    parser.add_argument('-p', help='Number of processes (FASTA input)', type=int, default=1)
+    parser.add_argument('-c', '--prefilter', help='Read the input twice and only store the sequences that can reach -M (count-min sketch, one process)', action='store_true', default=False)
+    parser.add_argument('-x', '--prefix', help='Prefix dereplication: fold sequences that are a prefix of a more abundant sequence into the longest one', action='store_true', default=False)
+    parser.add_argument('-m', help='Memory budget (MB, default: half of the physical memory), beyond which sorted runs are written to disk and merged', type=float, default=0)
     args = parser.parse_args()
+    if args.p > 1 and args.f and args.prefilter:
+        parser.error('-c/--prefilter runs in one process and cannot be used with -p > 1')
     return args
 
 
-def dereplicate(fst='', fsq='', sep='', trim_len=''):
-    # Dereplicate sequences
-    # NOTE:
-    #      Separator for barcodes must be specified in summary file. 
-    #      e.g. 'SRR230982_142' the separator is '_'
-    #      
-    x = {}
-    if fst:
-        fn = fst
-        iter_fst = util.iter_fst
-    if fsq:
-        fn = fsq
-        iter_fst = util.iter_fsq
-
-    for record in iter_fst(fn):
-        [sid, seq] = record[:2]
-        sid = sid[1:]
-        #sa = re.search('(.*?)%s' %(sep), sid).group(1)
-#        sa = sid.split(sep)[0]
-        sa = sid.split(sep)
-        sa = sep.join(sa[:len(sa)-1])
-        if trim_len:
-            if len(seq) >= trim_len:
-                seq = seq[:trim_len]
-            else:
-                continue
-        if seq not in x:
-            x[seq] = {}
-#        if sid not in x[seq]:
-#            x[seq][sid] = 0
-#        x[seq][sid] += 1
-        if sa not in x[seq]:
-            x[seq][sa] = 0
-        x[seq][sa] += 1
-
-    return x
-
-
-def write_output(x, map_fn, db_fn, min_size=1, min_samples=1):
-    # Write output (database + mapping file)
-    # Load SeqDB
-    min_samples = 1
-    db = seqdb.SeqDB(fn=db_fn)
-    out = open(map_fn, 'w')
-    for seq in x:
-        size = sum(x[seq].values())
-        if size < min_size:
-            continue
-        if len(x[seq]) < min_samples:
-            continue
-        db.add_seq(seq, size=size)
-        out.write('%s\t%s\n' %(db.db[:seq], ' '.join(['%s:%d' %(sa, x[seq][sa]) for sa in x[seq]])))
-
-    out.close()
-    db.write(db_fn)
-
 args = parse_args()
 if args.l == 0:
     args.l = ''
-x = dereplicate(fst=args.f, fsq=args.q, sep=args.s, trim_len=args.l)
-write_output(x, map_fn=args.o, db_fn=args.d, min_size=args.M, min_samples=args.S)
+if args.m > 0:
+    memory = args.m*2**20
+else:
+    memory = stages.memory_budget()
+if args.p > 1 and args.f:
+    pool = multiprocessing.Pool(args.p)
+    stages.dereplicate_parallel_and_write(args.o, args.d, args.f, pool, args.p, sep=args.s, trim_len=args.l, min_size=args.M, min_samples=args.S, memory=memory, tmp_prefix=args.o, prefix=args.prefix)
+    pool.close()
+    pool.join()
+else:
+    stages.dereplicate_and_write(args.o, args.d, fst=args.f, fsq=args.q, sep=args.s, trim_len=args.l, min_size=args.M, min_samples=args.S, memory=memory, tmp_prefix=args.o + '.run', prefilter=args.prefilter, prefix=args.prefix)
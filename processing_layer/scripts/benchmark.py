@@ -0,0 +1,840 @@
+# Benchmarks for the sequence processing code (new implementations vs. the code they replaced)
+# Usage: python benchmark.py --test fastq [-n 1000000]
+#        python benchmark.py --test fasta -n 100000 -L 1500
+#        python benchmark.py --test primers [-n 1000000]
+#        python benchmark.py --test barcodes [-n 1000000]
+#        python benchmark.py --test stages -n 10000
+#        python benchmark.py --test chunk -n 50000
+#        python benchmark.py --test pipeline -n 32 (chunks) [--procs 8]
+#        python benchmark.py --test renumber -n 1000000 [--procs 8]
+#        python benchmark.py --test derep -n 1000000 [--procs 8]
+#        python benchmark.py --test derep_memory -n 1000000 [-L 250]
+#        python benchmark.py --test derep_external -n 1000000 [--memory 32]
+#        python benchmark.py --test derep_prefilter -n 1000000
+#        python benchmark.py --test derep_prefix -n 1000000
+#        python benchmark.py --test seqdb -n 10000000 -L 32
+
+import argparse, itertools, os, random, shutil, subprocess, sys, tempfile, time
+import multiprocessing as mp
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'usearch_python'))
+import numpy as np
+import fasta, pipeline, primer, primermatch, readbatch, seqdb, stages, util
+
+
+def parse_args():
+    # Parse command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--test', help='Benchmark to run', choices=sorted(TESTS), required=True)
+    parser.add_argument('-n', help='Number of records', type=int, default=1000000)
+    parser.add_argument('-L', help='Read length', type=int, default=250)
+    parser.add_argument('--seed', help='Random seed', type=int, default=1)
+    parser.add_argument('--tmp', help='Directory for temporary files', default=None)
+    parser.add_argument('--procs', help='Pool size (pipeline, renumber and derep tests)', type=int, default=mp.cpu_count())
+    parser.add_argument('--memory', help='Memory budget (MB, derep_external test)', type=float, default=32)
+    args = parser.parse_args()
+    return args
+
+
+def random_seq(L):
+    return ''.join([random.choice('ACGT') for i in range(L)])
+
+
+def write_fastq(fn, n, L):
+    # Write n random reads of length L (quality strings encoded with ASCII 33)
+    out = open(fn, 'w')
+    seq = random_seq(4*L)
+    qual = ''.join([chr(33 + random.randint(2, 40)) for i in range(4*L)])
+    for i in range(n):
+        j = random.randint(0, 3*L)
+        out.write('@MISEQ:1:1101:%d:%d#ACGTACGT/1\n%s\n+\n%s\n' %(i, j, seq[j:j+L], qual[j:j+L]))
+    out.close()
+
+
+def write_fasta(fn, n, L, width=80):
+    # Write n random sequences of length L, wrapped at width characters per line
+    out = open(fn, 'w')
+    seq = random_seq(4*L)
+    for i in range(n):
+        j = random.randint(0, 3*L)
+        out.write('>%d;size=%d\n' %(i, n-i))
+        for k in range(0, L, width):
+            out.write(seq[j+k:j+min(k+width, L)] + '\n')
+    out.close()
+
+
+def report(name, n, t):
+    print '%-32s %8.2f s %12.0f records/s' %(name, t, n/t)
+
+
+def timeit(name, n, f, repeat=3):
+    # Time f() (best of repeat runs) and report records per second
+    ts = []
+    for i in range(repeat):
+        t = time.time()
+        f()
+        ts.append(time.time() - t)
+    t = min(ts)
+    report(name, n, t)
+    return t
+
+
+def consume(x):
+    # Exhaust an iterator
+    for xi in x:
+        pass
+
+
+# Legacy implementations (kept here as the baseline for comparisons)
+
+def legacy_iter_fsq(fn):
+    # util.iter_fsq before the block reader
+    record = []
+    i = 0
+    for line in open(fn):
+        i += 1
+        if i % 4 == 1:
+            if len(record) > 0:
+                yield record
+            record = []
+        record.append(line.rstrip())
+    yield record
+
+
+def legacy_iter_fst(fn):
+    # util.iter_fst before the streaming fasta engine
+    seq = ''
+    for line in open(fn):
+        line = line.rstrip()
+        if line.startswith('>'):
+            if seq != '':
+                yield [sid, seq]
+            sid = line
+            seq = ''
+        else:
+            seq += line
+    yield [sid, seq]
+
+
+def legacy_read_seqs_fast(fn):
+    # fasta.ReadSeqsFastFile before the streaming fasta engine
+    Seqs = {}
+    Id = ""
+    File = open(fn)
+    while 1:
+        Line = File.readline()
+        if len(Line) == 0:
+            return Seqs
+        Line = Line.strip()
+        if Line[0] == ">":
+            Id = Line[1:]
+            Seqs[Id] = ""
+        else:
+            Seqs[Id] = Seqs[Id] + Line
+
+
+def legacy_match_letter(a, b):
+    # primer.MatchLetter before the IUPAC table
+    if b == 'A' or b == 'C' or b == 'G' or b == 'T':
+        return a == b
+    elif b == 'S':
+        return a == 'C' or a == 'G'
+    elif b == 'Y':
+        return a == 'T' or a == 'C'
+    elif b == 'K':
+        return a == 'G' or a == 'T'
+    elif b == 'V':
+        return a == 'A' or a == 'C' or a == 'G'
+    elif b == 'H':
+        return a == 'A' or a == 'C' or a == 'T'
+    elif b == 'D':
+        return a == 'A' or a == 'G' or a == 'T'
+    elif b == 'B':
+        return a == 'C' or a == 'G' or a == 'T'
+    elif b == 'X' or b == 'N':
+        return a == 'G' or a == 'A' or a == 'T' or a == 'C'
+    elif b == 'R':
+        return a == 'A' or a == 'G'
+    elif b == 'M':
+        return a == 'A' or a == 'C'
+    elif b == 'W':
+        return a == 'A' or a == 'T'
+    else:
+        quit('Error: bad letter in primer')
+
+
+def legacy_match_prefix(seq, p):
+    # primer.MatchPrefix before the IUPAC table
+    n = min(len(seq), len(p))
+    diffs = 0
+    for i in range(0, n):
+        if not legacy_match_letter(seq[i], p[i]):
+            diffs += 1
+    return diffs
+
+
+def legacy_find_best_match(seq, primers, w, max_dist, match_prefix=legacy_match_prefix):
+    # stages.find_best_primer (mismatches inlined), one read at a time
+    best_i = ''
+    best_p = ''
+    best_d = len(seq)
+    for p in primers:
+        i_p = 0
+        d_p = len(seq)
+        for i in range(w):
+            d = match_prefix(seq[i:], p)
+            if d < d_p:
+                i_p = i
+                d_p = d
+        if d_p < best_d:
+            best_i = i_p
+            best_p = p
+            best_d = d_p
+    if best_d <= max_dist:
+        return [best_i, best_d, best_p]
+    else:
+        return ['', '', '']
+
+
+def legacy_find_barcode(seq, barcodes, w, max_diff):
+    # stages.find_best_barcode (mismatches inlined), one read at a time
+    best_i = ''
+    best_b = ''
+    best_d = len(seq)
+    for b in barcodes:
+        i_b = 0
+        d_b = len(seq)
+        for i in range(w):
+            if len(seq[i:]) < len(b):
+                continue
+            d = legacy_match_prefix(seq[i:], b)
+            if d < d_b:
+                i_b = i
+                d_b = d
+        if d_b < best_d:
+            best_i = i_b
+            best_b = b
+            best_d = d_b
+    if best_d <= max_diff:
+        return [best_i, best_d, best_b]
+    else:
+        return ['', '', '']
+
+
+def legacy_renumber_sequences(fasta_files, separator, fasta_out):
+    # preprocessing_16S.renumber_sequences before parallel relabeling: every file is rewritten in turn (.tmp + mv), then concatenated
+    sample_counts = {}
+    for filename in fasta_files:
+        with open(filename + '.tmp', 'w') as outfile:
+            for record in util.iter_fst(filename):
+                sid = record[0][1:].split(separator)
+                sampleID = ''.join(sid[:len(sid)-1])
+                sample_counts[sampleID] = sample_counts.get(sampleID, 0) + 1
+                record[0] = '>%s_%d' %(sampleID, sample_counts[sampleID])
+                outfile.write('\n'.join(record) + '\n')
+        os.system('mv ' + filename + '.tmp ' + filename)
+    os.system('cat ' + ' '.join(fasta_files) + ' > ' + fasta_out)
+
+
+# Benchmarks
+
+def legacy_dereplicate(fn, sep):
+    # stages.dereplicate before derepstore: {seq: {sample: count}} dict of dicts
+    x = {}
+    for [sid, seq] in util.iter_fst(fn):
+        sid = sid[1:]
+        sa = sid.split(sep)
+        sa = sep.join(sa[:len(sa)-1])
+        if seq not in x:
+            x[seq] = {}
+        if sa not in x[seq]:
+            x[seq][sa] = 0
+        x[seq][sa] += 1
+    return x
+
+
+def items(x):
+    # (seq, [(sample, count), ...]) items of a dereplicated map, in iteration order
+    return [(seq, counts.items()) for seq, counts in x.iteritems()]
+
+
+def bench_fastq(args, tmp):
+    # Compare FASTQ readers (reads/sec) and check that they yield the same records
+    fn = os.path.join(tmp, 'reads.fastq')
+    write_fastq(fn, args.n, args.L)
+    print 'FASTQ reader: %d reads x %d bp (%.1f MB)' %(args.n, args.L, os.path.getsize(fn)/1e6)
+    for r1, r2 in itertools.izip(legacy_iter_fsq(fn), util.iter_fsq(fn)):
+        if r1 != r2:
+            quit('Error: iter_fsq records differ from legacy reader')
+    t0 = timeit('legacy iter_fsq', args.n, lambda: consume(legacy_iter_fsq(fn)))
+    t1 = timeit('iter_fsq (lists)', args.n, lambda: consume(util.iter_fsq(fn)))
+    t2 = timeit('iter_fsq_records (tuples)', args.n, lambda: consume(util.iter_fsq_records(fn)))
+    t3 = timeit('iter_fsq_batches (n=%d)' %(util.FSQ_BATCH_SIZE), args.n, lambda: consume(util.iter_fsq_batches(fn)))
+    t4 = timeit('iter_fsq_blocks (raw lines)', args.n, lambda: consume(util.iter_fsq_blocks(fn)))
+    print 'Speedup vs legacy: lists %.1fx, tuples %.1fx, batches %.1fx, blocks %.1fx' %(t0/t1, t0/t2, t0/t3, t0/t4)
+
+
+def bench_fasta(args, tmp):
+    # Compare FASTA readers on a wrapped reference file (e.g. 100k records, -L 1500)
+    # iter_fst and iter_fst_batches are bound by per-record interpreter overhead, as the legacy reader is, and run at about
+    # its speed; the linear-time join pays off in fasta.ReadSeqsFast, which grew its sequences by copying
+    fn = os.path.join(tmp, 'reference.fasta')
+    write_fasta(fn, args.n, args.L)
+    print 'FASTA reader: %d records x %d bp, wrapped at 80 (%.1f MB)' %(args.n, args.L, os.path.getsize(fn)/1e6)
+    for r1, r2 in itertools.izip(legacy_iter_fst(fn), util.iter_fst(fn)):
+        if r1 != r2:
+            quit('Error: iter_fst records differ from legacy reader')
+    if legacy_read_seqs_fast(fn) != fasta.ReadSeqsFast(fn, False):
+        quit('Error: ReadSeqsFast differs from legacy reader')
+    t0 = timeit('legacy iter_fst', args.n, lambda: consume(legacy_iter_fst(fn)))
+    t1 = timeit('iter_fst', args.n, lambda: consume(util.iter_fst(fn)))
+    t2 = timeit('iter_fst_batches (n=%d)' %(util.FST_BATCH_SIZE), args.n, lambda: consume(util.iter_fst_batches(fn)))
+    t3 = timeit('legacy fasta.ReadSeqsFast', args.n, lambda: legacy_read_seqs_fast(fn), repeat=1)
+    t4 = timeit('fasta.ReadSeqsFast', args.n, lambda: fasta.ReadSeqsFast(fn, False))
+    print 'Speedup vs legacy: iter_fst %.1fx, iter_fst_batches %.1fx, ReadSeqsFast %.1fx' %(t0/t1, t0/t2, t3/t4)
+
+
+def random_primer_reads(n, L, primers):
+    # n reads of length L starting with 0-5 random bases and a degenerate primer with ~5% errors (some without primer)
+    # errors are 3% substitutions (or N), 1% deletions and 1% insertions
+    seqs = []
+    tail = random_seq(4*L)
+    for i in range(n):
+        p = random.choice(primers)
+        if random.random() < 0.1:
+            p = random_seq(len(p))
+        bases = []
+        for b in p:
+            r = random.random()
+            if r < 0.03:
+                bases.append(random.choice('ACGTN'))
+            elif r < 0.04:
+                continue
+            elif r < 0.05:
+                bases.append(random.choice('ACGT') + random.choice(list(primer.IUPAC[b])))
+            else:
+                bases.append(random.choice(list(primer.IUPAC[b])))
+        p = ''.join(bases)
+        j = random.randint(0, 3*L)
+        seqs.append((random_seq(random.randint(0, 5)) + p + tail[j:j+L])[:L])
+    return seqs
+
+
+def bench_primers(args, tmp):
+    # Compare primer matching (reads/sec) and check that every read gets the same match as find_best_match
+    primers = ['GTGCCAGCMGCCGCGGTAA', 'GGACTACHVGGGTWTCTAAT']
+    w = 10
+    max_dist = 1
+    seqs = random_primer_reads(args.n, args.L, primers)
+    print 'Primer matching: %d reads x %d bp, %d primers, w = %d, d = %d' %(args.n, args.L, len(primers), w, max_dist)
+    def match_all(matcher):
+        results = []
+        for i in range(0, len(seqs), util.FSQ_BATCH_SIZE):
+            [x, lengths] = readbatch.encode_seqs(seqs[i:i+util.FSQ_BATCH_SIZE])
+            results.append(matcher.match_ends(x, lengths))
+        return [np.concatenate(r) for r in zip(*results)]
+    matcher = primermatch.PrimerMatcher(primers, w, max_dist)
+    [E, D, K] = match_all(matcher)
+    for r, seq in enumerate(seqs):
+        [i, d, p] = legacy_find_best_match(seq, primers, w, max_dist)
+        if (p == '' and K[r] != -1) or (p != '' and [E[r], D[r], primers[K[r]]] != [i + len(p), d, p]):
+            quit('Error: PrimerMatcher differs from find_best_match for read %d' %(r))
+    print 'Reads with a primer match: %.2f%%' %(100.*(K >= 0).sum()/len(seqs))
+    t0 = timeit('legacy find_best_match', args.n, lambda: [legacy_find_best_match(seq, primers, w, max_dist) for seq in seqs], repeat=1)
+    t1 = timeit('find_best_match (IUPAC table)', args.n, lambda: [legacy_find_best_match(seq, primers, w, max_dist, primer.MatchPrefix) for seq in seqs], repeat=1)
+    t2 = timeit('PrimerMatcher (n=%d)' %(util.FSQ_BATCH_SIZE), args.n, lambda: match_all(matcher))
+    print 'Speedup vs legacy: IUPAC table %.1fx, PrimerMatcher %.1fx' %(t0/t1, t0/t2)
+    # Exact prefix index first, full scan of the misses only (as stages.trim_primers); stages.compile_primers only uses the
+    # index with a matcher it speeds up
+    def match_indexed(index, matcher):
+        results = []
+        for i in range(0, len(seqs), util.FSQ_BATCH_SIZE):
+            [x, lengths] = readbatch.encode_seqs(seqs[i:i+util.FSQ_BATCH_SIZE])
+            [I, K] = index.match(x, lengths)
+            E = np.where(K >= 0, I + np.array([len(p) for p in primers])[K], -1)
+            miss = np.flatnonzero(K < 0)
+            E[miss] = matcher.match_ends(x[miss], lengths[miss])[0]
+            results.append([E, K >= 0])
+        return [np.concatenate(r) for r in zip(*results)]
+    index = primermatch.PrefixIndex(primers, w, min_len=w - 1 + max([len(p) for p in primers]))
+    [E, hits] = match_indexed(index, matcher)
+    if (E != match_all(matcher)[0]).any():
+        quit('Error: PrefixIndex + PrimerMatcher differs from PrimerMatcher')
+    print 'Exact prefix hits (fast path): %.2f%%, full scan: %.2f%%' %(100.*hits.sum()/len(seqs), 100.*(~hits).sum()/len(seqs))
+    t3 = timeit('PrefixIndex + PrimerMatcher', args.n, lambda: match_indexed(index, matcher))
+    print 'Speedup vs PrimerMatcher: %.1fx' %(t2/t3)
+    # Indel-tolerant matching vs. the wider Hamming search it replaces, and with the prefix index
+    for [name, m] in [['PrimerMatcher w=%d d=%d' %(w + 5, max_dist + 2), primermatch.PrimerMatcher(primers, w + 5, max_dist + 2)],
+                      ['EditMatcher w=%d d=%d' %(w, max_dist), primermatch.EditMatcher(primers, w, max_dist)]]:
+        K = match_all(m)[2]
+        t4 = timeit('%s (%.2f%% matched)' %(name, 100.*(K >= 0).sum()/len(seqs)), args.n, lambda: match_all(m))
+    index = primermatch.PrefixIndex(primers, w + max_dist)
+    if (match_indexed(index, m)[0] != match_all(m)[0]).any():
+        quit('Error: PrefixIndex + EditMatcher differs from EditMatcher')
+    t5 = timeit('PrefixIndex + EditMatcher', args.n, lambda: match_indexed(index, m))
+    print 'Speedup vs EditMatcher: %.1fx' %(t4/t5)
+
+def bench_barcodes(args, tmp):
+    # Compare barcode demultiplexing (reads/sec) with 384 barcodes and check the matches against find_best_match
+    # The legacy matcher is checked and timed on the first 2000 reads only
+    barcodes = sorted(set([random_seq(8) for i in range(384)]))
+    w = 5
+    max_diff = 1
+    seqs = []
+    for i in range(args.n):
+        b = ''.join([a if random.random() > 0.02 else random.choice('ACGTN') for a in random.choice(barcodes)])
+        seqs.append(random_seq(random.randint(0, 2)) + b + random_seq(20))
+    print 'Barcode matching: %d reads, %d barcodes, w = %d, d = %d' %(args.n, len(barcodes), w, max_diff)
+    t = time.time()
+    index = primermatch.BarcodeIndex(barcodes, max_diff)
+    print 'BarcodeIndex: %d sequences, %d colliding barcode pairs, built in %.2f s' %(len(index.index), len(index.collisions()), time.time() - t)
+    n_legacy = min(args.n, 2000)
+    n_ambiguous = 0
+    for r, seq in enumerate(seqs[:n_legacy]):
+        [i, d, b] = legacy_find_barcode(seq, barcodes, w, max_diff)
+        hit = index.lookup(seq, w)
+        if hit is not None and hit[2] is None:
+            n_ambiguous += 1
+        elif (b == '' and hit is not None) or (b != '' and [i + len(b), d, b] != hit):
+            quit('Error: BarcodeIndex differs from find_best_match for read %d' %(r))
+    print 'Ambiguous reads (assigned arbitrarily by find_best_match): %.2f%%' %(100.*n_ambiguous/n_legacy)
+    t0 = timeit('legacy find_best_match', n_legacy, lambda: [legacy_find_barcode(seq, barcodes, w, max_diff) for seq in seqs[:n_legacy]], repeat=1)
+    t1 = timeit('BarcodeIndex', args.n, lambda: [index.lookup(seq, w) for seq in seqs])
+    print 'Speedup vs legacy: %.1fx' %((t0/n_legacy)/(t1/args.n))
+
+
+def bench_stages(args, tmp):
+    # Per-chunk cost of steps 1 and 2 run as a new python process (as before) vs. in-process calls to stages
+    # Chunks of args.n reads; the in-process calls reuse the primer and barcode tables compiled for the first chunk
+    scripts = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([scripts, os.path.join(scripts, 'usearch_python'), env.get('PYTHONPATH', '')])
+    primers = ['GTGCCAGCMGCCGCGGTAA', 'GGACTACHVGGGTWTCTAAT']
+    barcodes = sorted(set([random_seq(8) for i in range(384)]))
+    fn = os.path.join(tmp, 'chunk.fastq')
+    primers_fn = os.path.join(tmp, 'primers.lst')
+    barcodes_fn = os.path.join(tmp, 'barcodes.lst')
+    out_fn = os.path.join(tmp, 'out.fastq')
+    with open(primers_fn, 'w') as out:
+        out.write('\n'.join(primers) + '\n')
+    with open(barcodes_fn, 'w') as out:
+        out.write(''.join(['S%d\t%s\n' %(i, b) for i, b in enumerate(barcodes)]))
+    with open(fn, 'w') as out:
+        for i, seq in enumerate(random_primer_reads(args.n, args.L, primers)):
+            out.write('@MISEQ:1:1101:%d:1#%s/1\n%s\n+\n%s\n' %(i, random.choice(barcodes), seq, 'I'*len(seq)))
+    print 'Per-chunk cost: %d reads x %d bp, %d primers, %d barcodes' %(args.n, args.L, len(primers), len(barcodes))
+    devnull = open(os.devnull, 'w')
+    def run_script(cmd):
+        subprocess.check_call([sys.executable] + cmd, env=env, stdout=devnull)
+    for [name, cmd, f] in [['1.remove_primers', [os.path.join(scripts, '1.remove_primers.py'), '-q', fn, '-l', primers_fn, '-d', '1', '-o', out_fn],
+                            lambda: stages.remove_primers(fn, out_fn, stages.read_primers(primers_fn), max_dist=1)],
+                           ['2.split_by_barcodes', [os.path.join(scripts, '2.split_by_barcodes.py'), '-q', fn, '-b', barcodes_fn, '-B', 'tab', '-d', '1', '--mode', '1', '-o', out_fn],
+                            lambda: stages.split_by_barcodes(fn, out_fn, stages.read_barcodes(barcodes_fn, format='tab'), 1, max_diff=1)]]:
+        t0 = timeit('%s (new process)' %(name), args.n, lambda: run_script(cmd))
+        f()
+        t1 = timeit('%s (in-process)' %(name), args.n, f)
+        print '%s per chunk: %.0f ms in a new process, %.0f ms in-process (%.0f ms startup and compile overhead removed)' %(name, 1000*t0, 1000*t1, 1000*(t0 - t1))
+    devnull.close()
+
+
+def bench_chunk(args, tmp):
+    # Steps 2.1-2.5 of raw2otu.py on one chunk: one file per step (as before) vs. the fused single pass of process_chunk
+    # The FASTA conversion of the per-step chain is done with readbatch instead of fastq_to_fasta
+    import preprocessing_16S as OTU
+    primers = ['GTGCCAGCMGCCGCGGTAA', 'GGACTACHVGGGTWTCTAAT']
+    barcodes = sorted(set([random_seq(8) for i in range(96)]))
+    fn = os.path.join(tmp, 'chunk')
+    primers_fn = os.path.join(tmp, 'primers.lst')
+    barcodes_fn = os.path.join(tmp, 'barcodes.lst')
+    with open(primers_fn, 'w') as out:
+        out.write('\n'.join(primers) + '\n')
+    with open(barcodes_fn, 'w') as out:
+        out.write(''.join(['S%d\t%s\n' %(i, b) for i, b in enumerate(barcodes)]))
+    with open(fn, 'w') as out:
+        for i, seq in enumerate(random_primer_reads(args.n, args.L, primers)):
+            qual = ''.join([chr(33 + min(40, max(2, int(random.gauss(34, 6))))) for b in seq])
+            out.write('@MISEQ:1:1101:%d:1#%s/1\n%s\n+\n%s\n' %(i, random.choice(barcodes), seq, qual))
+    print 'Chunk of %d reads x %d bp, %d primers, %d barcodes' %(args.n, args.L, len(primers), len(barcodes))
+    devnull = open(os.devnull, 'w')
+    def quiet(f):
+        # Run f with the step reports sent to /dev/null
+        def g():
+            stdout = sys.stdout
+            sys.stdout = devnull
+            try:
+                f()
+            finally:
+                sys.stdout = stdout
+        return g
+    @quiet
+    def per_step():
+        OTU.split_by_barcodes((fn, fn + '.sb', barcodes_fn, '1', ''))
+        OTU.remove_primers((fn + '.sb', fn + '.pt', primers_fn))
+        OTU.trim_quality((fn + '.pt', fn + '.qt', 33, 10))
+        OTU.trim_length_fastq((fn + '.qt', fn + '.lt', 101, 33))
+        with open(fn + '.fasta', 'w') as out:
+            for batch in readbatch.iter_batches(fn + '.lt'):
+                batch.subset(~(batch.seqs == ord('N')).any(axis=1)).write(out, fmt='fasta')
+    @quiet
+    def fused():
+        OTU.process_chunk((fn, 0, None, fn, 'fastq', barcodes_fn, '1', '', primers_fn, 33, 10, 101, False))
+    per_step()
+    t0 = timeit('per-step files', args.n, per_step)
+    t1 = timeit('fused', args.n, fused)
+    print 'Steps 2.1-2.5 per chunk: %.0f ms with per-step files, %.0f ms fused (%.1fx)' %(1000*t0, 1000*t1, t0/t1)
+    devnull.close()
+
+
+def sleep_task((t, x)):
+    # Stand-in for a chunk task that takes t seconds (e.g. decompress or process a chunk)
+    time.sleep(t)
+    return x
+
+
+def bench_pipeline(args, tmp):
+    # Two stages over args.n chunks with unequal task times: one pool and one pool.map barrier per stage (as before) vs.
+    # one pool for the whole run, each chunk moving to its next stage as soon as it is done (pipeline.run_stages)
+    n_cpus = args.procs
+    times = [[random.uniform(0.02, 0.05), random.lognormvariate(-2.5, 1.0)] for i in range(args.n)]
+    print '%d chunks on %d CPUs, stage 1 %.2f s, stage 2 %.2f s of task time (longest task %.2f s)' %(args.n, n_cpus,
+        sum([t[0] for t in times]), sum([t[1] for t in times]), max([max(t) for t in times]))
+    def barrier():
+        x = range(args.n)
+        for k in range(2):
+            pool = mp.Pool(n_cpus)
+            x = pool.map(sleep_task, [(times[i][k], x[i]) for i in range(args.n)])
+            pool.close()
+            pool.join()
+    def pipelined():
+        pool = mp.Pool(n_cpus)
+        pipeline.run_stages(pool, range(args.n), [['stage %d' %(k), sleep_task, lambda i, x, k=k: (times[i][k], x)] for k in range(2)], verbose=False)
+        pool.close()
+        pool.join()
+    t0 = timeit('pool.map per stage', args.n, barrier)
+    t1 = timeit('pipeline.run_stages', args.n, pipelined)
+    print 'Wall time: %.2f s -> %.2f s (%.2fx)' %(t0, t1, t0/t1)
+
+
+def bench_renumber(args, tmp):
+    # Renumber and concatenate args.n reads in 4*procs chunk files: serial rewrite + cat (as before) vs. two-phase parallel relabeling
+    import preprocessing_16S as OTU
+    n_chunks = 4*args.procs
+    samples = ['S%d' %(i) for i in range(96)]
+    filenames = [os.path.join(tmp, 'x%05d.fasta' %(i)) for i in range(n_chunks)]
+    for i, fn in enumerate(filenames):
+        with open(fn, 'w') as out:
+            for j in range(args.n/n_chunks):
+                out.write('>%s_%d\n%s\n' %(random.choice(samples), j + 1, random_seq(101)))
+    print '%d reads in %d chunks, %d samples, pool of %d' %(args.n, n_chunks, len(samples), args.procs)
+    legacy_fn = os.path.join(tmp, 'legacy.fasta')
+    new_fn = os.path.join(tmp, 'new.fasta')
+    devnull = open(os.devnull, 'w')
+    pool = mp.Pool(args.procs)
+    def renumber(pool):
+        stdout = sys.stdout
+        sys.stdout = devnull
+        try:
+            OTU.renumber_sequences(filenames, '_', new_fn, pool=pool)
+        finally:
+            sys.stdout = stdout
+    t1 = timeit('renumber_sequences (one pass)', args.n, lambda: renumber(None))
+    t2 = timeit('renumber_sequences (two-phase)', args.n, lambda: renumber(pool))
+    t0 = timeit('renumber_sequences (legacy)', args.n, lambda: legacy_renumber_sequences(filenames, '_', legacy_fn), repeat=1)
+    pool.close()
+    pool.join()
+    if open(legacy_fn).read() != open(new_fn).read():
+        util.error('Error: renumbered files differ')
+    print 'Renumber + concatenate: %.2f s -> %.2f s (one pass), %.2f s (two-phase, pool of %d)' %(t0, t1, t2, args.procs)
+    devnull.close()
+
+
+def bench_derep(args, tmp):
+    # Dereplicate args.n reads: one process (stages.dereplicate) vs. map-reduce on a pool (stages.dereplicate_parallel)
+    # Both must give the same map, in the same iteration order (write_dereplicated output)
+    samples = ['S%d' %(i) for i in range(96)]
+    uniques = [random_seq(101) for i in range(max(args.n/10, 1))]
+    fn = os.path.join(tmp, 'reads.fasta')
+    with open(fn, 'w') as out:
+        for i in range(args.n):
+            seq = uniques[min(int(random.paretovariate(0.7)) - 1, len(uniques) - 1)]
+            out.write('>%s_%d\n%s\n' %(random.choice(samples), i + 1, seq))
+    print '%d reads, %d samples, pool of %d' %(args.n, len(samples), args.procs)
+    pool = mp.Pool(args.procs)
+    x0 = stages.dereplicate(fst=fn, sep='_')
+    x1 = stages.dereplicate_parallel(fn, pool, args.procs, sep='_', tmp_prefix=os.path.join(tmp, 'part'))
+    if items(x0) != items(x1) or items(x0) != items(legacy_dereplicate(fn, '_')):
+        util.error('Error: dereplicated maps differ')
+    print '%d unique sequences' %(len(x0))
+    t0 = timeit('dereplicate', args.n, lambda: stages.dereplicate(fst=fn, sep='_'))
+    t1 = timeit('dereplicate_parallel', args.n, lambda: stages.dereplicate_parallel(fn, pool, args.procs, sep='_', tmp_prefix=os.path.join(tmp, 'part')))
+    pool.close()
+    pool.join()
+    print 'Dereplicate: %.2f s -> %.2f s (pool of %d)' %(t0, t1, args.procs)
+
+
+def rss():
+    # Resident memory of this process (MB)
+    with open('/proc/self/statm') as fid:
+        return int(fid.read().split()[1])*os.sysconf('SC_PAGE_SIZE')/2.0**20
+
+
+def write_derep_reads(fn, n, L, samples):
+    # Write n mostly unique reads of length L (one mutation in a random window of a random sequence, or of its start)
+    seq = random_seq(4*L)
+    with open(fn, 'w') as out:
+        for i in range(n):
+            if random.random() < 0.2:
+                j = random.randint(0, 10) # abundant sequences
+            else:
+                j = random.randint(0, 3*L)
+            read = list(seq[j:j+L])
+            read[random.randint(0, L - 1)] = random.choice('ACGT')
+            out.write('>%s_%d\n%s\n' %(random.choice(samples), i + 1, ''.join(read)))
+
+
+def derep_memory((name, fn)):
+    # Peak memory used to dereplicate fn (MB), measured in a fresh pool worker
+    import resource
+    rss0 = rss()
+    t = time.time()
+    if name == 'legacy':
+        x = legacy_dereplicate(fn, '_')
+    else:
+        x = stages.dereplicate(fst=fn, sep='_')
+    t = time.time() - t
+    return [len(x), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0 - rss0, t]
+
+
+def bench_derep_memory(args, tmp):
+    # Peak memory of the {seq: {sample: count}} dict of dicts vs. derepstore.DerepStore on args.n reads of length args.L
+    # Reads are mostly unique (singletons), as in large runs
+    samples = ['S%d' %(i) for i in range(96)]
+    fn = os.path.join(tmp, 'reads.fasta')
+    write_derep_reads(fn, args.n, args.L, samples)
+    print '%d reads of length %d, %d samples' %(args.n, args.L, len(samples))
+    result = {}
+    for name in ['legacy', 'derepstore']:
+        pool = mp.Pool(1)
+        [n_uniques, mb, t] = result[name] = pool.apply(derep_memory, [(name, fn)])
+        pool.close()
+        pool.join()
+        print '%-32s %8.1f MB %8.2f s %10d unique sequences' %(name, mb, t, n_uniques)
+    [before, after] = [result['legacy'][1], result['derepstore'][1]]
+    if after <= before:
+        print 'Peak memory: %.1f MB -> %.1f MB (%.1fx smaller)' %(before, after, before/max(after, 0.1))
+    else:
+        print 'Peak memory: %.1f MB -> %.1f MB (%.1fx larger)' %(before, after, after/max(before, 0.1))
+    [before, after] = [result['legacy'][2], result['derepstore'][2]]
+    if after <= before:
+        print 'Time: %.2f s -> %.2f s (%.1fx faster)' %(before, after, before/max(after, 1e-3))
+    else:
+        print 'Time: %.2f s -> %.2f s (%.1fx slower)' %(before, after, after/max(before, 1e-3))
+
+
+def derep_external((fn, prefix, memory, prefilter, prefix_derep)):
+    # Peak memory (MB) and time of stages.dereplicate_and_write, measured in a fresh pool worker
+    import resource
+    rss0 = rss()
+    t = time.time()
+    stages.dereplicate_and_write(prefix + '.map', prefix + '.fasta', fst=fn, sep='_', min_size=10, memory=memory, tmp_prefix=prefix + '.run', prefilter=prefilter, prefix=prefix_derep)
+    t = time.time() - t
+    return [resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0 - rss0, t]
+
+
+def read_derep_output(prefix):
+    # {seq: size} and {seq: {sample: count}} of a database and mapping file (OTU numbers aside)
+    x = seqdb.SeqDB(prefix + '.fasta')
+    db = dict(x.db.iteritems())
+    sizes = dict([(db[otu], x.size[otu]) for otu in x.db])
+    counts = {}
+    for line in open(prefix + '.map'):
+        [otu, row] = line.rstrip('\n').split('\t')
+        counts[db[int(otu)]] = dict([(sa, int(count)) for sa, count in [x.rsplit(':', 1) for x in row.split(' ')]])
+    return [sizes, counts]
+
+
+def bench_derep_external(args, tmp):
+    # Dereplicate and write args.n mostly unique reads in memory vs. out of core within --memory MB (sorted runs + merge)
+    samples = ['S%d' %(i) for i in range(96)]
+    fn = os.path.join(tmp, 'reads.fasta')
+    write_derep_reads(fn, args.n, args.L, samples)
+    print '%d reads of length %d, %d samples, budget %.0f MB' %(args.n, args.L, len(samples), args.memory)
+    for [name, memory] in [['in memory', None], ['out of core', args.memory*2**20]]:
+        pool = mp.Pool(1)
+        [mb, t] = pool.apply(derep_external, [(fn, os.path.join(tmp, name.replace(' ', '_')), memory, False, False)])
+        pool.close()
+        pool.join()
+        print '%-32s %8.1f MB %8.2f s' %(name, mb, t)
+    if read_derep_output(os.path.join(tmp, 'in_memory')) != read_derep_output(os.path.join(tmp, 'out_of_core')):
+        util.error('Error: dereplicated outputs differ')
+
+
+def bench_derep_prefilter(args, tmp):
+    # Dereplicate and write args.n mostly unique reads (min size 10) with and without the count-min sketch prefilter
+    samples = ['S%d' %(i) for i in range(96)]
+    fn = os.path.join(tmp, 'reads.fasta')
+    write_derep_reads(fn, args.n, args.L, samples)
+    print '%d reads of length %d, %d samples' %(args.n, args.L, len(samples))
+    for [name, prefilter] in [['one pass', False], ['prefilter', True]]:
+        pool = mp.Pool(1)
+        [mb, t] = pool.apply(derep_external, [(fn, os.path.join(tmp, name.replace(' ', '_')), None, prefilter, False)])
+        pool.close()
+        pool.join()
+        print '%-32s %8.1f MB %8.2f s' %(name, mb, t)
+    x = stages.dereplicate(fst=fn, sep='_')
+    cms = stages.count_sketch(fst=fn, sep='_')
+    seqs = list(x)
+    n_kept = sum([x.size(i) >= 10 for i in range(len(x))])
+    n_passed = (cms.estimate(seqs) >= 10).sum()
+    print '%d unique sequences, %d of size 10+, %d passed by the sketch (%.1f MB)' %(len(x), n_kept, n_passed, cms.memory()/2.0**20)
+    if read_derep_output(os.path.join(tmp, 'one_pass')) != read_derep_output(os.path.join(tmp, 'prefilter')):
+        util.error('Error: dereplicated outputs differ')
+
+
+def write_prefix_reads(fn, n, L, samples):
+    # Write n reads trimmed to random lengths (L/2 to L) from 10 sequences of length L and 3 rarer variants of each (one
+    # mutation), as left by quality trimming
+    seqs = []
+    for seq in [random_seq(L) for i in range(10)]:
+        seqs.append(seq)
+        for j in random.sample(range(L), 3):
+            seqs.append(seq[:j] + random.choice('ACGT'.replace(seq[j], '')) + seq[j+1:])
+    with open(fn, 'w') as out:
+        for i in range(n):
+            seq = seqs[int(random.paretovariate(1)) % len(seqs)]
+            if random.random() < 0.5:
+                seq = seq[:random.randint(L/2, L)]
+            out.write('>%s_%d\n%s\n' %(random.choice(samples), i + 1, seq))
+
+
+def naive_fold_prefixes(x):
+    # Reference prefix dereplication of {seq: {sample: count}}: every sequence is compared with all the others
+    sizes = dict([(seq, sum(counts.values())) for seq, counts in x.iteritems()])
+    parent = {}
+    for a in x:
+        for b in x:
+            if sizes[b] > sizes[a] and b.startswith(a):
+                # longest, then most abundant, then first in sequence order
+                if a not in parent or (len(b), sizes[b], parent[a]) > (len(parent[a]), sizes[parent[a]], b):
+                    parent[a] = b
+    y = {}
+    for a in x:
+        r = a
+        while r in parent:
+            r = parent[r]
+        y.setdefault(r, {})
+        for sa, count in x[a].iteritems():
+            y[r][sa] = y[r].get(sa, 0) + count
+    return y
+
+
+def bench_derep_prefix(args, tmp):
+    # Dereplicate and write args.n reads of variable length (min size 10) with and without prefix dereplication
+    # The prefix dereplicated output is checked against a naive all-pairs fold of the dereplicated sequences
+    samples = ['S%d' %(i) for i in range(96)]
+    fn = os.path.join(tmp, 'reads.fasta')
+    write_prefix_reads(fn, args.n, args.L, samples)
+    print '%d reads of length %d to %d, %d samples' %(args.n, args.L/2, args.L, len(samples))
+    x = dict(stages.dereplicate(fst=fn, sep='_').iteritems())
+    for [name, prefix_derep] in [['full length', False], ['prefix', True]]:
+        pool = mp.Pool(1)
+        [mb, t] = pool.apply(derep_external, [(fn, os.path.join(tmp, name.replace(' ', '_')), None, False, prefix_derep)])
+        pool.close()
+        pool.join()
+        [sizes, counts] = read_derep_output(os.path.join(tmp, name.replace(' ', '_')))
+        print '%-32s %8.1f MB %8.2f s %10d sequences of size 10+ (%d reads)' %(name, mb, t, len(sizes), sum(sizes.values()))
+    y = naive_fold_prefixes(x)
+    print '%d unique sequences, %d after prefix dereplication' %(len(x), len(y))
+    if counts != dict([(seq, row) for seq, row in y.iteritems() if sum(row.values()) >= 10]):
+        util.error('Error: prefix dereplication differs from the naive fold')
+
+
+def random_seqs(n, L):
+    # n random sequences of length L (numpy)
+    x = np.random.randint(0, 4, size=(n, L)).astype(np.uint8)
+    buf = np.array([ord(b) for b in 'ACGT'], dtype=np.uint8)[x].tostring()
+    return [buf[i*L:(i+1)*L] for i in xrange(n)]
+
+
+def legacy_seqdb_add(seqs):
+    # SeqDB.add_seq on a bidict otu <-> seq and a {otu: size} dict, with the next OTU id from max(db) + 1
+    import bidict
+    db = bidict.bidict({})
+    size = {}
+    for seq in seqs:
+        if seq not in ~db:
+            if len(db) == 0:
+                otu = 1
+            else:
+                otu = max(db) + 1
+            db[otu] = seq
+            size[otu] = 1
+        else:
+            size[db[:seq]] += 1
+    return db
+
+
+def seqdb_insert((n, L, seed)):
+    # Peak memory (MB) and time of n seqdb.SeqDB.add_seq calls with random sequences, measured in a fresh pool worker
+    import resource
+    np.random.seed(seed)
+    rss0 = rss()
+    db = seqdb.SeqDB(fn='')
+    t = 0
+    for i in xrange(0, n, 100000):
+        seqs = random_seqs(min(100000, n - i), L)
+        t0 = time.time()
+        for seq in seqs:
+            db.add_seq(seq)
+        t += time.time() - t0
+    # check the index on the last batch
+    if [db.get_otu(seq) for seq in seqs] != range(n - len(seqs) + 1, n + 1) or db.db.next_otu != n + 1:
+        util.error('Error: wrong OTU ids')
+    return [resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0 - rss0, t]
+
+
+def bench_seqdb(args, tmp):
+    # Insert args.n random sequences of length args.L into a seqdb.SeqDB (O(1) OTU ids, sequence arena, size array)
+    # The bidict SeqDB (O(n) per insert) is timed on the first 20000 sequences only
+    np.random.seed(args.seed)
+    seqs = random_seqs(min(args.n, 20000), args.L)
+    t_legacy = timeit('legacy SeqDB (bidict, max + 1)', len(seqs), lambda: legacy_seqdb_add(seqs), repeat=1)
+    db = seqdb.SeqDB(fn='')
+    t = timeit('SeqDB', len(seqs), lambda: [db.add_seq(seq) for seq in seqs], repeat=1)
+    print '%d sequences: %.1fx faster' %(len(seqs), t_legacy/t)
+    pool = mp.Pool(1)
+    [mb, t] = pool.apply(seqdb_insert, [(args.n, args.L, args.seed)])
+    pool.close()
+    pool.join()
+    report('SeqDB', args.n, t)
+    print '%d sequences of length %d: %.1f MB (%.0f bytes per sequence)' %(args.n, args.L, mb, mb*2**20/args.n)
+
+
+TESTS = {'barcodes': bench_barcodes,
+         'chunk': bench_chunk,
+         'derep': bench_derep,
+         'derep_external': bench_derep_external,
+         'derep_memory': bench_derep_memory,
+         'derep_prefilter': bench_derep_prefilter,
+         'derep_prefix': bench_derep_prefix,
+         'fasta': bench_fasta,
+         'fastq': bench_fastq,
+         'pipeline': bench_pipeline,
+         'primers': bench_primers,
+         'renumber': bench_renumber,
+         'seqdb': bench_seqdb,
+         'stages': bench_stages,
+         }
+
+
+def run():
+    args = parse_args()
+    random.seed(args.seed)
+    tmp = tempfile.mkdtemp(dir=args.tmp)
+    try:
+        TESTS[args.test](args, tmp)
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    run()
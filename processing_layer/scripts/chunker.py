@@ -0,0 +1,160 @@
+"""
+
+OVERVIEW:
+
+Module to split raw FASTA/FASTQ files into chunks for the parallel processing steps in raw2otu.py.
+Plain files are not copied: they are split into record-aligned byte ranges [start, end), which the workers read in place
+(util.open_range).  The number of ranges follows the file size and the number of CPUs (see chunk_size).
+Compressed input (gzip, BGZF, zstd) is read directly, without decompressing the raw file to disk first.
+BGZF files are split into record-aligned ranges of their uncompressed bytes in the same way: every worker decompresses its
+own range, starting from the block that holds it (util.open_bgzf).  gzip and zstd streams can only be decompressed
+sequentially, into chunk files (iter_split_file).
+
+"""
+
+import itertools, math, os
+import util
+
+CHUNKS_PER_CPU = 4 # chunks per CPU, so that the workers stay busy when chunks take unequal time
+MIN_CHUNK_SIZE = 1e6 # smallest chunk (bytes)
+MAX_CHUNK_SIZE = 1e8 # largest chunk (bytes), bounds the memory used per worker
+
+
+def iter_lines(fid):
+    # generator that iterates through the raw lines (newlines not stripped) of an open file
+    while True:
+        lines = fid.readlines(util.BLOCK_SIZE)
+        if not lines:
+            break
+        for line in lines:
+            yield line
+
+
+def iter_range(fid, start=0, end=None, fmt='fastq'):
+    # generator that iterates through raw records (lists of lines) in a FASTA/FASTQ stream
+    # fid must be positioned at (uncompressed) offset start
+    # yields the records starting at offsets s with start <= s-1 < end (s = 0 for the first record),
+    # so consecutive ranges [a,b), [b,c), ... split a file into disjoint sets of complete records
+    lines = iter_lines(fid)
+    pos = start
+    if start > 0:
+        # skip the (partial) line at the start of the range
+        pos += len(next(lines, ''))
+    if fmt == 'fastq':
+        # skip to the first record header: an '@' line followed by a sequence and a '+' line
+        record = list(itertools.islice(lines, 4))
+        while len(record) == 4 and not (record[0][:1] == '@' and record[2][:1] == '+'):
+            pos += len(record.pop(0))
+            record.extend(itertools.islice(lines, 1))
+        if len(record) < 4:
+            return
+        for record in itertools.chain([record], itertools.izip(lines, lines, lines, lines)):
+            if end is not None and pos > end:
+                break
+            yield list(record)
+            pos += len(record[0]) + len(record[1]) + len(record[2]) + len(record[3])
+    elif fmt == 'fasta':
+        # skip to the first header line (earlier lines belong to the previous range)
+        record = []
+        for line in lines:
+            if line[:1] == '>':
+                if record:
+                    yield record
+                if end is not None and pos > end:
+                    return
+                record = [line]
+            elif record:
+                record.append(line)
+            pos += len(line)
+        if record:
+            yield record
+    else:
+        util.error('Error: unrecognized format "%s"' %(fmt))
+
+
+def iter_split_file(fn, fmt='fastq', n_records=25000, prefix='x'):
+    # generator that splits a plain or compressed FASTA/FASTQ file into chunk files of n_records records
+    # yields the filename of every chunk as soon as it is complete
+    filename = None
+    out = None
+    fid = util.open_file(fn)
+    for i, record in enumerate(iter_range(fid, fmt=fmt)):
+        if i % n_records == 0:
+            if out is not None:
+                out.close()
+                yield filename
+            filename = '%s%05d' %(prefix, i/n_records)
+            out = open(filename, 'w')
+        out.writelines(record)
+    if out is not None:
+        out.close()
+        yield filename
+    fid.close()
+
+
+def split_file(fn, fmt='fastq', n_records=25000, prefix='x'):
+    # Split a plain or compressed FASTA/FASTQ file into chunk files of n_records records
+    # Returns the list of chunk filenames
+    return list(iter_split_file(fn, fmt=fmt, n_records=n_records, prefix=prefix))
+
+
+def chunk_size(file_size, n_cpus, chunks_per_cpu=CHUNKS_PER_CPU, min_size=MIN_CHUNK_SIZE, max_size=MAX_CHUNK_SIZE):
+    # Chunk size (bytes) giving about chunks_per_cpu chunks per CPU, within [min_size, max_size]
+    size = float(file_size)/max(n_cpus*chunks_per_cpu, 1)
+    return int(min(max(size, min_size), max_size))
+
+
+def next_record(fid, offset, fmt='fastq', size=None):
+    # Offset of the first record starting at or after offset in an open FASTA/FASTQ file (same rules as iter_range)
+    # fid is a plain file, or a stream positioned at offset - 1 (e.g. util.open_bgzf) if size (the file size) is given
+    # Returns the file size if there is none
+    if offset == 0:
+        return 0
+    if size is None:
+        size = os.fstat(fid.fileno()).st_size
+        fid.seek(offset - 1)
+    # skip to the first line starting at or after offset
+    pos = offset - 1 + len(fid.readline())
+    if fmt == 'fastq':
+        # first record header: an '@' line followed by a sequence and a '+' line
+        record = [fid.readline() for i in range(4)]
+        while record[3] and not (record[0][:1] == '@' and record[2][:1] == '+'):
+            pos += len(record.pop(0))
+            record.append(fid.readline())
+        if not record[3]:
+            return size
+        return pos
+    elif fmt == 'fasta':
+        for line in iter_lines(fid):
+            if line[:1] == '>':
+                return pos
+            pos += len(line)
+        return pos
+    else:
+        util.error('Error: unrecognized format "%s"' %(fmt))
+
+
+def record_ranges(fn, fmt='fastq', chunk_size=MAX_CHUNK_SIZE):
+    # Split a plain or BGZF FASTA/FASTQ file into byte ranges of about chunk_size (uncompressed) bytes that start and end on
+    # record boundaries
+    # Returns a list of [start, end]; the ranges are read with util.open_range (e.g. util.iter_fsq_batches(fn, start=start, end=end))
+    compression = util.get_compression(fn)
+    if compression == 'bgzf':
+        size = sum([block_size for [offset, block_size] in util.bgzf_blocks(fn)])
+    elif compression == '':
+        size = os.path.getsize(fn)
+    else:
+        util.error('Error: cannot split %s file %s into byte ranges' %(compression, fn))
+    n = max(int(math.ceil(size/float(chunk_size))), 1)
+    if compression == 'bgzf':
+        starts = [0]
+        for i in range(1, n):
+            fid = util.open_bgzf(fn, int(i*chunk_size) - 1)
+            starts.append(next_record(fid, int(i*chunk_size), fmt, size=size))
+            fid.close()
+        starts = sorted(set(starts))
+    else:
+        fid = open(fn, 'rb')
+        starts = sorted(set([next_record(fid, int(i*chunk_size), fmt) for i in range(n)]))
+        fid.close()
+    return [[start, end] for [start, end] in zip(starts, starts[1:] + [size]) if start < end]
@@ -0,0 +1,428 @@
+"""
+
+OVERVIEW:
+
+Compact store for dereplication (3.dereplicate.py), replacing the {seq: {sample: count}} dict of dicts.
+
+Sequences are kept once in one byte arena (NumPy array), 2-bit packed (4 bases per byte) when they only contain ACGT and
+as plain bytes otherwise, and indexed by their 64-bit hash (hash(seq)) in an open addressing table of sequence numbers
+(HashTable, NumPy arrays, no Python object per sequence).  A hit is checked against the arena, and the rare sequences whose
+hash is already taken by a different sequence are indexed by the sequence itself instead.  Reads are added and sequences
+unpacked in batches, so that hashing, packing and counting are done with NumPy.  Sample names are interned to small
+integers.  Every sequence has its hash, arena offset, length, first sample and count in flat arrays, and the counts of its
+other samples are cells of one flat array (keyed by sequence and sample number in a second HashTable), numbered in order
+of first occurrence.
+
+iteritems() yields the same (seq, {sample: count}) items, in the same order, as the dict of dicts built from the same
+reads: the iteration order of a Python 2 dict only depends on the hashes of its keys and the order they were inserted in,
+so a {hash: None} dict filled in sequence order iterates in the order of the {seq: ...} dict, and every {sample: count}
+dict is rebuilt with its samples in order of first occurrence.  The OTU database and mapping file written from it (see
+stages.write_dereplicated) are unchanged.
+
+"""
+
+import itertools
+import numpy as np
+import readbatch, util
+
+BATCH_SIZE = 2000 # reads added, or sequences unpacked, at once
+MAX_SAMPLES = 1 << 24 # cells are keyed by sequence number*MAX_SAMPLES + sample number
+
+# Approximate memory (bytes) per sequence (arrays and hash table), per cell (sample of a sequence besides its first one),
+# and per unpacked sequence (str object, besides its bases), for DerepStore.memory
+SEQ_BYTES = 50
+CELL_BYTES = 40
+STR_BYTES = 80
+
+# 2-bit code of every base (4 for the other characters, 0 for the padding of encode_seqs) and base of every code
+CODES = np.zeros(256, dtype=np.uint8) + 4
+CODES[0] = 0
+for i, b in enumerate('ACGT'):
+    CODES[ord(b)] = i
+BASES = np.array([ord(b) for b in 'ACGT'], dtype=np.uint8)
+
+MIX = np.uint64(0x9E3779B97F4A7C15) # multiplier of the Fibonacci hashing of HashTable keys into slots
+
+
+def pack(seqs):
+    # 2-bit pack a list of sequences
+    # Returns [packed bases, bases, lengths, packable]: n x ceil(L/4) and n x L uint8 matrices (encode_seqs), the length of
+    # every sequence and whether it only contains ACGT
+    [x, lengths] = readbatch.encode_seqs(seqs)
+    [n, L] = x.shape
+    W = (L + 3) // 4
+    codes = np.zeros((n, 4*W), dtype=np.uint8)
+    codes[:, :L] = CODES[x]
+    packable = (codes < 4).all(axis=1)
+    codes &= 3
+    P = (codes[:, 0::4] << 6) | (codes[:, 1::4] << 4) | (codes[:, 2::4] << 2) | codes[:, 3::4]
+    return [P, x, lengths, packable]
+
+
+def arena_bytes(P, x, packable):
+    # Arena bytes of every read (rows of pack): packed bases if it only contains ACGT, else its bases (padded with 0)
+    if packable.all():
+        return P
+    if packable.any():
+        x = x.copy()
+        x[packable, :P.shape[1]] = P[packable]
+    return x
+
+
+def sizes(lengths):
+    # Arena bytes of sequences of lengths (negative if not packed)
+    return np.where(lengths >= 0, (lengths + 3) // 4, -lengths)
+
+
+def grow(a, n):
+    # a, or a copy of a with room for n items (the number of items used is kept by the caller)
+    if n <= len(a):
+        return a
+    b = np.zeros(max(n, len(a) + len(a) // 4, 1024), dtype=a.dtype)
+    b[:len(a)] = a
+    return b
+
+
+def ranges(starts, counts):
+    # Concatenation of the ranges starts[k]..starts[k]+counts[k]-1
+    ends = np.cumsum(counts)
+    return np.arange(ends[-1] if len(ends) else 0) + np.repeat(starts - ends + counts, counts)
+
+
+class HashTable():
+    # Open addressing (linear probing) table of entry numbers, looked up by the int64 key of every entry (keys[entry])
+    # Entries are never removed, and the table is kept at most half full
+
+    def __init__(self, size=1024):
+        self.slots = np.zeros(size, dtype=np.int32) - 1
+        self.n = 0
+
+
+    def home(self, q):
+        # First slot of every key (Fibonacci hashing: high bits of q*MIX)
+        bits = len(self.slots).bit_length() - 1
+        return ((q.view(np.uint64) * MIX) >> np.uint64(64 - bits)).astype(np.int64)
+
+
+    def lookup(self, keys, q):
+        # Entry of every key of q (-1 if absent)
+        found = np.zeros(len(q), dtype=np.int64) - 1
+        if self.n == 0:
+            return found
+        mask = len(self.slots) - 1
+        rows = np.arange(len(q))
+        slot = self.home(q)
+        while len(rows) > 0:
+            e = self.slots[slot]
+            used = e >= 0
+            hit = used & (keys[e] == q[rows])
+            found[rows[hit]] = e[hit]
+            more = used & ~hit
+            rows = rows[more]
+            slot = (slot[more] + 1) & mask
+        return found
+
+
+    def insert(self, keys, entries):
+        # Add entries (with distinct keys, absent from the table)
+        size = len(self.slots)
+        while 2*(self.n + len(entries)) > size:
+            size *= 2
+        if size > len(self.slots):
+            old = self.slots[self.slots >= 0]
+            self.slots = np.zeros(size, dtype=np.int32) - 1
+            self.place(keys, old)
+        self.place(keys, entries)
+        self.n += len(entries)
+
+
+    def place(self, keys, entries):
+        # Put every entry in the first free slot from its home slot (one entry per slot at a time)
+        mask = len(self.slots) - 1
+        slot = self.home(keys[entries])
+        while len(entries) > 0:
+            free = np.flatnonzero(self.slots[slot] < 0)
+            [u, first] = np.unique(slot[free], return_index=True)
+            won = free[first]
+            self.slots[slot[won]] = entries[won]
+            keep = np.ones(len(entries), dtype=bool)
+            keep[won] = False
+            entries = entries[keep]
+            slot = (slot[keep] + 1) & mask
+
+
+class DerepStore():
+
+    def __init__(self):
+        self.n = 0 # number of sequences
+        self.index = HashTable() # hash(seq) -> sequence number
+        self.collisions = {} # seq -> sequence number, for the sequences whose hash is already used by another sequence
+        self.hashes = np.zeros(0, dtype=np.int64) # sequence number -> hash(seq)
+        self.arena = np.zeros(1024, dtype=np.uint8) # all the packed sequences
+        self.arena_size = 0
+        self.offsets = np.zeros(0, dtype=np.int64) # sequence number -> offset in the arena
+        self.lengths = np.zeros(0, dtype=np.int32) # sequence number -> length (negative if not packed)
+        self.first = np.zeros(0, dtype=np.int32) # sequence number -> first sample
+        self.first_count = np.zeros(0, dtype=np.int64) # sequence number -> count in the first sample
+        self.samples = [] # sample number -> sample name
+        self.sample_ids = {} # sample name -> sample number
+        self.n_cells = 0 # number of cells (samples of a sequence besides its first one)
+        self.cells = HashTable() # sequence number*MAX_SAMPLES + sample number -> cell number
+        self.cell_keys = np.zeros(0, dtype=np.int64) # cell number -> sequence number*MAX_SAMPLES + sample number
+        self.cell_counts = np.zeros(0, dtype=np.int64) # cell number -> count
+        self.rows = None # [sequence numbers, cell numbers] of the cells sorted by sequence (get_rows, rebuilt after adding reads)
+        self.total_length = 0 # total length of the sequences
+
+
+    def __len__(self):
+        return self.n
+
+
+    def sample_id(self, sa):
+        # Intern a sample name
+        if sa not in self.sample_ids:
+            if len(self.samples) >= MAX_SAMPLES:
+                util.error('Error: more than %d samples' %(MAX_SAMPLES))
+            self.sample_ids[sa] = len(self.samples)
+            self.samples.append(sa)
+        return self.sample_ids[sa]
+
+
+    def append(self, h, P, x, lengths, packable, s):
+        # Store new sequences (rows of pack) with hashes h, first found in samples s; returns their sequence numbers
+        # The sequences are not indexed
+        k = len(h)
+        i = np.arange(self.n, self.n + k)
+        L = np.where(packable, lengths, -lengths)
+        size = sizes(L)
+        x = arena_bytes(P, x, packable)
+        data = x[np.arange(x.shape[1])[np.newaxis, :] < size[:, np.newaxis]]
+        self.arena = grow(self.arena, self.arena_size + len(data))
+        self.arena[self.arena_size:self.arena_size + len(data)] = data
+        self.hashes = grow(self.hashes, self.n + k)
+        self.offsets = grow(self.offsets, self.n + k)
+        self.lengths = grow(self.lengths, self.n + k)
+        self.first = grow(self.first, self.n + k)
+        self.first_count = grow(self.first_count, self.n + k)
+        self.hashes[i] = h
+        self.offsets[i] = self.arena_size + np.cumsum(size) - size
+        self.lengths[i] = L
+        self.first[i] = s
+        self.first_count[i] = 0
+        self.arena_size += len(data)
+        self.total_length += int(lengths.sum())
+        self.n += k
+        return i
+
+
+    def same_stored(self, i, P, x, lengths, packable):
+        # Whether every read (rows of pack) is the stored sequence i
+        L = np.where(packable, lengths, -lengths)
+        same = self.lengths[i] == L
+        rows = np.flatnonzero(same)
+        if len(rows) == 0:
+            return same
+        read = arena_bytes(P[rows], x[rows], packable[rows])
+        cols = np.arange(read.shape[1])
+        stored = self.arena[np.minimum(self.offsets[i[rows]][:, np.newaxis] + cols, len(self.arena) - 1)]
+        same[rows] = ((stored == read) | (cols >= sizes(L[rows])[:, np.newaxis])).all(axis=1)
+        return same
+
+
+    def add_reads(self, seqs, s, counts):
+        # Add reads (at most BATCH_SIZE), up to the first one whose hash is taken by a different sequence
+        # s: sample numbers; returns the number of reads added
+        n = len(seqs)
+        h = np.array(map(hash, seqs), dtype=np.int64)
+        [P, x, lengths, packable] = pack(seqs)
+        ids = self.index.lookup(self.hashes, h)
+
+        # Reads of a stored sequence: check the sequence
+        found = np.flatnonzero(ids >= 0)
+        bad = found[~self.same_stored(ids[found], P[found], x[found], lengths[found], packable[found])]
+
+        # Reads of new sequences: the first read of every hash is stored, the others must be the same
+        new = np.flatnonzero(ids < 0)
+        [u, first, inverse] = np.unique(h[new], return_index=True, return_inverse=True) if len(new) > 0 else [new, new, new]
+        ref = new[first][inverse]
+        dup = np.flatnonzero(ref != new)
+        [r, q] = [new[dup], ref[dup]]
+        same = (lengths[r] == lengths[q]) & (P[r] == P[q]).all(axis=1) & (packable[r] | (x[r] == x[q]).all(axis=1))
+        bad = np.concatenate([bad, r[~same]])
+        if len(bad) > 0:
+            k = int(bad.min())
+            if k > 0:
+                self.add_reads(seqs[:k], s[:k], counts[:k])
+            return k
+
+        # New sequences are numbered in order of first read
+        if len(new) > 0:
+            first = np.sort(new[first])
+            i = self.append(h[first], P[first], x[first], lengths[first], packable[first], s[first])
+            self.index.insert(self.hashes, i)
+            ids[new] = i[np.searchsorted(first, ref)]
+        self.add_counts(ids, s, counts)
+        return n
+
+
+    def add_collision(self, seq, s, count):
+        # Add a read whose hash is taken by a different sequence (indexed by the sequence itself)
+        i = self.collisions.get(seq)
+        if i is None:
+            [P, x, lengths, packable] = pack([seq])
+            i = self.collisions[seq] = self.append(np.array([hash(seq)]), P, x, lengths, packable, np.array([s]))[0]
+        self.add_counts(np.array([i]), np.array([s]), np.array([count]))
+
+
+    def add_counts(self, ids, s, counts):
+        # Add counts[k] reads of sample s[k] to sequence ids[k]
+        self.rows = None
+        f = self.first[ids] == s
+        if f.any():
+            [u, inverse] = np.unique(ids[f], return_inverse=True)
+            self.first_count[u] += np.bincount(inverse, weights=counts[f]).astype(np.int64)
+        if f.all():
+            return
+        keys = ids[~f]*MAX_SAMPLES + s[~f]
+        counts = counts[~f]
+        cells = self.cells.lookup(self.cell_keys, keys)
+
+        # New cells are numbered in order of first read
+        new = np.flatnonzero(cells < 0)
+        if len(new) > 0:
+            [u, first, inverse] = np.unique(keys[new], return_index=True, return_inverse=True)
+            order = np.argsort(first)
+            rank = np.empty(len(u), dtype=np.int64)
+            rank[order] = np.arange(len(u))
+            c = np.arange(self.n_cells, self.n_cells + len(u))
+            self.cell_keys = grow(self.cell_keys, self.n_cells + len(u))
+            self.cell_counts = grow(self.cell_counts, self.n_cells + len(u))
+            self.cell_keys[c] = u[order]
+            self.cell_counts[c] = 0
+            self.n_cells += len(u)
+            self.cells.insert(self.cell_keys, c)
+            cells[new] = c[rank[inverse]]
+        [u, inverse] = np.unique(cells, return_inverse=True)
+        self.cell_counts[u] += np.bincount(inverse, weights=counts).astype(np.int64)
+
+
+    def add_batch(self, seqs, samples, counts=None):
+        # Add the reads seqs[k] from samples samples[k] (counts[k] reads each, or 1)
+        n = len(seqs)
+        s = map(self.sample_ids.get, samples)
+        if None in s:
+            s = [self.sample_id(sa) for sa in samples]
+        s = np.array(s, dtype=np.int64)
+        if counts is None:
+            counts = np.ones(n, dtype=np.int64)
+        counts = np.array(counts, dtype=np.int64)
+        start = 0
+        while start < n:
+            end = min(start + BATCH_SIZE, n)
+            k = self.add_reads(seqs[start:end], s[start:end], counts[start:end])
+            if start + k < end:
+                self.add_collision(seqs[start + k], s[start + k], counts[start + k])
+                k += 1
+            start += k
+
+
+    def add(self, seq, sa, count=1):
+        # Add count reads of seq from sample sa (use add_batch for many reads)
+        self.add_batch([seq], [sa], [count])
+
+
+    def get_seqs(self, ids):
+        # Unpack the sequences ids
+        ids = np.array(ids, dtype=np.int64)
+        if len(ids) == 0:
+            return []
+        L = self.lengths[ids]
+        W = int(sizes(L).max())
+        B = self.arena[np.minimum(self.offsets[ids][:, np.newaxis] + np.arange(W), len(self.arena) - 1)]
+        codes = np.empty((len(ids), W, 4), dtype=np.uint8)
+        codes[:, :, 0] = B >> 6
+        codes[:, :, 1] = (B >> 4) & 3
+        codes[:, :, 2] = (B >> 2) & 3
+        codes[:, :, 3] = B & 3
+        bases = BASES[codes].tostring()
+        raw = B.tostring()
+        return [bases[4*W*k:4*W*k + l] if l >= 0 else raw[W*k:W*k - l] for k, l in enumerate(L.tolist())]
+
+
+    def get_seq(self, i):
+        return self.get_seqs([i])[0]
+
+
+    def get_rows(self, ids):
+        # [[sample, count], ...] of every sequence of ids, in order of first occurrence
+        if self.rows is None:
+            c = np.argsort(self.cell_keys[:self.n_cells] // MAX_SAMPLES, kind='mergesort')
+            self.rows = [self.cell_keys[c] // MAX_SAMPLES, c]
+        [seq, c] = self.rows
+        ids = np.array(ids, dtype=np.int64)
+        start = np.searchsorted(seq, ids)
+        n = np.searchsorted(seq, ids, side='right') - start
+        c = c[ranges(start, n)]
+        samples = self.samples
+        cells = zip([samples[s] for s in (self.cell_keys[c] % MAX_SAMPLES).tolist()], self.cell_counts[c].tolist())
+        rows = []
+        k = 0
+        for s, count, m in itertools.izip(self.first[ids].tolist(), self.first_count[ids].tolist(), n.tolist()):
+            rows.append([[samples[s], count]] + [list(cell) for cell in cells[k:k + m]])
+            k += m
+        return rows
+
+
+    def get_row(self, i):
+        return self.get_rows([i])[0]
+
+
+    def get_counts(self, i):
+        # {sample: count} dict of sequence i, with the samples inserted in order of first occurrence
+        return dict(self.get_row(i))
+
+
+    def size(self, i):
+        # Total count of sequence i
+        return sum([count for sa, count in self.get_row(i)])
+
+
+    def memory(self, unpacked=False):
+        # Approximate memory used by the store (bytes)
+        # unpacked: also count all the sequences unpacked as strings (as when sorting them)
+        m = self.arena_size + SEQ_BYTES*len(self) + CELL_BYTES*self.n_cells
+        if unpacked:
+            m += self.total_length + STR_BYTES*len(self)
+        return m
+
+
+    def order(self):
+        # Sequence numbers in the iteration order of the {seq: ...} dict
+        if not self.collisions:
+            # a {hash: None} dict filled in sequence order (as the {seq: ...} dict), read back as hashes
+            hashes = (h for i in xrange(0, self.n, BATCH_SIZE) for h in self.hashes[i:min(i + BATCH_SIZE, self.n)].tolist())
+            x = dict.fromkeys(hashes)
+            hashes = np.fromiter(x.iterkeys(), dtype=np.int64, count=len(x))
+            x = None
+            return self.index.lookup(self.hashes, hashes)
+        # two sequences share a hash: rebuild the dict on the sequences themselves
+        x = {}
+        for i in xrange(0, len(self), BATCH_SIZE):
+            ids = range(i, min(i + BATCH_SIZE, len(self)))
+            for j, seq in zip(ids, self.get_seqs(ids)):
+                x[seq] = j
+        return np.fromiter(x.itervalues(), dtype=np.int64, count=len(x))
+
+
+    def iteritems(self):
+        # Yields (seq, {sample: count}) as dict.iteritems on the dict of dicts
+        order = self.order()
+        for k in xrange(0, len(order), BATCH_SIZE):
+            ids = order[k:k + BATCH_SIZE]
+            for seq, row in zip(self.get_seqs(ids), self.get_rows(ids)):
+                yield seq, dict(row)
+
+
+    def __iter__(self):
+        for seq, counts in self.iteritems():
+            yield seq
@@ -0,0 +1,84 @@
+"""
+
+OVERVIEW:
+
+Chunk-level pipeline scheduler for the parallel steps of raw2otu.py.
+
+Every chunk goes through a list of stages (e.g. decompress -> process).  All tasks run on one long-lived
+multiprocessing.Pool, and a chunk is submitted to its next stage as soon as its current stage finishes, so there is no
+barrier between stages (as with one pool.map per stage) and the workers are forked only once.  New chunks can be added
+while earlier ones are running (e.g. chunk files written by a sequential decompressor).
+
+A stage is [name, f, make_args]: f is a module-level function taking a single tuple argument (as for pool.map), and
+make_args(i, x) builds that tuple for chunk i from x, the chunk itself for the first stage or the result of the previous
+stage of the chunk otherwise.  Progress is printed per stage as the tasks finish.
+
+"""
+
+import Queue, sys, time, traceback
+import util
+
+
+def run_task((f, args)):
+    # Run f(args) in a pool worker; returns [True, result], or [False, traceback] if f raises
+    try:
+        return [True, f(args)]
+    except BaseException:
+        return [False, traceback.format_exc()]
+
+
+def report(name, n_done, n_submitted, n_total, t0):
+    # Print the progress of a stage
+    total = '%d' %(n_total) if n_total is not None else '%d+' %(n_submitted)
+    print '[[ Pipeline ]] %s: %d of %s chunks done (%.1f s)' %(name, n_done, total, time.time() - t0)
+    sys.stdout.flush()
+
+
+def run_stages(pool, chunks, stages, verbose=True):
+    # Run every chunk in chunks (an iterable, read as the pipeline runs) through stages on pool
+    # Returns one list of stage results per chunk, in chunk order
+    t0 = time.time()
+    done = Queue.Queue() # [chunk, stage, [ok, result]] of the finished tasks, filled by the pool result thread
+    results = []
+    n_done = [0]*len(stages)
+    n_submitted = [0]*len(stages)
+    n_total = None # number of chunks, known once chunks is exhausted
+
+    def submit(i, k, x):
+        # Submit stage k of chunk i on input x
+        [name, f, make_args] = stages[k]
+        n_submitted[k] += 1
+        pool.apply_async(run_task, [(f, make_args(i, x))], callback=lambda r: done.put([i, k, r]))
+
+    def finish(i, k, r):
+        # Record a finished task and submit the next stage of its chunk
+        [ok, x] = r
+        if not ok:
+            pool.terminate()
+            util.error('Error: stage %s failed on chunk %d:\n%s' %(stages[k][0], i, x))
+        results[i].append(x)
+        n_done[k] += 1
+        if verbose:
+            report(stages[k][0], n_done[k], n_submitted[k], n_total, t0)
+        if k + 1 < len(stages):
+            submit(i, k + 1, x)
+
+    # Submit the chunks as they come, handling the tasks finished in the meantime
+    for i, chunk in enumerate(chunks):
+        results.append([])
+        submit(i, 0, chunk)
+        while True:
+            try:
+                finish(*done.get_nowait())
+            except Queue.Empty:
+                break
+    n_total = len(results)
+
+    # Wait for the remaining tasks
+    while n_done[-1] < n_total:
+        # (a timeout keeps the wait interruptible with Ctrl-C)
+        try:
+            finish(*done.get(timeout=60))
+        except Queue.Empty:
+            continue
+    return results
@@ -16,107 +16,292 @@ import numpy as np
 import sys
 import os, sys
 import util
+import readbatch
+import qcprofile
+import stages
 import Formatting
 
+MAXEE = 0.25 # maximum expected errors of the reads kept by length trimming (FASTQ)
+
 def length_stats_fastq(fastq_in):
-    # Returns full sequence length, and  5th percentile of read length for a 100000 sample from a FASTQ file.
-    iter_seq = util.iter_fsq
-    x = []
-    counter = 0
-    for record in iter_seq(fastq_in):
-        sid, seq = record[:2]
-        counter = counter + 1
-        if(counter > 100000):
-            break
-        x.append(len(seq))
-    x = np.array(x)
-    return [np.amax(x), np.percentile(x,5)]
-
-def trim_quality((fastq_in, fastq_out, ascii_encoding)):
+    # Returns full sequence length, and 5th percentile of read length over all reads of a FASTQ file.
+    # Streams the file through a QCProfile, so memory use does not depend on the number of reads.
+    profile = qcprofile.profile_file(fastq_in, fmt='fastq')
+    return profile.length_stats()
+
+def trim_quality((fastq_in, fastq_out, ascii_encoding, Q)):
     # Finds maximum Q-score cut-off where 95% of reads are over 200 bases, if possible.  If not, selects Q=5 and returns a warning.
-    Qvals = range(5,11)
-    bestQ = 0
-
-    for Q in Qvals:
-        # Trim to Q
-        print "[[ Quality trimming ]] Quality trimming with Q=" + str(Q)        
-        str1 = '/home/ubuntu/bin/usearch8 -fastq_filter ' + fastq_in + ' -fastq_truncqual ' + str(Q) + ' -fastq_ascii ' + str(ascii_encoding) + ' -fastqout ' + fastq_out
-        os.system(str1)
-        # Check length distribution
-        try:
-            [full_length, fifthPercentile] = length_stats_fastq(fastq_out)
-            print "[[ Quality trimming ]] 5th percentile length: " + str(fifthPercentile)
-            if(fifthPercentile >= 0.8*float(full_length)):
-                bestQ = Q
-                bestFifthPercentile = fifthPercentile
-            else:
-                continue
-        except:
-            continue
+    # If Q > 0, the search is skipped and reads are trimmed at the given (dataset-wide) cut-off, see choose_quality_cutoff.
+    # Quality scores are decoded once into a QCProfile of the chunk, which holds the truncated length distribution for every Q
+    # (rule of usearch8 -fastq_truncqual: truncate at the first position with quality <= Q, discard empty reads).  The output is
+    # written once, batch by batch as the reads are read when Q > 0 (only the search needs all the reads of the chunk first).
+    # Returns the QCProfile of the input reads, so that raw2otu.py can merge the profiles of all chunks.
+    profile = qcprofile.QCProfile()
+    Qvals = profile.truncq_vals
+    if Q > 0 and Q not in Qvals:
+        Qvals = Qvals + [Q]
+        profile = qcprofile.QCProfile(truncq_vals=Qvals)
+
+    if Q > 0:
+        with open(fastq_out, 'w') as out:
+            for batch in readbatch.iter_batches(fastq_in, fmt='fastq', ascii_encoding=ascii_encoding):
+                lengths = batch.truncqual_lengths(Qvals)
+                profile.add_batch(batch, truncqual_lengths=lengths)
+                L = lengths[:,Qvals.index(Q)]
+                batch.truncate(L).subset(L > 0).write(out)
+        bestQ = Q
+        stats = profile.truncqual_stats(Q)
+        bestFifthPercentile = stats[1] if stats is not None else 0
+        print "[[ Quality trimming ]] Using dataset-wide quality cut-off Q=" + str(Q)
+    else:
+        batches = []
+        lengths = []
+        for batch in readbatch.iter_batches(fastq_in, fmt='fastq', ascii_encoding=ascii_encoding):
+            batches.append(batch)
+            lengths.append(batch.truncqual_lengths(Qvals))
+            profile.add_batch(batch, truncqual_lengths=lengths[-1])
+        if len(lengths) > 0:
+            lengths = np.concatenate(lengths)
+        else:
+            lengths = np.zeros((0, len(Qvals)), dtype=int)
+        for Qval in Qvals:
+            stats = profile.truncqual_stats(Qval)
+            if stats is not None:
+                print "[[ Quality trimming ]] Q=" + str(Qval) + ", 5th percentile length: " + str(stats[1])
+        [bestQ, bestFifthPercentile] = profile.best_truncqual(0.8)
     if (bestQ == 0):
         print "[[ Quality trimming ]] ERROR!!  Could not obtain 95% of reads over 200 base pairs with quality score cut-off of at least 5.  Check sequencing quality of the data.  Proceeding with Q=5..."
-        str1 = '/home/ubuntu/bin/usearch8 -fastq_filter ' + fastq_in + ' -fastq_truncqual ' + str(5) + ' -fastq_ascii ' + str(ascii_encoding) + ' -fastqout ' + fastq_out
-        os.system(str1)
-        [new_full_length, fifthPercentile] = length_stats_fastq(fastq_out)
+        write_truncqual(batches, lengths[:,Qvals.index(5)], fastq_out)
+        stats = profile.truncqual_stats(5)
+        fifthPercentile = stats[1] if stats is not None else 0
         print "[[ Quality trimming ]] Input file: " + fastq_in
         print "[[ Quality trimming ]] ASCII encoding used: " + str(ascii_encoding)
         print "[[ Quality trimming ]] Trimmed sequences with quality cut-off of Q = " + str(5) + "."  
         print "[[ Quality trimming ]] 5th percentile of read length: " + str(fifthPercentile) + "."
         print "[[ Quality trimming ]] Trimmed file: " + fastq_out
         print "[[ Quality trimming ]] Complete."
-        return None
+        return profile
            
     else:
-        str1 = '/home/ubuntu/bin/usearch8 -fastq_filter ' + fastq_in + ' -fastq_truncqual ' + str(bestQ) + ' -fastq_ascii ' + str(ascii_encoding) + ' -fastqout ' + fastq_out
-        os.system(str1)
+        if Q <= 0:
+            write_truncqual(batches, lengths[:,Qvals.index(bestQ)], fastq_out)
         print "[[ Quality trimming ]] Input file: " + fastq_in
         print "[[ Quality trimming ]] ASCII encoding used: " + str(ascii_encoding)
         print "[[ Quality trimming ]] Trimmed sequences with quality cut-off of Q = " + str(bestQ) + "."  
         print "[[ Quality trimming ]] 5th percentile of read length: " + str(bestFifthPercentile) + "."
         print "[[ Quality trimming ]] Trimmed file: " + fastq_out
         print "[[ Quality trimming ]] Complete."
-        return None
+        return profile
+
+def choose_quality_cutoff(fastq_in, ascii_encoding, n=100000):
+    # Chooses one Q-score cut-off for a whole dataset from a uniform random sample of n reads, with the rule used in trim_quality.
+    # Returns Q (5 if no cut-off keeps the 5th percentile of read length at 80% of the full length).
+    profile = qcprofile.sample_file(fastq_in, n=n, ascii_encoding=ascii_encoding)
+    [bestQ, fifthPercentile] = profile.best_truncqual(0.8)
+    print "[[ Quality trimming ]] Sampled " + str(profile.n_reads) + " reads from " + fastq_in
+    if bestQ == 0:
+        print "[[ Quality trimming ]] ERROR!!  Could not obtain 95% of reads over 200 base pairs with quality score cut-off of at least 5.  Check sequencing quality of the data.  Proceeding with Q=5..."
+        return 5
+    print "[[ Quality trimming ]] Dataset-wide quality cut-off Q = " + str(bestQ) + ", 5th percentile of read length: " + str(fifthPercentile) + "."
+    return bestQ
+
+def write_truncqual(batches, lengths, fastq_out):
+    # Writes ReadBatches truncated to the given read lengths, discarding empty reads
+    with open(fastq_out, 'w') as out:
+        i = 0
+        for batch in batches:
+            L = lengths[i:i+len(batch)]
+            i += len(batch)
+            batch.truncate(L).subset(L > 0).write(out)
+    return None
 
 def trim_length_fasta((fasta_in, fasta_out, length)):
-    # Trims FASTA files to uniform length
-    str1 = '/home/ubuntu/bin/usearch8 -fastx_truncate ' + fasta_in + ' -trunclen ' + str(length) + ' -fastaout ' + fasta_out
-    os.system(str1)
+    # Trims FASTA files to uniform length (as usearch8 -fastx_truncate -trunclen, reads shorter than length are discarded)
+    [n_in, n_out] = filter_length_ee(fasta_in, fasta_out, 'fasta', length)
+    print "[[ Length trimming ]] Input file: " + fasta_in
+    print "[[ Length trimming ]] Trimmed sequences to length " + str(length) + "."
+    print "[[ Length trimming ]] Kept " + str(n_out) + " of " + str(n_in) + " reads, discarded " + str(n_in - n_out) + "."
+    print "[[ Length trimming ]] Complete."
+    return None
 
 def trim_length_fastq((fastq_in, fastq_out, length, ascii_encoding)):
-    # Trims FASTQ files to usearch -fastq_chars obio.raw.fsq uniform length and filters by maximum expected error
+    # Trims FASTQ files to uniform length and filters by maximum expected error (as usearch8 -fastq_trunclen -fastq_maxee)
     # Takes as input the ascii encoding (33 or 64 currently supported)
-    str1 = '/home/ubuntu/bin/usearch8 -fastq_filter ' + fastq_in + ' -fastq_trunclen ' + str(length) + ' -fastq_maxee 0.25 -fastq_ascii ' + str(ascii_encoding) + ' -fastqout ' + fastq_out
-    os.system(str1)
-    # Check for how many reads were thrown out
-    statinfoIN = os.stat(fastq_in)
-    input_filesize = float(statinfoIN.st_size)
-    statinfoOUT = os.stat(fastq_out)
-    output_filesize = float(statinfoOUT.st_size)
-    percent_thrown_out = 100*(output_filesize / input_filesize)
+    maxee = MAXEE
+    [n_in, n_out] = filter_length_ee(fastq_in, fastq_out, 'fastq', length, maxee=maxee, ascii_encoding=ascii_encoding)
+    percent_thrown_out = 100.*(n_in - n_out)/max(n_in, 1)
     print "[[ Length trimming ]] Input file: " + fastq_in
-    print "[[ Length trimming ]] Trimmed sequences with length less than " + str(length) + " and maximum expected error of 0.25."
+    print "[[ Length trimming ]] Trimmed sequences with length less than " + str(length) + " and maximum expected error of " + str(maxee) + "."
+    print "[[ Length trimming ]] Kept " + str(n_out) + " of " + str(n_in) + " reads, discarded " + str(n_in - n_out) + "."
     print "[[ Length trimming ]] Threw out " + str(percent_thrown_out) + " % of reads."
     print "[[ Length trimming ]] Complete."
     return None
+
+def filter_length_ee(fn_in, fn_out, fmt, length, maxee=None, ascii_encoding=33):
+    # Discards reads shorter than length or with more than maxee expected errors in their first length bases, and truncates
+    # the remaining reads to length.  Expected errors are computed for whole ReadBatches with a quality -> probability lookup table.
+    # Returns [number of input reads, number of output reads]
+    n_in = 0
+    n_out = 0
+    with open(fn_out, 'w') as out:
+        for batch in readbatch.iter_batches(fn_in, fmt=fmt, ascii_encoding=ascii_encoding):
+            if maxee is None:
+                keep = batch.lengths >= length
+            else:
+                keep = batch.filter_length_ee(length, maxee)
+            n_in += len(batch)
+            n_out += int(keep.sum())
+            batch.subset(keep).truncate(length).write(out)
+    return [n_in, n_out]
  
 def remove_primers((fastq_in, fastq_out, primers_file)):
     # Remove primers from FASTQ file
+    # Runs in the calling process; the primer list and matcher are compiled once per pool worker
     print "[[ Primer trimming ]] ..."
-    os.system('python ~/scripts/1.remove_primers.py -q ' + fastq_in + ' -l ' + primers_file + ' -d 1 -o ' + fastq_out)
+    [n_seqs, n_fast, n_keep] = stages.remove_primers(fastq_in, fastq_out, stages.read_primers(primers_file), max_dist=1)
+    print "[[ Primer trimming ]] Removed primers from %d of %d sequences." %(n_keep, n_seqs)
     print "[[ Primer trimming ]] Complete."
     return None
 
 
-def split_by_barcodes((fastq_in, fastq_out, barcodes_map, mode)):
+def split_by_barcodes((fastq_in, fastq_out, barcodes_map, mode, index_file)):
     # Split by barcodes
+    # In mode 3 the barcodes are looked up in index_file, which is read in step with the reads (or only the entries of this chunk are loaded)
+    # Runs in the calling process; the barcode map and index are compiled once per pool worker
     print "[[ Splitting by barcodes ]] ..."
-    os.system('python ~/scripts/2.split_by_barcodes.py -q ' + fastq_in + ' -b ' + barcodes_map + ' -B tab -d 1 --mode ' + mode + ' -o ' + fastq_out)
+    index_format = ''
+    if index_file:
+        index_format = 'fasta' if util.open_file(index_file).read(1) == '>' else 'tab'
+    b2s = stages.read_barcodes(barcodes_map, format='tab')
+    [n_seqs, s2c, n_ambiguous] = stages.split_by_barcodes(fastq_in, fastq_out, b2s, int(mode), max_diff=1, index_fn=index_file, index_format=index_format)
+    print "[[ Splitting by barcodes ]] Assigned %d of %d sequences (%d ambiguous)." %(sum(s2c.values()), n_seqs, n_ambiguous)
+    return None
+
+def process_chunk((fn_in, start, end, out_prefix, fmt, barcodes_map, mode, index_file, primers_file, ascii_encoding, Q, length, debug)):
+    # Runs steps 2.1-2.5 of raw2otu.py on one chunk in a single pass: every batch of reads is demultiplexed, trimmed of primers,
+    # truncated at quality Q, filtered by length and expected errors and written as FASTA (out_prefix.fasta), without intermediate files.
+    # The chunk is the byte range start..end-1 of fn_in (chunker.record_ranges), read in place, or the whole file if end is None.
+    # Steps are skipped if barcodes_map (demultiplexing) or primers_file (primer removal) is empty; quality trimming is FASTQ only.
+    # Filters match the per-step functions (split_by_barcodes, remove_primers, trim_quality with a dataset-wide Q, trim_length_fastq
+    # or trim_length_fasta, and fastq_to_fasta, which discards reads containing N).
+    # If debug is True, the reads after every step are also written to the per-step files (out_prefix.sb, .pt, .qt, .lt).
+    # Returns the QCProfile of the reads entering quality trimming (FASTQ), or None (FASTA).
+    fasta_out = out_prefix + '.fasta'
+    chunk = fn_in
+    if end is not None:
+        chunk = '%s [%d, %d)' %(fn_in, start, end)
+    print "[[ Processing chunk ]] " + chunk + " ..."
+    if fmt == 'fasta':
+        iter_batches = lambda fn: util.iter_fst_batches(fn, start=start, end=end)
+    else:
+        iter_batches = lambda fn: util.iter_fsq_batches(fn, start=start, end=end)
+
+    # Compile barcodes and primers (cached per pool worker)
+    if barcodes_map:
+        mode = int(mode)
+        b2s = stages.read_barcodes(barcodes_map, format='tab')
+        matcher = stages.compile_barcodes(b2s, max_diff=1)
+        index = None
+        if mode == 3:
+            index_format = 'fasta' if util.open_file(index_file).read(1) == '>' else 'tab'
+            index = stages.IndexJoin(index_file, fn_in, iter_batches, format=index_format)
+        s2c = {}
+    if primers_file:
+        primers = stages.read_primers(primers_file)
+    profile = None
+    if fmt == 'fastq':
+        Qvals = qcprofile.TRUNCQ_VALS
+        if Q not in Qvals:
+            Qvals = Qvals + [Q]
+        profile = qcprofile.QCProfile(truncq_vals=Qvals)
+
+    # Per-step output files (debug only)
+    debug_out = {}
+    if debug:
+        fn = out_prefix
+        for [step, used] in [['.sb', barcodes_map], ['.pt', primers_file], ['.qt', fmt == 'fastq'], ['.lt', True]]:
+            if used:
+                fn = fn + step
+                debug_out[step] = open(fn, 'w')
+
+    counts = [0, 0, 0, 0, 0, 0] # reads in, demultiplexed, with primer, quality trimmed, length trimmed, written
+    out = open(fasta_out, 'w')
+    for records in iter_batches(fn_in):
+        counts[0] += len(records)
+
+        # Step 2.1 - demultiplex
+        if barcodes_map:
+            [records, n_ambiguous] = stages.demultiplex(records, b2s, mode, matcher, index=index, s2c=s2c)
+            write_records(debug_out.get('.sb'), records)
+        counts[1] += len(records)
+
+        # Step 2.2 - remove primers
+        if primers_file:
+            [records, n_fast] = stages.trim_primers(records, primers, max_dist=1)
+            write_records(debug_out.get('.pt'), records)
+        counts[2] += len(records)
+        batch = readbatch.from_records(records, ascii_encoding=ascii_encoding)
+
+        # Step 2.3 - quality trimming
+        if fmt == 'fastq':
+            lengths = batch.truncqual_lengths(Qvals)
+            profile.add_batch(batch, truncqual_lengths=lengths)
+            L = lengths[:, Qvals.index(Q)]
+            batch = batch.truncate(L).subset(L > 0)
+            if '.qt' in debug_out:
+                batch.write(debug_out['.qt'])
+        counts[3] += len(batch)
+
+        # Step 2.4 - length trimming
+        if fmt == 'fastq':
+            keep = batch.filter_length_ee(length, MAXEE)
+        else:
+            keep = batch.lengths >= length
+        batch = batch.subset(keep).truncate(length)
+        if '.lt' in debug_out:
+            batch.write(debug_out['.lt'])
+        counts[4] += len(batch)
+
+        # Step 2.5 - convert to FASTA
+        if fmt == 'fastq':
+            batch = batch.subset(~(batch.seqs == ord('N')).any(axis=1))
+        batch.write(out, fmt='fasta')
+        counts[5] += len(batch)
+    out.close()
+    for fid in debug_out.values():
+        fid.close()
+
+    steps = ['demultiplexed', 'with primers', 'quality trimmed', 'length trimmed', 'written']
+    print "[[ Processing chunk ]] " + chunk + ": " + str(counts[0]) + " reads, " + ', '.join([str(n) + ' ' + step for n, step in zip(counts[1:], steps)]) + "."
+    print "[[ Processing chunk ]] FASTA file: " + fasta_out
+    print "[[ Processing chunk ]] Complete."
+    return profile
+
+def process_chunk_file(args):
+    # Runs process_chunk on a temporary chunk file (the first argument, e.g. decompressed by chunker.iter_split_file), and
+    # removes the chunk file once it is processed
+    profile = process_chunk(args)
+    os.remove(args[0])
+    return profile
+
+def write_records(out, records):
+    # Writes FASTA/FASTQ records to an open file (no-op if out is None)
+    if out is not None:
+        out.writelines(['\n'.join(record) + '\n' for record in records])
     return None
 
-def dereplicate_and_sort(fasta_in, fasta_out, OTU_database, separator):
+def dereplicate_and_sort(fasta_in, fasta_out, OTU_database, separator, pool=None, n_parts=1, memory=None):
     # Dereplicate and sort sequences by size
+    # With a pool, the file is dereplicated by map-reduce over byte ranges and n_parts hash partitions (same output)
+    # Beyond memory bytes (default: half of the physical memory), the reads are dereplicated out of core (see
+    # stages.dereplicate_and_write and stages.dereplicate_parallel_and_write)
     print "[[ Dereplicating and sorting ]] ..."
-    os.system('sudo python ~/scripts/3.dereplicate.py -f ' + fasta_in + " -s '" + separator + "' -o " + OTU_database + ' -d ' + fasta_out)
+    if memory is None:
+        memory = stages.memory_budget()
+    if pool is None:
+        stages.dereplicate_and_write(OTU_database, fasta_out, fst=fasta_in, sep=separator, min_size=10, memory=memory, tmp_prefix=fasta_out + '.run')
+    else:
+        stages.dereplicate_parallel_and_write(OTU_database, fasta_out, fasta_in, pool, n_parts, sep=separator, min_size=10, memory=memory, tmp_prefix=fasta_out)
     print "[[ Dereplicating and sorting ]] Complete."
     return None
 
@@ -135,7 +320,7 @@ def remove_chimeras_and_cluster_OTUs(fasta_in, OTU_sequences_fasta, OTU_sequence
 def build_OTU_table(fasta_in, dereplication_map, OTU_table, OTU_GG_dict=0):
     # Builds an OTU table from a list of OTUs and a dereplication map.  If an optional fourth argument is given, this should be a dictionary to convert OTU IDs to Greengenes ID.
     print "[[ Building OTU table ]] ..."
-    os.system('sudo python ~/scripts/4.derep2counts.py --fst ' + fasta_in + ' --map ' + dereplication_map + ' --out ' + OTU_table)
+    stages.derep2counts(dereplication_map, OTU_table, fst=fasta_in)
     if OTU_GG_dict == 0:
         print "[[ Building OTU table ]] Complete."
         return None
@@ -153,7 +338,7 @@ def build_OTU_table(fasta_in, dereplication_map, OTU_table, OTU_GG_dict=0):
                     linejoined = '\t'.join(linespl)
                     newfid.write(linejoined)
         print "[[ Building OTU table ]] Building second (GreenGenes referenced) OTU table."
-        os.system('sudo python ~/scripts/4.derep2counts.py --map ' + new_dereplication_map + ' --out ' + new_OTU_table)
+        stages.derep2counts(new_dereplication_map, new_OTU_table)
         print "[[ Building OTU table ]] Greengenes OTU table complete."
         print "[[ Building OTU table ]] Complete."
         return None
@@ -174,25 +359,90 @@ def parse_alignment(alignment_file):
             alignment_dict[query] = target
     return alignment_dict
 
-def renumber_sequences(fasta_files, separator):
-    # Renumbers sequences IDs for each sample so sampleID_1, sampleID_2 etc. only occur once
-    def update_numbers(fasta_in, fasta_out, sample_counts):
-        iter_fst = util.iter_fst
-        with open(fasta_out, 'w') as outfile:
-            for record in iter_fst(fasta_in):
-                sid = record[0][1:] # id
-                sid = sid.split(separator)
-                sampleID = ''.join(sid[:len(sid)-1])
-                seq = record[1] # sequence
-                sample_count = sid[len(sid)-1]
-                sample_counts[sampleID] = sample_counts.get(sampleID, 0) + 1 # Increment sample count
-                new_sid = '>%s_%d' %(sampleID, sample_counts[sampleID])
-                record[0] = new_sid
-                outfile.write('\n'.join(record) + '\n')
-        return sample_counts
+def sample_id(sid, separator):
+    # Sample ID of a sequence ID of the form sampleID<separator>N (the parts before the last separator are joined)
+    return sid.rpartition(separator)[0].replace(separator, '')
+
+def count_samples((fasta_in, separator)):
+    # Counts the reads of every sample in a FASTA file, for renumber_sequences
+    # Returns [sample counts, size in bytes of the renumbered records without their numbers]
+    heads = {} # '>' + sequence ID up to the last separator -> number of reads
+    size = 0
+    for records in util.iter_fst_batches(fasta_in):
+        for [sid, seq] in records:
+            head = sid.rpartition(separator)[0]
+            heads[head] = heads.get(head, 0) + 1
+        size += sum([len(seq) for [sid, seq] in records])
+    counts = {}
+    for head in heads:
+        sampleID = sample_id(head[1:] + separator, separator)
+        counts[sampleID] = counts.get(sampleID, 0) + heads[head]
+        size += heads[head]*(len(sampleID) + 4) # '>' + sampleID + '_' + N + newline + seq + newline
+    return [counts, size]
+
+def count_digits(a, b):
+    # Total number of digits of the integers a+1..b
+    n = 0
+    d = 1
+    lo = 1
+    while lo <= b:
+        n += d*max(0, min(b, 10*lo - 1) - max(a + 1, lo) + 1)
+        lo *= 10
+        d += 1
+    return n
 
+def relabel_chunk((fasta_in, fasta_out, offset, sample_counts, separator)):
+    # Writes the records of fasta_in renumbered from sample_counts[sampleID] + 1 into fasta_out, starting at byte offset
+    # Returns the sample counts after this file
+    sample_counts = dict(sample_counts)
+    sample_ids = {} # '>' + sequence ID up to the last separator -> sample ID
+    with open(fasta_out, 'r+b') as out:
+        out.seek(offset)
+        for records in util.iter_fst_batches(fasta_in):
+            lines = []
+            for [sid, seq] in records:
+                head = sid.rpartition(separator)[0]
+                if head not in sample_ids:
+                    sample_ids[head] = sample_id(head[1:] + separator, separator)
+                sampleID = sample_ids[head]
+                n = sample_counts.get(sampleID, 0) + 1 # Increment sample count
+                sample_counts[sampleID] = n
+                lines.append('>%s_%d\n%s\n' %(sampleID, n, seq))
+            out.write(''.join(lines))
+    return sample_counts
+
+def renumber_sequences(fasta_files, separator, fasta_out, pool=None, counts=None):
+    # Renumbers sequences IDs for each sample so sampleID_1, sampleID_2 etc. only occur once, and concatenates the files into fasta_out
+    # With a pool, in two phases: the reads per sample are counted in every file (count_samples, or counts if already computed), then
+    # prefix sums give every file the first number of every sample and its byte offset in fasta_out, and the files are relabeled in
+    # parallel, each worker writing its own part of fasta_out.  Without a pool, the files are relabeled in turn in a single pass.
+    # Input files are not rewritten.  Returns the number of reads of every sample.
     print "[[ Renumbering sequences ]] ..."
-    sample_counts = {}
-    for filename in fasta_files:
-        sample_counts = update_numbers(filename, filename + '.tmp', sample_counts)
-        os.system('mv ' + filename + '.tmp ' + filename)
+    if pool is None and counts is None:
+        sample_counts = {}
+        open(fasta_out, 'w').close()
+        for filename in fasta_files:
+            sample_counts = relabel_chunk((filename, fasta_out, os.path.getsize(fasta_out), sample_counts, separator))
+    else:
+        map_chunks = map if pool is None else pool.map
+        if counts is None:
+            counts = map_chunks(count_samples, [(filename, separator) for filename in fasta_files])
+
+        # Prefix sums: sample counts before every file, and byte offset of every file in fasta_out
+        sample_counts = {}
+        starts = []
+        offset = 0
+        for [chunk_counts, size] in counts:
+            starts.append([offset, dict(sample_counts)])
+            for sampleID in chunk_counts:
+                n = sample_counts.get(sampleID, 0)
+                offset += count_digits(n, n + chunk_counts[sampleID])
+                sample_counts[sampleID] = n + chunk_counts[sampleID]
+            offset += size
+        with open(fasta_out, 'w') as out:
+            out.truncate(offset)
+        map_chunks(relabel_chunk, [(filename, fasta_out, start, start_counts, separator) for (filename, [start, start_counts]) in zip(fasta_files, starts)])
+
+    print "[[ Renumbering sequences ]] Wrote " + str(sum(sample_counts.values())) + " sequences from " + str(len(sample_counts)) + " samples to " + fasta_out
+    print "[[ Renumbering sequences ]] Complete."
+    return sample_counts
@@ -0,0 +1,343 @@
+"""
+
+OVERVIEW:
+
+Vectorized matching of degenerate (IUPAC) primers against batches of reads.
+
+Reads are one-hot encoded as 4-bit masks (A=1, C=2, G=4, T=8, anything else=0) and every primer is compiled into one
+mask per position (e.g. R = A|G = 5), so a base matches a primer position if (read & primer) != 0.  The mismatches at all
+w window offsets are counted for a whole batch of reads with one NumPy operation per primer position.
+
+Results are identical to stages.find_best_primer (Hamming distance of primer.MatchPrefix, first best offset,
+first best primer).
+
+EditMatcher allows indels: it finds the primer with the smallest edit distance to a substring of the read that ends within
+the first w + len(primer) + max_dist - 1 bases, using Myers' bit-parallel algorithm (one 64-bit word per read, so primers
+are limited to 64 bases).  The text positions are scanned for the whole batch at once, and reads drop out of the scan as
+soon as they have an exact match or can no longer reach max_dist.
+
+PrefixIndex is the fast path for the common case of a read carrying a primer exactly near its start: every expansion of
+every degenerate primer is stored as a sorted array of 2-bit packed k-mers.  The k-mers at all window offsets of a batch of
+reads are computed from prefix codes (one NumPy operation per read position) and looked up with one np.searchsorted per
+primer, so the cost per primer does not grow with the primer length.  Only the reads that miss the index need the full scan with
+EditMatcher (a PrimerMatcher scan costs about as much as the index lookup, see stages.compile_primers).
+
+BarcodeIndex maps every sequence within max_dist mismatches of a barcode to that barcode, so demultiplexing a read costs
+one dictionary lookup per window offset regardless of the number of barcodes.  Sequences equally close to two barcodes are
+marked as ambiguous, and the barcode pairs whose neighborhoods overlap are kept for the collision report.
+
+"""
+
+import itertools
+import numpy as np
+import primer, util
+
+MAX_EXPANSIONS = 4096 # most expansions of a degenerate primer stored in a PrefixIndex
+MAX_PREFIX_LEN = 31 # longest primer stored in a PrefixIndex (2-bit packed in a uint64)
+SUFFIX_BASES = 10 # a PrefixIndex filters the windows on their last 10 bases with a lookup table (4^10 entries)
+
+# One-hot (4-bit) code of every read character
+BASE_BITS = np.zeros(256, dtype=np.uint8)
+for i, b in enumerate('ACGT'):
+    BASE_BITS[ord(b)] = 1 << i
+
+
+def compile_primer(p):
+    # Compile a degenerate primer into an array of per-position base masks
+    masks = []
+    for b in p:
+        if b not in primer.IUPAC:
+            util.error('Error: bad letter in primer "%s"' %(p))
+        masks.append(sum([1 << 'ACGT'.index(a) for a in primer.IUPAC[b]]))
+    return np.array(masks, dtype=np.uint8)
+
+
+def encode_bits(seqs, L):
+    # One-hot encode the first L columns of a matrix of base codes (ReadBatch.seqs), padded with zeros to L columns
+    bits = BASE_BITS[seqs[:, :L]]
+    if bits.shape[1] < L:
+        bits = np.hstack([bits, np.zeros((bits.shape[0], L - bits.shape[1]), dtype=np.uint8)])
+    return bits
+
+
+class PrimerMatcher():
+
+    def __init__(self, primers, w, max_dist):
+        self.primers = list(primers)
+        self.masks = [compile_primer(p) for p in self.primers]
+        self.w = w
+        self.max_dist = max_dist
+
+
+    def mismatches(self, bits, valid, k):
+        # Number of mismatches between primer k and every read at window offsets 0..w-1 (n x w array)
+        # Only positions inside the read are compared (as primer.MatchPrefix)
+        w = self.w
+        d = np.zeros((bits.shape[0], w), dtype=np.int64)
+        for j, m in enumerate(self.masks[k]):
+            d += ((bits[:, j:j+w] & m) == 0) & valid[:, j:j+w]
+        return d
+
+
+    def match(self, seqs, lengths):
+        # Find the best matching primer for every read (ReadBatch.seqs and ReadBatch.lengths)
+        # Returns [offsets, distances, primer indices]; reads without a match within max_dist have offset and primer index -1
+        n = len(lengths)
+        L = self.w + max([len(m) for m in self.masks])
+        bits = encode_bits(seqs, L)
+        valid = np.arange(bits.shape[1])[np.newaxis, :] < lengths[:, np.newaxis]
+        best_i = np.zeros(n, dtype=np.int64) - 1
+        best_k = np.zeros(n, dtype=np.int64) - 1
+        best_d = lengths.copy()
+        rows = np.arange(n)
+        for k in range(len(self.masks)):
+            d = self.mismatches(bits, valid, k)
+            i = d.argmin(axis=1) # first offset with the fewest mismatches
+            d = d[rows, i]
+            better = d < best_d
+            best_i[better] = i[better]
+            best_k[better] = k
+            best_d[better] = d[better]
+        found = (best_k >= 0) & (best_d <= self.max_dist)
+        best_i[~found] = -1
+        best_k[~found] = -1
+        return [best_i, best_d, best_k]
+
+
+    def match_ends(self, seqs, lengths):
+        # As match, but returns [end positions (offset + primer length), distances, primer indices]
+        [I, D, K] = self.match(seqs, lengths)
+        lengths = np.array([len(p) for p in self.primers])
+        E = np.where(K >= 0, I + lengths[K], -1)
+        return [E, D, K]
+
+
+def compile_peq(p):
+    # Myers pattern bitvectors: one uint64 per read character, with bit j set if the character matches primer position j
+    if len(p) > 64:
+        util.error('Error: primer "%s" is longer than 64 bases' %(p))
+    masks = compile_primer(p)
+    peq = np.zeros(256, dtype=np.uint64)
+    for i, b in enumerate('ACGT'):
+        bits = 0
+        for j, m in enumerate(masks):
+            if m & (1 << i):
+                bits |= 1 << j
+        peq[ord(b)] = bits
+    return peq
+
+
+class EditMatcher():
+
+    def __init__(self, primers, w, max_dist):
+        self.primers = list(primers)
+        self.peqs = [compile_peq(p) for p in self.primers]
+        self.w = w
+        self.max_dist = max_dist
+
+
+    def distances(self, seqs, lengths, k):
+        # Smallest edit distance between primer k and a substring of every read ending in the search window
+        # Returns [end positions, distances]; reads are scanned until a match is exact or cannot get within max_dist
+        m = len(self.primers[k])
+        peq = self.peqs[k]
+        n = len(lengths)
+        L = min(seqs.shape[1], self.w + m + self.max_dist - 1)
+        high = np.uint64(1 << (m - 1))
+        one = np.uint64(1)
+        best_e = np.zeros(n, dtype=np.int64)
+        best_d = np.zeros(n, dtype=np.int64) + m
+        # state of the reads still being scanned
+        rows = np.flatnonzero(lengths > 0)
+        Pv = np.zeros(len(rows), dtype=np.uint64) + np.uint64((1 << m) - 1)
+        Mv = np.zeros(len(rows), dtype=np.uint64)
+        score = np.zeros(len(rows), dtype=np.int64) + m
+        for j in range(L):
+            if len(rows) == 0:
+                break
+            Eq = peq[seqs[rows, j]]
+            Xv = Eq | Mv
+            Xh = (((Eq & Pv) + Pv) ^ Pv) | Eq
+            Ph = Mv | ~(Xh | Pv)
+            Mh = Pv & Xh
+            score += (Ph & high) != 0
+            score -= (Mh & high) != 0
+            Ph <<= one
+            Mh <<= one
+            Pv = Mh | ~(Xv | Ph)
+            Mv = Ph & Xv
+            # keep the first end position with the smallest distance
+            better = score < best_d[rows]
+            best_d[rows[better]] = score[better]
+            best_e[rows[better]] = j + 1
+            # stop at the end of the read, after an exact match, or when max_dist is out of reach
+            remaining = np.minimum(lengths[rows], L) - (j + 1)
+            keep = (remaining > 0) & (best_d[rows] > 0) & (score - remaining <= self.max_dist)
+            if not keep.all():
+                rows = rows[keep]
+                Pv = Pv[keep]
+                Mv = Mv[keep]
+                score = score[keep]
+        return [best_e, best_d]
+
+
+    def match_ends(self, seqs, lengths):
+        # Find the best matching primer for every read (ReadBatch.seqs and ReadBatch.lengths)
+        # Returns [end positions, distances, primer indices]; reads without a match within max_dist have end and index -1
+        n = len(lengths)
+        best_e = np.zeros(n, dtype=np.int64) - 1
+        best_k = np.zeros(n, dtype=np.int64) - 1
+        best_d = np.zeros(n, dtype=np.int64) + self.max_dist + 1
+        for k in range(len(self.peqs)):
+            [e, d] = self.distances(seqs, lengths, k)
+            better = d < best_d
+            best_e[better] = e[better]
+            best_k[better] = k
+            best_d[better] = d[better]
+        return [best_e, best_d, best_k]
+
+
+def expand_primer(p):
+    # List all the ACGT sequences matched by a degenerate primer
+    return [''.join(x) for x in itertools.product(*[sorted(primer.IUPAC[b]) for b in p])]
+
+
+def pack_kmer(x):
+    # 2-bit packed code of an ACGT sequence (first base in the highest bits)
+    # Bases are coded from their ASCII value as (c >> 1) & 3 (A=0, C=1, T=2, G=3), as in PrefixIndex.match
+    code = 0
+    for b in x:
+        code = 4*code + ((ord(b) >> 1) & 3)
+    return code
+
+
+class PrefixIndex():
+
+    def __init__(self, primers, n_offsets, min_len=0):
+        # Index the expansions of every primer, searched at offsets 0..n_offsets-1 of reads with at least min_len bases
+        # Primers are indexed in order up to the first one with more than MAX_EXPANSIONS expansions (or more than
+        # MAX_PREFIX_LEN bases), so that the first hit is always the match the full scan would choose
+        # Every primer is stored as [primer index, length, sorted packed expansions, lookup table of their last bases]
+        self.primers = list(primers)
+        self.n_offsets = n_offsets
+        self.min_len = min_len
+        self.index = []
+        for k, p in enumerate(self.primers):
+            n = 1
+            for b in p:
+                n *= len(primer.IUPAC.get(b, 'X'))
+            if n > MAX_EXPANSIONS or len(p) > MAX_PREFIX_LEN:
+                break
+            codes = np.array(sorted([pack_kmer(x) for x in expand_primer(p)]), dtype=np.uint64)
+            suffixes = np.zeros(4**min(len(p), SUFFIX_BASES), dtype=bool)
+            suffixes[(codes % len(suffixes)).astype(np.int64)] = True
+            self.index.append([k, len(p), codes, suffixes])
+
+
+    def match(self, seqs, lengths):
+        # Find the first exact primer match at offsets 0..n_offsets-1 of every read (ReadBatch.seqs and ReadBatch.lengths)
+        # Primers are tried in order, and the first offset of the first primer with an exact match is returned
+        # Returns [offsets, primer indices]; reads without an exact match (or shorter than min_len) have -1
+        n = len(lengths)
+        best_i = np.zeros(n, dtype=np.int64) - 1
+        best_k = np.zeros(n, dtype=np.int64) - 1
+        if n == 0 or len(self.index) == 0:
+            return [best_i, best_k]
+        w = self.n_offsets
+        L = w - 1 + max([x[1] for x in self.index])
+        x = seqs[:, :L]
+        if x.shape[1] < L:
+            x = np.hstack([x, np.zeros((n, L - x.shape[1]), dtype=np.uint8)])
+        # prefix codes of every read, one row per position (uint64 arithmetic wraps around, which leaves the codes of windows
+        # up to 32 bases exact); other characters than ACGT get the code of one of them, and are checked on the hits only
+        base_codes = (np.ascontiguousarray(x.T) >> 1) & 3
+        C = np.zeros((L + 1, n), dtype=np.uint64)
+        two = np.uint64(2)
+        for j in range(L):
+            np.left_shift(C[j], two, C[j+1])
+            C[j+1] |= base_codes[j]
+        found = lengths < self.min_len
+        for [k, m, codes, suffixes] in self.index:
+            # candidate windows i..i+m-1 (for all offsets i at once) end with the last bases of an expansion
+            ends = (C[m:m+w] & np.uint64(len(suffixes) - 1)).view(np.int64)
+            [I, R] = np.nonzero(suffixes[ends] & ~found)
+            # check the whole window code (C[i+m] - C[i]*4^m) and the bases
+            W = C[I + m, R] - (C[I, R] << np.uint64(2*m))
+            hit = codes[np.minimum(np.searchsorted(codes, W), len(codes) - 1)] == W
+            [I, R] = [I[hit], R[hit]]
+            hit = (BASE_BITS[x[R[:, np.newaxis], I[:, np.newaxis] + np.arange(m)]] != 0).all(axis=1)
+            [I, R] = [I[hit], R[hit]]
+            # first offset with an exact match (the hits are sorted by offset)
+            [rows, first] = np.unique(R, return_index=True)
+            best_i[rows] = I[first]
+            best_k[rows] = k
+            found[rows] = True
+        return [best_i, best_k]
+
+
+def hamming(x, y):
+    # Number of mismatches between two sequences of the same length
+    return sum([a != b for a, b in zip(x, y)])
+
+
+class BarcodeIndex():
+
+    def __init__(self, barcodes, max_dist, alphabet='ACGTN'):
+        # Index all the sequences (over alphabet) within max_dist mismatches of every barcode
+        self.barcodes = list(barcodes)
+        self.max_dist = max_dist
+        self.index = {} # sequence -> (barcode, mismatches), barcode None if ambiguous
+        for b in self.barcodes:
+            for x in expand_primer(b):
+                for d in range(max_dist + 1):
+                    for pos in itertools.combinations(range(len(x)), d):
+                        for letters in itertools.product(*[[a for a in alphabet if a != x[j]] for j in pos]):
+                            y = list(x)
+                            for j, a in zip(pos, letters):
+                                y[j] = a
+                            self.add(''.join(y), b, d)
+        self.lengths = sorted(set([len(y) for y in self.index]))
+
+
+    def add(self, y, b, d):
+        # Add sequence y at d mismatches from barcode b
+        if y not in self.index:
+            self.index[y] = (b, d)
+            return
+        [b0, d0] = self.index[y]
+        if d < d0:
+            self.index[y] = (b, d)
+        elif d == d0 and b0 != b:
+            self.index[y] = (None, d)
+
+
+    def collisions(self):
+        # Barcode pairs too close for max_dist (some sequences are within max_dist mismatches of both)
+        # Returns a list of [barcode 1, barcode 2, mismatches]
+        pairs = []
+        for i, b1 in enumerate(self.barcodes):
+            for b2 in self.barcodes[i+1:]:
+                if len(b1) == len(b2):
+                    d = hamming(b1, b2)
+                    if d <= 2*self.max_dist:
+                        pairs.append([b1, b2, d])
+        return pairs
+
+
+    def lookup(self, seq, w):
+        # Find the closest barcode at offsets 0..w-1 of seq
+        # Returns [end position, mismatches, barcode] (barcode None if two barcodes are equally close), or None
+        best = None
+        for i in range(w):
+            for m in self.lengths:
+                if i + m > len(seq):
+                    break
+                hit = self.index.get(seq[i:i+m])
+                if hit is None:
+                    continue
+                [b, d] = hit
+                if best is None or d < best[1]:
+                    best = [i + m, d, b]
+                elif d == best[1] and b != best[2]:
+                    best[2] = None
+        return best
@@ -0,0 +1,205 @@
+"""
+
+OVERVIEW:
+
+Streaming read QC profile.  A QCProfile accumulates, in bounded memory, over every read of a FASTA/FASTQ file:
+    length_hist     read length histogram
+    qual_hist       per-position quality score histogram (FASTQ only)
+    base_counts     per-position base composition (A, C, G, T, other)
+    ee_hist         expected error distribution (FASTQ only)
+    truncqual_hist  read length histogram after truncating at the first base with quality <= Q, for every Q in TRUNCQ_VALS
+
+Profiles built by the parallel chunk workers are combined with merge(), and the dataset profile is written as JSON.
+Reads longer than max_len are counted in the last length bin, and only their first max_len positions are profiled.
+
+"""
+
+import json
+import numpy as np
+import readbatch, util
+
+MAX_LEN = 1000 # longest read length profiled per position
+TRUNCQ_VALS = range(5,11) # candidate Q cut-offs for quality trimming
+EE_STEP = 0.05 # width of the expected error bins
+EE_BINS = 200 # number of expected error bins (the last bin holds EE >= 9.95)
+BASES = 'ACGT' # base composition columns (plus one column for any other character)
+
+# Maps base codes to base composition columns
+BASE_INDEX = np.zeros(256, dtype=np.int64) + len(BASES)
+for i, b in enumerate(BASES):
+    BASE_INDEX[ord(b)] = i
+    BASE_INDEX[ord(b.lower())] = i
+
+
+def bincount(x, n):
+    # np.bincount with exactly n bins (values must be < n)
+    counts = np.zeros(n, dtype=np.int64)
+    if len(x) > 0:
+        c = np.bincount(x)
+        counts[:len(c)] += c
+    return counts
+
+
+def hist_percentile(hist, p):
+    # Percentile of the values summarized in a histogram (bin i = value i), interpolated as np.percentile
+    n = hist.sum()
+    if n == 0:
+        return 0
+    cum = np.cumsum(hist)
+    rank = (n - 1)*p/100.
+    lo = int(np.floor(rank))
+    hi = int(np.ceil(rank))
+    x_lo = np.searchsorted(cum, lo + 1)
+    x_hi = np.searchsorted(cum, hi + 1)
+    return x_lo + (x_hi - x_lo)*(rank - lo)
+
+
+class QCProfile():
+
+    def __init__(self, max_len=MAX_LEN, truncq_vals=TRUNCQ_VALS):
+        self.max_len = max_len
+        self.truncq_vals = list(truncq_vals)
+        self.n_reads = 0
+        self.length_hist = np.zeros(max_len + 1, dtype=np.int64)
+        self.qual_hist = np.zeros((max_len, 256), dtype=np.int64)
+        self.base_counts = np.zeros((max_len, len(BASES) + 1), dtype=np.int64)
+        self.ee_hist = np.zeros(EE_BINS, dtype=np.int64)
+        self.truncqual_hist = np.zeros((len(self.truncq_vals), max_len + 1), dtype=np.int64)
+
+
+    def add_batch(self, batch, truncqual_lengths=None):
+        # Add the reads in a ReadBatch to the profile
+        # truncqual_lengths (from batch.truncqual_lengths(truncq_vals)) can be passed in if already computed
+        if len(batch) == 0:
+            return self
+        m = self.max_len
+        self.n_reads += len(batch)
+        self.length_hist += bincount(np.minimum(batch.lengths, m), m + 1)
+        L = min(batch.seqs.shape[1], m)
+        mask = batch.mask()[:, :L]
+        pos = np.nonzero(mask)[1]
+        codes = BASE_INDEX[batch.seqs[:, :L][mask]]
+        self.base_counts += bincount(pos*(len(BASES) + 1) + codes, m*(len(BASES) + 1)).reshape(m, len(BASES) + 1)
+        if batch.quals is not None:
+            quals = batch.quals[:, :L][mask].astype(np.int64)
+            self.qual_hist += bincount(pos*256 + quals, m*256).reshape(m, 256)
+            ee = batch.expected_errors()
+            self.ee_hist += bincount(np.minimum((ee/EE_STEP).astype(np.int64), EE_BINS - 1), EE_BINS)
+            if truncqual_lengths is None:
+                truncqual_lengths = batch.truncqual_lengths(self.truncq_vals)
+            for j in range(len(self.truncq_vals)):
+                self.truncqual_hist[j] += bincount(np.minimum(truncqual_lengths[:, j], m), m + 1)
+        return self
+
+
+    def merge(self, x):
+        # Add the counts of another QCProfile (e.g. from another chunk) to this one
+        if x.max_len != self.max_len or x.truncq_vals != self.truncq_vals:
+            util.error('Error: cannot merge QC profiles with different settings')
+        self.n_reads += x.n_reads
+        self.length_hist += x.length_hist
+        self.qual_hist += x.qual_hist
+        self.base_counts += x.base_counts
+        self.ee_hist += x.ee_hist
+        self.truncqual_hist += x.truncqual_hist
+        return self
+
+
+    def length_stats(self, hist=None):
+        # Returns [maximum read length, 5th percentile of read length] (as preprocessing_16S.length_stats_fastq)
+        if hist is None:
+            hist = self.length_hist
+        nonzero = np.flatnonzero(hist)
+        if len(nonzero) == 0:
+            return [0, 0]
+        return [int(nonzero[-1]), hist_percentile(hist, 5)]
+
+
+    def truncqual_stats(self, Q):
+        # Returns [maximum read length, 5th percentile of read length] after truncating reads at the first base with
+        # quality <= Q and discarding empty reads, or None if no read is left
+        hist = self.truncqual_hist[self.truncq_vals.index(Q)].copy()
+        hist[0] = 0
+        if hist.sum() == 0:
+            return None
+        return self.length_stats(hist)
+
+
+    def best_truncqual(self, min_frac=0.8):
+        # Highest Q for which the 5th percentile of the truncated read length is at least min_frac of the maximum length
+        # Returns [Q, 5th percentile], or [0, None] if no Q qualifies
+        bestQ = 0
+        bestFifthPercentile = None
+        for Q in self.truncq_vals:
+            stats = self.truncqual_stats(Q)
+            if stats is None:
+                continue
+            [full_length, fifthPercentile] = stats
+            if fifthPercentile >= min_frac*float(full_length):
+                bestQ = Q
+                bestFifthPercentile = fifthPercentile
+        return [bestQ, bestFifthPercentile]
+
+
+    def to_dict(self):
+        return {'n_reads': self.n_reads,
+                'max_len': self.max_len,
+                'length_hist': self.length_hist.tolist(),
+                'qual_hist': self.qual_hist.tolist(),
+                'base_counts': self.base_counts.tolist(),
+                'bases': BASES + 'N',
+                'ee_step': EE_STEP,
+                'ee_hist': self.ee_hist.tolist(),
+                'truncq_vals': self.truncq_vals,
+                'truncqual_hist': self.truncqual_hist.tolist(),
+                }
+
+
+    def write(self, fn):
+        # Write profile as JSON
+        with open(fn, 'w') as out:
+            json.dump(self.to_dict(), out)
+        return self
+
+
+def load(fn):
+    # Load a QCProfile from a JSON file
+    x = json.load(open(fn))
+    profile = QCProfile(max_len=x['max_len'], truncq_vals=x['truncq_vals'])
+    profile.n_reads = x['n_reads']
+    profile.length_hist = np.array(x['length_hist'], dtype=np.int64)
+    profile.qual_hist = np.array(x['qual_hist'], dtype=np.int64)
+    profile.base_counts = np.array(x['base_counts'], dtype=np.int64)
+    profile.ee_hist = np.array(x['ee_hist'], dtype=np.int64)
+    profile.truncqual_hist = np.array(x['truncqual_hist'], dtype=np.int64)
+    return profile
+
+
+def merge(profiles):
+    # Merge a list of QCProfiles into one
+    profile = QCProfile(max_len=profiles[0].max_len, truncq_vals=profiles[0].truncq_vals)
+    for x in profiles:
+        profile.merge(x)
+    return profile
+
+
+def profile_file(fn, fmt='fastq', ascii_encoding=33, n=0):
+    # Build the QCProfile of a FASTA/FASTQ file in one streaming pass (n > 0 stops after n reads)
+    profile = QCProfile()
+    for batch in readbatch.iter_batches(fn, fmt=fmt, ascii_encoding=ascii_encoding):
+        if n > 0:
+            if profile.n_reads >= n:
+                break
+            if profile.n_reads + len(batch) > n:
+                batch = batch.subset(np.arange(n - profile.n_reads))
+        profile.add_batch(batch)
+    return profile
+
+
+def sample_file(fn, n=100000, ascii_encoding=33, seed=None):
+    # Build the QCProfile of a uniform random sample of n reads from a FASTQ file
+    records = util.reservoir_sample(util.iter_fsq_batches(fn), n, seed=seed)
+    profile = QCProfile()
+    for i in range(0, len(records), util.FSQ_BATCH_SIZE):
+        profile.add_batch(readbatch.from_records(records[i:i+util.FSQ_BATCH_SIZE], ascii_encoding=ascii_encoding))
+    return profile
@@ -13,10 +13,10 @@ import numpy as np
 import os, sys
 import os.path
 import math
-from string import ascii_lowercase
 import multiprocessing as mp
 import ntpath
 import preprocessing_16S as OTU
+import chunker, pipeline, qcprofile, util
 import Formatting as frmt
 from CommLink import *
 from SummaryParser import *
@@ -30,6 +30,7 @@ parser.add_option("-i", "--input_dir", type="string", dest="input_dir")
 parser.add_option("-o", "--output_dir", type="string", dest="output_dir")
 parser.add_option("-p", "--primers_removed", dest="primers_removed", default='False')
 parser.add_option("-b", "--split_by_barcodes", dest="split_by_barcodes", default='False')
+parser.add_option("-d", "--debug", dest="debug", default='False', help="keep the intermediate file of every step of every chunk (.sb, .pt, .qt, .lt)")
 (options, args) = parser.parse_args()
 
 if( not options.input_dir ):
@@ -81,6 +82,10 @@ except:
 
 primers_file = options.input_dir + '/' + summary_obj.attribute_value_16S['PRIMERS_FILE']
 barcodes_map = options.input_dir + '/' + summary_obj.attribute_value_16S['BARCODES_MAP']
+try:
+    index_file = options.input_dir + '/' + summary_obj.attribute_value_16S['INDEX_FILE']
+except:
+    index_file = ''
 
 # Construct output filenames from dataset ID
 fastq_trimmed_qual = working_directory + '/' + dataset_ID + '.raw_trimmed_qual.fastq'
@@ -94,6 +99,7 @@ OTU_sequences_table = working_directory + '/' + dataset_ID + '.otu_seqs.table'
 OTU_clustering_results = working_directory + '/' + dataset_ID + '.otu_clustering.tab'
 OTU_database = working_directory + '/' + dataset_ID + '.otu_database'
 OTU_table = working_directory + '/' + dataset_ID + '.otu_table'
+qc_profile = working_directory + '/' + dataset_ID + '.qc_profile.json'
 
 # Get ASCII encoding of FASTQ files
 try:
@@ -117,27 +123,21 @@ else:
 #       1. split fastq into chunks
 #       2. demultiplex (sort by barcodes), remove primers, and trim, and convert to fasta format
 #       3. recombine into a single fasta file before dereplicating
+# All parallel tasks run on one pool, created once (in the working directory, see Step 1.3).  Chunks move through their stages
+# independently (pipeline.run_stages): a chunk is processed as soon as it is read or decompressed, without waiting for the other chunks.
+cpu_count = mp.cpu_count()
 
-# Step 1.1 - get raw data filesize, then split into ~10Mb pieces (100000 lines) if smaller than 100 Mb, or into ~100Mb pieces (1000000 lines) otherwise.  Can optimize this eventually
-# to split according to the number of cpus.
+# Step 1.1 - get raw data filesize, and choose the chunk size from the file size and the number of CPUs (about 4 chunks per CPU, between
+# 1 Mb and 100 Mb, see chunker.chunk_size).
+# Compressed raw data (gzip, BGZF, zstd) is split directly, without decompressing it to disk first (~100 bytes per line).  Its uncompressed size is
+# estimated as 10x the compressed size (exact for BGZF).
+compression = util.get_compression(raw_data_file)
 rawfilesize = os.path.getsize(raw_data_file)
-
-# Step 1.1 - split file into 1000000 line (~100Mb) chunks
-os.chdir(working_directory)
-if(rawfilesize < 2e8):
-    os.system('split -l 100000 ' + raw_data_file)
-else:
-    os.system('split -l 1000000 ' + raw_data_file)
-
-# Step 1.2 - get split filenames
-split_filenames = []
-for c1 in ascii_lowercase:
-    for c2 in ascii_lowercase:
-        filename = 'x'+c1+c2
-        if(os.path.isfile(filename)):
-            split_filenames.append(filename)
-if len(split_filenames) == 0:
-    split_filenames = [raw_data_file]
+if compression == 'bgzf':
+    rawfilesize = sum([size for [offset, size] in util.bgzf_blocks(raw_data_file)])
+elif compression != '':
+    rawfilesize = 10*rawfilesize
+chunk_size = chunker.chunk_size(rawfilesize, cpu_count)
 
 # Check whether samples need to be split by barcodes and primers need to be removed
 if (options.split_by_barcodes == 'True' and options.primers_removed == 'True'):
@@ -145,98 +145,79 @@ if (options.split_by_barcodes == 'True' and options.primers_removed == 'True'):
     cmd_str = 'cp ' + raw_data_file + ' ' + fastq_trimmed_primers
     os.system(cmd_str)
 
-# Step 2 - loop through these split files and launch parallel threads as a function of the number of CPUs
-cpu_count = mp.cpu_count()
+# Step 1.2 - choose the quality cut-off once for the whole dataset from a random sample of the raw reads, so that all chunks are
+# trimmed consistently and the chunk workers skip the Q search
+if (raw_file_type == "FASTQ"):
+    quality_cutoff = OTU.choose_quality_cutoff(raw_data_file, ascii_encoding)
 
-# Step 2.1 - demultiplex, i.e. sort by barcode
+# Steps 2.1-2.5 run fused, one pass per chunk: demultiplex (sort by barcode), remove primers, trim with quality filter (FASTQ), trim to
+# uniform length of 101 and convert to FASTA format.  Reads stay in memory between the steps and only the final FASTA file of every chunk
+# is written, unless the intermediate files are requested with --debug True.
+length = 101
+barcodes_map_chunk = ''
+mode = ''
 if (options.split_by_barcodes == 'False'):
+    barcodes_map_chunk = barcodes_map
     mode = summary_obj.attribute_value_16S['BARCODES_MODE']
-    pool = mp.Pool(cpu_count)
-    filenames = split_filenames
-    newfilenames = [f + '.sb' for f in filenames]
-    barcodes_map_vect = [barcodes_map]*len(filenames)
-    mode_vect = [mode]*len(filenames)
-    pool.map(OTU.split_by_barcodes, zip(filenames, newfilenames, barcodes_map_vect, mode_vect))
-    pool.close()
-    pool.join()
-    split_filenames = [f + '.sb' for f in split_filenames] 
-
-
-# Step 2.2 - remove primers
+primers_file_chunk = ''
 if (options.primers_removed == 'False'):
-    pool = mp.Pool(cpu_count)
-    filenames = split_filenames
-    newfilenames = [f + '.pt' for f in filenames]
-    primers_vect = [primers_file]*len(filenames)
-    pool.map(OTU.remove_primers, zip(filenames, newfilenames, primers_vect))
-    pool.close()
-    pool.join()
-    split_filenames = [f + '.pt' for f in split_filenames] 
-
-
-# Step 2.3 - trim with quality filter
-if (raw_file_type == "FASTQ"):
-    pool = mp.Pool(cpu_count)
-    filenames = split_filenames
-    newfilenames = [f + '.qt' for f in filenames]
-    ascii_vect = [ascii_encoding]*len(filenames)
-    pool.map(OTU.trim_quality, zip(filenames, newfilenames, ascii_vect))
-    pool.close()
-    pool.join()
-    split_filenames = [f + '.qt' for f in split_filenames] 
-
-
-# Step 2.4 - trim to uniform length of 101
-length = 101
-pool = mp.Pool(cpu_count)
-filenames = split_filenames
-newfilenames = [f + '.lt' for f in filenames]
-length_vect = [length]*len(filenames)
-ascii_vect = [ascii_encoding]*len(filenames)
-    
+    primers_file_chunk = primers_file
 if (raw_file_type == "FASTQ"):
-    pool.map(OTU.trim_length_fastq, zip(filenames, newfilenames, length_vect, ascii_vect))
-    pool.close()
-    pool.join()
-    split_filenames = [f + '.lt' for f in split_filenames] 
+    Q = quality_cutoff
 else:
-    pool.map(OTU.trim_length_fasta, zip(filenames, newfilenames, length_vect))
-    pool.close()
-    pool.join()
-    split_filenames = [f + '.lt' for f in split_filenames] 
-
-
-# Step 2.5 - convert to FASTA format
-if (raw_file_type == "FASTQ"):
-    pool = mp.Pool(cpu_count)
-    filenames = split_filenames
-    newfilenames = [f + '.fasta' for f in filenames]
-    pool.map(frmt.fastq2fasta, zip(filenames, newfilenames))
-    pool.close()
-    pool.join()
-    split_filenames = [f + '.fasta' for f in split_filenames] 
-
-# Step 2.6 - renumber sequences IDs to be consistent across files
+    Q = 0
+def process_args(i, (f, start, end)):
+    # Arguments of OTU.process_chunk for chunk i, the byte range start..end-1 of file f (end None: whole file)
+    return (f, start, end, 'x%05d' %(i), raw_file_type.lower(), barcodes_map_chunk, mode, index_file, primers_file_chunk,
+            ascii_encoding, Q, length, options.debug == 'True')
+process_stage = ['process', OTU.process_chunk, process_args]
+
+# Step 2.6 (first phase) - count the reads of every sample in every chunk as soon as it is processed, for renumbering.  On a single CPU
+# the chunks are relabeled in one sequential pass instead, which needs no counts.
 try:
     separator = summary_obj.attribute_value_16S['BARCODES_SEPARATOR']
 except:
     separator = '_'
-OTU.renumber_sequences(split_filenames, separator)
-
-# Step 3 - Recombine into a single fasta file
-if len(split_filenames)>1:
-    cat_str = ['cat']
-    for filename in split_filenames:
-        cat_str.append(filename)
-    cat_str = ' '.join(cat_str)
-    cat_str = cat_str + ' > ' + fasta_trimmed    
-    # Recombine
-    os.system(cat_str)
+count_stage = ['count', OTU.count_samples, lambda i, profile: ('x%05d.fasta' %(i), separator)]
+chunk_stages = [process_stage]
+if cpu_count > 1:
+    chunk_stages.append(count_stage)
+
+# Step 1.3 - split file into chunks, as [filename, start, end] (end None: whole file), and run every chunk through its stages.
+# The pool is created after changing to the working directory, so that the workers read and write the chunk files ('x%05d', relative
+# paths) in the working directory, as the parent does.
+os.chdir(working_directory)
+pool = mp.Pool(cpu_count)
+if compression in ['', 'bgzf']:
+    # Plain and BGZF raw data is not copied: the chunks are record-aligned byte ranges of the raw file, which the workers read in
+    # place (BGZF: every worker decompresses its own range, from the block that holds its start).
+    chunks = [[raw_data_file, start, end] for [start, end] in chunker.record_ranges(raw_data_file, fmt=raw_file_type.lower(), chunk_size=chunk_size)]
+    results = pipeline.run_stages(pool, chunks, chunk_stages)
+else:
+    # gzip and zstd streams can only be decompressed sequentially; every chunk file is processed as soon as it is written, and
+    # removed once processed
+    split_lines = chunk_size/100
+    records_per_chunk = split_lines/4 if raw_file_type == 'FASTQ' else split_lines/2
+    chunks = ([f, 0, None] for f in chunker.iter_split_file(raw_data_file, fmt=raw_file_type.lower(), n_records=records_per_chunk))
+    results = pipeline.run_stages(pool, chunks, [['process', OTU.process_chunk_file, process_args]] + chunk_stages[1:])
+if len(results) == 0:
+    results = pipeline.run_stages(pool, [[raw_data_file, 0, None]], chunk_stages)
+split_filenames = ['x%05d.fasta' %(i) for i in range(len(results))]
+if (raw_file_type == "FASTQ"):
+    # Merge the QC profiles of the chunks (reads after demultiplexing and primer removal) into one profile for the dataset
+    qcprofile.merge([result[0] for result in results]).write(qc_profile)
+
+# Step 2.6 (second phase) and Step 3 - renumber sequences IDs to be consistent across files, and recombine into a single fasta file.
+# Every chunk is relabeled in parallel from the sample counts of the earlier chunks and written directly to its place in the combined file.
+if cpu_count > 1:
+    OTU.renumber_sequences(split_filenames, separator, fasta_trimmed, pool=pool, counts=[result[1] for result in results])
 else:
-    os.system('cp ' + split_filenames[0] + ' ' + fasta_trimmed)
+    OTU.renumber_sequences(split_filenames, separator, fasta_trimmed)
 
-# Dereplicate sequences into a list of uniques for clustering
-OTU.dereplicate_and_sort(fasta_trimmed, fasta_dereplicated, OTU_database, '_')
+# Dereplicate sequences into a list of uniques for clustering (map-reduce on the pool, one hash partition of the sequences per CPU)
+OTU.dereplicate_and_sort(fasta_trimmed, fasta_dereplicated, OTU_database, '_', pool=pool, n_parts=cpu_count)
+pool.close()
+pool.join()
 
 # Remove chimeras and cluster OTUs
 OTU.remove_chimeras_and_cluster_OTUs(fasta_dereplicated, OTU_sequences_fasta, OTU_sequences_table, OTU_clustering_results)
@@ -0,0 +1,190 @@
+"""
+
+OVERVIEW:
+
+Columnar representation of a batch of FASTA/FASTQ reads for vectorized per-read operations.
+
+A ReadBatch holds n reads as:
+    seqs     n x L uint8 matrix of base codes (ASCII), padded with 0
+    quals    n x L uint8 matrix of quality scores (ASCII - ascii_encoding), padded with 0 (FASTQ only)
+    lengths  int array of read lengths
+    ids      one string buffer with all read IDs (without '@' or '>') and an (n+1) array of offsets into it
+
+"""
+
+import numpy as np
+import util
+
+# Error probability for every quality score (lookup table for expected errors)
+PROB_TABLE = 10**(-np.arange(256)/10.0)
+
+
+class ReadBatch():
+
+    def __init__(self, seqs, quals, lengths, ids, id_offsets, ascii_encoding=33):
+        self.seqs = seqs
+        self.quals = quals # None for FASTA reads
+        self.lengths = lengths
+        self.ids = ids
+        self.id_offsets = id_offsets
+        self.ascii_encoding = ascii_encoding
+
+
+    def __len__(self):
+        return len(self.lengths)
+
+
+    def mask(self):
+        # Boolean matrix marking the valid (non-padding) positions of every read
+        return np.arange(self.seqs.shape[1])[np.newaxis, :] < self.lengths[:, np.newaxis]
+
+
+    def get_id(self, i):
+        return self.ids[self.id_offsets[i]:self.id_offsets[i+1]]
+
+
+    def get_seq(self, i):
+        return self.seqs[i, :self.lengths[i]].tostring()
+
+
+    def get_qual(self, i):
+        return (self.quals[i, :self.lengths[i]] + self.ascii_encoding).astype(np.uint8).tostring()
+
+
+    def subset(self, index):
+        # Return a new ReadBatch with the reads selected by index (boolean mask or integer array)
+        index = np.asarray(index)
+        if index.dtype == bool:
+            index = np.flatnonzero(index)
+        starts = self.id_offsets[index]
+        ends = self.id_offsets[index + 1]
+        ids = ''.join([self.ids[a:b] for a, b in zip(starts, ends)])
+        id_offsets = np.zeros(len(index) + 1, dtype=np.int64)
+        np.cumsum(ends - starts, out=id_offsets[1:])
+        quals = None
+        if self.quals is not None:
+            quals = self.quals[index]
+        return ReadBatch(self.seqs[index], quals, self.lengths[index], ids, id_offsets, self.ascii_encoding)
+
+
+    def truncate(self, lengths):
+        # Truncate every read to at most lengths (scalar or array); clears the padding
+        self.lengths = np.minimum(self.lengths, lengths)
+        mask = self.mask()
+        self.seqs[~mask] = 0
+        if self.quals is not None:
+            self.quals[~mask] = 0
+        return self
+
+
+    def trim_left(self, starts):
+        # Remove the first starts[i] positions of every read (scalar or array)
+        n, L = self.seqs.shape
+        starts = np.minimum(np.zeros(n, dtype=np.int64) + starts, self.lengths)
+        cols = np.arange(L)[np.newaxis, :] + starts[:, np.newaxis]
+        valid = cols < L
+        cols[~valid] = 0
+        rows = np.arange(n)[:, np.newaxis]
+        self.seqs = np.where(valid, self.seqs[rows, cols], 0).astype(np.uint8)
+        if self.quals is not None:
+            self.quals = np.where(valid, self.quals[rows, cols], 0).astype(np.uint8)
+        self.lengths = self.lengths - starts
+        return self.truncate(self.lengths)
+
+
+    def truncqual_lengths(self, Qs):
+        # Read lengths after truncating at the first position with quality <= Q (usearch -fastq_truncqual)
+        # Returns an n x len(Qs) array with one column per Q; qualities are scanned once for all Qs
+        quals = np.where(self.mask(), self.quals, 255)
+        cmin = np.minimum.accumulate(quals, axis=1)
+        lengths = np.array([(cmin > Q).sum(axis=1) for Q in Qs]).reshape(len(Qs), len(self)).T
+        return np.minimum(lengths, self.lengths[:, np.newaxis])
+
+
+    def expected_errors(self, length=None):
+        # Expected number of errors (sum of error probabilities) in the first length bases of every read
+        if length is None:
+            length = self.seqs.shape[1]
+        quals = self.quals[:, :length]
+        ee = PROB_TABLE[quals]
+        ee[~self.mask()[:, :length]] = 0
+        return ee.sum(axis=1)
+
+
+    def filter_length_ee(self, length, maxee):
+        # Boolean mask of reads with at least length bases and at most maxee expected errors in
+        # the first length bases (usearch -fastq_trunclen length -fastq_maxee maxee)
+        keep = self.lengths >= length
+        if self.quals is not None:
+            keep &= self.expected_errors(length) <= maxee
+        return keep
+
+
+    def to_records(self, fmt=None):
+        # Convert batch to a list of [sid, seq, '+', qual] (fastq) or [sid, seq] (fasta) records
+        if fmt is None:
+            fmt = 'fasta' if self.quals is None else 'fastq'
+        mask = self.mask()
+        offsets = np.zeros(len(self) + 1, dtype=np.int64)
+        np.cumsum(self.lengths, out=offsets[1:])
+        seqs = self.seqs[mask].tostring()
+        ids = self.ids
+        if fmt == 'fastq':
+            if self.quals is None:
+                util.error('Error: cannot write FASTA reads as FASTQ')
+            quals = (self.quals[mask] + self.ascii_encoding).astype(np.uint8).tostring()
+            return [['@' + ids[self.id_offsets[i]:self.id_offsets[i+1]], seqs[offsets[i]:offsets[i+1]], '+', quals[offsets[i]:offsets[i+1]]] for i in xrange(len(self))]
+        elif fmt == 'fasta':
+            return [['>' + ids[self.id_offsets[i]:self.id_offsets[i+1]], seqs[offsets[i]:offsets[i+1]]] for i in xrange(len(self))]
+        else:
+            util.error('Error: unrecognized format "%s"' %(fmt))
+
+
+    def write(self, out, fmt=None):
+        # Write batch to an open file as FASTQ or FASTA
+        records = self.to_records(fmt=fmt)
+        if records:
+            out.write('\n'.join(['\n'.join(record) for record in records]) + '\n')
+        return self
+
+
+def encode_seqs(seqs):
+    # Encode a list of sequences as [n x L uint8 matrix of base codes padded with 0, array of lengths]
+    lengths = np.array([len(seq) for seq in seqs], dtype=np.int64)
+    L = int(lengths.max()) if len(seqs) > 0 else 0
+    mask = np.arange(L)[np.newaxis, :] < lengths[:, np.newaxis]
+    x = np.zeros((len(seqs), L), dtype=np.uint8)
+    x[mask] = np.frombuffer(''.join(seqs), dtype=np.uint8)
+    return [x, lengths]
+
+
+def from_records(records, ascii_encoding=33):
+    # Build a ReadBatch from [sid, seq] (util.iter_fst) or [sid, seq, plus, qual] (util.iter_fsq) records
+    n = len(records)
+    ids = ''.join([record[0][1:] for record in records])
+    id_offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum([len(record[0]) - 1 for record in records], out=id_offsets[1:])
+    [seqs, lengths] = encode_seqs([record[1] for record in records])
+    mask = np.arange(seqs.shape[1])[np.newaxis, :] < lengths[:, np.newaxis]
+    quals = None
+    if n > 0 and len(records[0]) > 2:
+        qual = np.frombuffer(''.join([record[3] for record in records]), dtype=np.uint8)
+        if len(qual) != mask.sum():
+            util.error('Error: sequence and quality lengths differ')
+        if len(qual) > 0 and qual.min() < ascii_encoding:
+            util.error('Error: quality score below ASCII offset %d' %(ascii_encoding))
+        quals = np.zeros(seqs.shape, dtype=np.uint8)
+        quals[mask] = qual - ascii_encoding
+    return ReadBatch(seqs, quals, lengths, ids, id_offsets, ascii_encoding)
+
+
+def iter_batches(fn, fmt='fastq', n=util.FSQ_BATCH_SIZE, ascii_encoding=33):
+    # generator that iterates through a FASTA/FASTQ file in ReadBatches of n reads
+    if fmt == 'fastq':
+        iter_batch = util.iter_fsq_batches
+    elif fmt == 'fasta':
+        iter_batch = util.iter_fst_batches
+    else:
+        util.error('Error: unrecognized format "%s"' %(fmt))
+    for records in iter_batch(fn, n=n):
+        yield from_records(records, ascii_encoding=ascii_encoding)
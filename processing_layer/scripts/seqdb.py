@@ -1,43 +1,191 @@
-from bidict import *
-import os.path, os
+"""
+
+OVERVIEW:
+
+Database of OTU sequences (OTU id <-> sequence, and OTU id -> size), stored as a fasta file with '>otu;size=N' headers.
+
+The sequences are kept once, in one byte arena (bytearray), and found by their 64-bit hash (hash(seq)) in a
+{hash: otu} dict; a hit is checked against the arena, and the rare sequences whose hash is already taken by another
+sequence are indexed by the sequence itself.  OTU ids come from a counter (the next id after the largest one), so adding a
+sequence is O(1), and the arena offsets, lengths and sizes are flat arrays indexed by OTU id.  SeqIndex supports the bidict
+operations used on SeqDB.db (db[otu], db[:seq], seq in ~db, iteration over OTU ids in increasing order).
+
+"""
+
+import array, os.path, os
 import re, sys, util
 
+class SeqIndex():
+	# OTU id <-> sequence, with the bidict interface of SeqDB.db
+	
+	def __init__(self):
+		self.arena = bytearray() # all the sequences, concatenated
+		self.offsets = array.array('l') # otu -> start of its sequence in arena
+		self.lengths = array.array('l') # otu -> length of its sequence (-1 if no such OTU)
+		self.index = {} # hash(seq) -> otu
+		self.collisions = {} # seq -> otu, for the sequences whose hash is already used by another sequence
+		self.n = 0 # number of OTUs
+		self.next_otu = 1 # next OTU id (after the largest one)
+	
+	
+	def __len__(self):
+		return self.n
+	
+	
+	def __contains__(self, otu):
+		return 0 <= otu < len(self.lengths) and self.lengths[otu] >= 0
+	
+	
+	def __iter__(self):
+		# OTU ids in increasing order
+		lengths = self.lengths
+		return (otu for otu in xrange(len(lengths)) if lengths[otu] >= 0)
+	
+	
+	def iteritems(self):
+		for otu in self:
+			yield otu, self.seq(otu)
+	
+	
+	def __eq__(self, x):
+		return len(self) == len(x) and all(a == b for a, b in zip(self.iteritems(), x.iteritems()))
+	
+	
+	def __ne__(self, x):
+		return not self == x
+	
+	
+	def __invert__(self):
+		# Sequence -> OTU view (~bidict)
+		return SeqIndexInverse(self)
+	
+	
+	def seq(self, otu):
+		# Sequence of OTU otu
+		if otu not in self:
+			raise KeyError(otu)
+		start = self.offsets[otu]
+		return str(self.arena[start:start + self.lengths[otu]])
+	
+	
+	def find(self, seq):
+		# OTU id of sequence seq (None if not in the index)
+		otu = self.index.get(hash(seq))
+		if otu is not None and self.lengths[otu] == len(seq) and self.arena[self.offsets[otu]:self.offsets[otu] + len(seq)] == seq:
+			return otu
+		if self.collisions:
+			return self.collisions.get(seq)
+		return None
+	
+	
+	def __getitem__(self, key):
+		# db[otu] -> sequence, db[:seq] -> OTU id
+		if isinstance(key, slice):
+			otu = self.find(key.stop)
+			if otu is None:
+				raise KeyError(key.stop)
+			return otu
+		return self.seq(key)
+	
+	
+	def __setitem__(self, otu, seq):
+		# Map otu to seq (replacing the previous sequence of otu and the previous OTU of seq, as bidict)
+		if otu in self:
+			del self[otu]
+		old = self.find(seq)
+		if old is not None:
+			del self[old]
+		if otu >= len(self.lengths):
+			n = otu + 1 - len(self.lengths)
+			self.offsets.extend([0]*n)
+			self.lengths.extend([-1]*n)
+		self.offsets[otu] = len(self.arena)
+		self.lengths[otu] = len(seq)
+		self.arena.extend(seq)
+		h = hash(seq)
+		if h not in self.index:
+			self.index[h] = otu
+		else:
+			self.collisions[seq] = otu
+		self.n += 1
+		self.next_otu = max(self.next_otu, otu + 1)
+	
+	
+	def __delitem__(self, otu):
+		# Remove otu (its sequence stays in the arena)
+		seq = self.seq(otu)
+		h = hash(seq)
+		if self.index.get(h) == otu:
+			del self.index[h]
+		else:
+			del self.collisions[seq]
+		self.lengths[otu] = -1
+		self.n -= 1
+
+
+class SeqIndexInverse():
+	# Sequence -> OTU view of a SeqIndex (~bidict)
+	
+	def __init__(self, x):
+		self.x = x
+	
+	
+	def __len__(self):
+		return len(self.x)
+	
+	
+	def __contains__(self, seq):
+		return self.x.find(seq) is not None
+	
+	
+	def __getitem__(self, seq):
+		return self.x[:seq]
+	
+	
+	def __iter__(self):
+		for otu, seq in self.x.iteritems():
+			yield seq
+
+
 class SeqDB():
 	
 	def __init__(self, fn):
 
 		# Initialize attributes
 		self.fn = fn # db filename
-		self.db = bidict({}) # otu <-> seq
-		self.size = {} # otu -> size
+		self.db = SeqIndex() # otu <-> seq
+		self.size = array.array('l') # otu -> size
 		
 		# Load sequence database
 		self = self.load_db()
 	
 	
+	def set_size(self, otu, size):
+		# Set size of OTU (growing the size array)
+		if otu >= len(self.size):
+			self.size.extend([0]*(otu + 1 - len(self.size)))
+		self.size[otu] = size
+	
+	
 	def load_db(self):
 		# Load existing SeqDB (if exists)
 		if os.path.exists(self.fn):
 			for tag, seq in util.iter_fst(self.fn):
 				otu, size = re.search('>(.*);size=(\d+)', tag).groups()
 				self.db[int(otu)] = seq
-				self.size[int(otu)] = int(size)
+				self.set_size(int(otu), int(size))
 		return self
 	
 	
 	def add_seq(self, seq, size=1):
 		# Add new sequence to SeqDB
-		if seq not in ~self.db:
-			# If SeqDB is empty, set OTU = 1
-			if len(self.db) == 0:
-				otu = 1
-			# Otherwise, increment to get next OTU
-			else:
-				otu = max(self.db) + 1
+		otu = self.db.find(seq)
+		if otu is None:
+			# Next OTU id from the counter (1 if SeqDB is empty)
+			otu = self.db.next_otu
 			self.db[otu] = seq
-			self.size[otu] = size
+			self.set_size(otu, size)
 		else:
-			otu = self.db[:seq]
 			self.size[otu] += size
 		return otu
 	
@@ -72,10 +220,9 @@ class SeqDB():
 	def get_otu(self, seq, size=1):
 		# Get OTU id associated with sequence
 		# If sequence in SeqDB, get OTU id
-		if seq in ~self.db:
-			otu = self.db[:seq]
+		otu = self.db.find(seq)
 		# Otherwise, create new SeqDB entry
-		else:
+		if otu is None:
 			otu = self.add_seq(seq, size=size)
 		# Return OTU id
 		return otu
@@ -86,7 +233,7 @@ class SeqDB():
 		# ERROR : Identical sequences will double size
 		
 		# Trim sequences in SeqDB to length l
-		for otu in self.db:
+		for otu in list(self.db):
 			seq = self.db[otu]
 			size = self.size[otu]
 			new_seq = seq[:l]
@@ -96,6 +243,7 @@ class SeqDB():
 				if len(seq) != l:
 					del self.db[otu]
 		return self
+
 	
 	
 	def validate(self, fn):
@@ -0,0 +1,59 @@
+"""
+
+OVERVIEW:
+
+Count-min sketch of sequence counts, used to skip the sequences that cannot reach the minimum size before dereplication
+(stages.dereplicate_and_write with prefilter=True).
+
+The sketch is a depth x width table of counters.  A sequence is counted in one cell per row, chosen from its 64-bit hash
+(hash(seq)) by double hashing, and its estimated count is the smallest of these cells.  Other sequences falling in the same
+cells can only add to them, so the estimate is never below the true count: every sequence with at least min_size reads has
+an estimate of at least min_size, and only a few rarer sequences get through with it.  Reads are added and looked up in
+batches with NumPy.
+
+"""
+
+import numpy as np
+
+DEPTH = 4 # rows of the sketch
+MIN_WIDTH = 1 << 16 # smallest number of counters per row
+
+
+class CountMinSketch():
+
+    def __init__(self, width, depth=DEPTH):
+        # width is rounded up to a power of 2
+        self.width = MIN_WIDTH
+        while self.width < width:
+            self.width <<= 1
+        self.depth = depth
+        self.table = np.zeros((depth, self.width), dtype=np.uint32)
+
+
+    def cells(self, seqs):
+        # Counter of every sequence in every row (depth x n array)
+        h = np.array([hash(seq) for seq in seqs], dtype=np.int64).view(np.uint64)
+        h1 = h & np.uint64(0xffffffff)
+        h2 = (h >> np.uint64(32)) | np.uint64(1)
+        mask = np.uint64(self.width - 1)
+        return np.array([(h1 + np.uint64(k)*h2) & mask for k in range(self.depth)], dtype=np.int64).reshape(self.depth, len(seqs))
+
+
+    def add(self, seqs):
+        # Count one read of every sequence
+        # np.bincount adds repeated cells (no np.add.at or minlength in NumPy 1.5, see setup_proc_ami.sh)
+        cells = self.cells(seqs)
+        for k in range(self.depth):
+            counts = np.bincount(cells[k])
+            self.table[k][:len(counts)] += counts.astype(self.table.dtype)
+
+
+    def estimate(self, seqs):
+        # Estimated count of every sequence (never below the true count)
+        cells = self.cells(seqs)
+        return np.min([self.table[k][cells[k]] for k in range(self.depth)], axis=0)
+
+
+    def memory(self):
+        # Size of the table (bytes)
+        return self.table.nbytes
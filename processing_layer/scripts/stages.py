@@ -0,0 +1,920 @@
+"""
+
+OVERVIEW:
+
+In-process API for the sequence processing steps 1-4 (1.remove_primers.py, 2.split_by_barcodes.py, 3.dereplicate.py and
+4.derep2counts.py).  The command line scripts are thin wrappers around these functions, and the raw2otu.py pool workers
+call them directly instead of starting a new python interpreter for every chunk of every step.
+
+Primer lists, barcode maps and the primer/barcode matchers compiled from them are cached per process (see compiled), so a
+pool worker builds them once and reuses them for every chunk it processes.
+
+"""
+
+import cPickle, heapq, itertools, os, zlib
+import numpy as np
+import chunker, derepstore, primer, primermatch, readbatch, seqdb, sketch, util
+from string import maketrans
+
+compiled = {} # per-process cache of primer lists, barcode maps and compiled matchers
+SKETCH_FILE_BYTES = 1024 # bytes of input per count-min sketch counter (about 4 reads of 250 bp)
+RECORD_BYTES = 200 # approximate memory per (size, OTU, seq) record kept before it is written to a sorted run (besides the sequence)
+
+
+# Step 1 - remove primers
+
+def read_primers(primers_fn):
+    # Read a primer list (one primer per line)
+    key = ('primer list', primers_fn)
+    if key not in compiled:
+        compiled[key] = [line.rstrip() for line in open(primers_fn)]
+    return compiled[key]
+
+
+def primer_mismatches(seq, p, w):
+    # Calculate the number of mismatches between a sequence and a primer
+    # Searches in a sliding window from 0:w
+    best_i = 0 # index of best match
+    best_d = len(seq) # edit distance of best match
+    # for every start position
+    for i in range(w):
+        # calculate edit distance to the given primer
+        d = primer.MatchPrefix(seq[i:], p)
+        # keep track of the best match
+        if d < best_d:
+            best_i = i
+            best_d = d
+    # Return the index and edit distance of the best match
+    return [best_i, best_d]
+
+
+def find_best_primer(seq, primers, w, max_dist):
+    # For a given sequence, find the best matching primer
+    # If edit distance > max_dist, return empty match
+    best_i = '' # index of best match
+    best_p = '' # best matching primer
+    best_d = len(seq) # edit distance of best match
+    # Calculate edit distance to every primer
+    for p in primers:
+        [i,d] = primer_mismatches(seq, p, w) # get index and edit distance
+        if d < best_d:
+            best_i = i
+            best_p = p
+            best_d = d
+    # Return [index, edit distance, primer] of best match
+    if best_d <= max_dist:
+        return [best_i, best_d, best_p]
+    else:
+        return ['', '', '']
+
+
+def compile_primers(primers, w=10, max_dist=1, indels=False):
+    # Compile primers into [prefix index, matcher, prefix length] (same matches as find_best_primer, computed for a whole batch of reads)
+    # With indels, reads with an exact primer match in the search window are found in the prefix index (fast path), and all
+    # other reads are scanned with the matcher (full scan).  Without indels, the full scan of all reads is as fast as the
+    # prefix index (benchmark.py --test primers), and the index is None.
+    # Only the first prefix length bases of every read are compared
+    key = ('primers', tuple(primers), w, max_dist, indels)
+    if key not in compiled:
+        m = max([len(p) for p in primers])
+        if indels:
+            matcher = primermatch.EditMatcher(primers, w, max_dist)
+            index = primermatch.PrefixIndex(primers, w + max_dist)
+            compiled[key] = [index, matcher, w + max_dist - 1 + m]
+        else:
+            matcher = primermatch.PrimerMatcher(primers, w, max_dist)
+            compiled[key] = [None, matcher, w - 1 + m]
+    return compiled[key]
+
+
+def trim_primers(records, primers, w=10, max_dist=1, indels=False):
+    # Remove the best matching primer from a batch of FASTA/FASTQ records
+    # Returns [trimmed records of the reads with a primer match, number of reads matched by the prefix index (0 without indels)]
+    [index, matcher, n] = compile_primers(primers, w=w, max_dist=max_dist, indels=indels)
+    [seqs, lengths] = readbatch.encode_seqs([record[1][:n] for record in records])
+    
+    # Fast path: exact primer matches
+    ends = np.zeros(len(records), dtype=np.int64) - 1
+    miss = np.arange(len(records))
+    if index is not None:
+        [I, K] = index.match(seqs, lengths)
+        primer_lengths = np.array([len(p) for p in primers], dtype=np.int64)
+        ends = np.where(K >= 0, I + primer_lengths[K], -1)
+        miss = np.flatnonzero(K < 0)
+    
+    # Full scan of the remaining reads
+    [E, D, K] = matcher.match_ends(seqs[miss], lengths[miss])
+    ends[miss] = E
+    
+    # Trim reads
+    trimmed = []
+    for r in np.flatnonzero(ends >= 0):
+        record = list(records[r])
+        start = ends[r]
+        record[1] = record[1][start:]
+        if len(record) > 2:
+            record[3] = record[3][start:]
+        trimmed.append(record)
+    return [trimmed, len(records) - len(miss)]
+
+
+def remove_primers(fn, out_fn, primers, fmt='fastq', w=10, max_dist=1, indels=False):
+    # Remove primers from the beginning of every sequence in a FASTA/FASTQ file (1.remove_primers.py)
+    # Reads without a primer match are discarded
+    # Returns [number of reads, number of reads matched by the prefix index, number of reads written (0 without indels)]
+    if fmt == 'fasta':
+        iter_batches = util.iter_fst_batches
+    else:
+        iter_batches = util.iter_fsq_batches
+    n_seqs = 0
+    n_fast = 0
+    n_keep = 0
+    out = open(out_fn, 'w')
+    for records in iter_batches(fn):
+        [trimmed, n] = trim_primers(records, primers, w=w, max_dist=max_dist, indels=indels)
+        n_seqs += len(records)
+        n_fast += n
+        n_keep += len(trimmed)
+        for record in trimmed:
+            out.write('\n'.join(record) + '\n')
+    out.close()
+    return [n_seqs, n_fast, n_keep]
+
+
+# Step 2 - split by barcodes
+
+rctab = maketrans('ACGTacgt','TGCAtgca')
+def reverse_complement(x):
+    # Reverse complement a sequence
+    return x[::-1].translate(rctab)
+
+
+def parse_barcodes_file(map_fn, format='fasta', rc=False):
+    # Map barcodes to samples
+    b2s = {} # maps barcodes to samples
+    # Case 1: barcodes file is FASTA format
+    if format == 'fasta':
+        for [s,b] in util.iter_fst(map_fn):
+            if rc == True:
+                seq = reverse_complement(s)
+            b2s[b] = s
+    # Case 2: barcodes file is tab-delimited
+    elif format == 'tab':
+        with open(map_fn) as fid:
+            all_lines = fid.readlines()
+        for line in open(map_fn):
+            [s,b] = line.rstrip().split()
+            if rc == True:
+                b = reverse_complement(b)
+            b2s[b] = s
+    # Return map of barcodes to samples
+    return b2s
+
+
+def iter_index(index_fn, format='fasta'):
+    # generator that iterates through the [seqid, barcode] pairs of an index file, in file order
+    # Case 1: index file is FASTA format
+    if format=='fasta':
+        for [s,b] in util.iter_fst(index_fn):
+            yield [s[1:], b]
+    # Case 2: index file is tab-delimited
+    elif format=='tab':
+        for line in util.open_file(index_fn):
+            [s,b] = line.rstrip().split()
+            yield [s, b]
+
+
+def parse_index_file(index_fn, format='fasta'):
+    # Map FASTQ sequences to their barcodes
+    s2b = {} # maps sequences to barcodes
+    for [s,b] in iter_index(index_fn, format=format):
+        s2b[s] = b
+    return s2b
+
+
+class IndexJoin():
+    # Looks up the barcodes of the reads in a FASTA/FASTQ file in an index file, without loading the whole index
+    # order = 'same': the index file lists the reads in the same order as the reads file (extra entries are skipped),
+    #                 so it is read in step with the reads file
+    # order = 'any':  only the index entries of the reads in reads_fn (e.g. one chunk) are loaded
+    # order = 'auto': read in step with the reads file, switching to 'any' at the first read not found ahead in the index
+
+    def __init__(self, index_fn, reads_fn, iter_batches, format='fasta', order='auto'):
+        self.index_fn = index_fn
+        self.reads_fn = reads_fn
+        self.iter_batches = iter_batches
+        self.format = format
+        self.order = order
+        self.index = iter_index(index_fn, format=format)
+        self.s2b = None # index entries of the reads in reads_fn (loaded on demand)
+
+
+    def load_range(self):
+        # Load the index entries of the reads in reads_fn only
+        sids = set([record[0][1:] for records in self.iter_batches(self.reads_fn) for record in records])
+        self.s2b = {}
+        for [s,b] in iter_index(self.index_fn, format=self.format):
+            if s in sids:
+                self.s2b[s] = b
+
+
+    def get(self, sid):
+        # Get the barcode of read sid (reads must be looked up in file order)
+        if self.s2b is None and self.order != 'any':
+            for [s,b] in self.index:
+                if s == sid:
+                    return b
+            if self.order == 'same':
+                util.error('Error: read %s not found in index file (or index file not in the same order as the reads)' %(sid))
+        if self.s2b is None:
+            self.load_range()
+        if sid not in self.s2b:
+            util.error('Error: read %s not found in index file' %(sid))
+        return self.s2b[sid]
+
+
+def extract_barcode_from_id(line):
+    # for this type of fasta line:
+    # @MISEQ:1:1101:14187:1716#ATAGGTGG/1
+    bcode = line.split('#')[-1].split('/')[0]
+    return bcode
+
+
+def read_barcodes(map_fn, format='fasta', rc=False):
+    # Map barcodes to samples (parse_barcodes_file, cached per process)
+    key = ('barcodes file', map_fn, format, rc)
+    if key not in compiled:
+        compiled[key] = parse_barcodes_file(map_fn, format=format, rc=rc)
+    return compiled[key]
+
+
+def barcode_mismatches(seq, subseq, w):
+    # Calculate the number of mismatches between a sequence and a given subsequence
+    # Searches in a sliding window that starts at position 1 and ends at position w
+    best_i = 0 # index (start position)
+    best_d = len(seq) # edit distance
+    # for every start position
+    for i in range(w):
+        # calculate edit distance to the given subsequence
+        if len(seq[i:]) < len(subseq):
+            continue
+        d = primer.MatchPrefix(seq[i:], subseq)
+        # keep track of the best index and edit distance
+        if d < best_d:
+            best_i = i
+            best_d = d
+    return [best_i, best_d]
+
+
+def find_best_barcode(seq, b2s, w, max_diff):
+    # Find the sample with the best matching barcode
+    best_i = ''
+    best_b = '' # barcode
+    best_d = len(seq) # edit distance
+    # Calculate edit distance to every barcode
+    for b in b2s:
+        [i,d] = barcode_mismatches(seq, b, w) # index, edit distance
+        if d < best_d:
+            best_i = i
+            best_b = b
+            best_d = d
+    # Return [index, edit distance, barcode, sample id] of best match
+    if best_d <= max_diff:
+        return [best_i, best_d, best_b, b2s[best_b]]
+    else:
+        return ['', '', '', '']
+
+
+def match_barcodes(seqs, b2s, w, matcher):
+    # Find the best matching barcode for a list of sequences
+    # matcher is a primermatch.BarcodeIndex (mismatches) or primermatch.EditMatcher (indels) over the barcodes in b2s
+    # Returns [end position of barcode, edit distance, barcode, sample id] for every sequence (as find_best_barcode)
+    # Sequences equally close to two barcodes are ambiguous and get sample id None
+    matches = []
+    if isinstance(matcher, primermatch.BarcodeIndex):
+        for seq in seqs:
+            hit = matcher.lookup(seq, w)
+            if hit is None:
+                matches.append(['', '', '', ''])
+            elif hit[2] is None:
+                matches.append([hit[0], hit[1], '', None])
+            else:
+                matches.append([hit[0], hit[1], hit[2], b2s[hit[2]]])
+        return matches
+    [x, lengths] = readbatch.encode_seqs(seqs)
+    [E, D, K] = matcher.match_ends(x, lengths)
+    for r in range(len(seqs)):
+        if K[r] >= 0:
+            b = matcher.primers[K[r]]
+            matches.append([E[r], D[r], b, b2s[b]])
+        else:
+            matches.append(['', '', '', ''])
+    return matches
+
+
+def print_collisions(pairs, b2s, max_diff, max_pairs=20):
+    # Report the barcode pairs that are too close to be told apart at max_diff mismatches (closest max_pairs pairs)
+    if not pairs:
+        return
+    print 'Warning: %d barcode pairs are within %d mismatches (reads equally close to both are not assigned):' %(len(pairs), 2*max_diff)
+    for [b1, b2, d] in sorted(pairs, key=lambda x: x[2])[:max_pairs]:
+        print '  %s (%s)\t%s (%s)\t%d mismatches' %(b1, b2s[b1], b2, b2s[b2], d)
+    if len(pairs) > max_pairs:
+        print '  ... %d more' %(len(pairs) - max_pairs)
+
+
+def compile_barcodes(b2s, w=5, max_diff=0, indels=False):
+    # Compile barcodes: mismatch neighborhood index, or edit distance matcher (cached per process)
+    # The barcode pairs that are too close for max_diff are reported once, when the index is built
+    key = ('barcodes', tuple(sorted(b2s.items())), w, max_diff, indels)
+    if key not in compiled:
+        if indels:
+            compiled[key] = primermatch.EditMatcher(list(b2s), w, max_diff)
+        else:
+            compiled[key] = primermatch.BarcodeIndex(list(b2s), max_diff)
+            print_collisions(compiled[key].collisions(), b2s, max_diff)
+    return compiled[key]
+
+
+def demultiplex(records, b2s, mode, matcher, w=5, index=None, s2c=None):
+    # Map a batch of FASTA/FASTQ records to samples by finding the best matching barcodes
+    # Barcodes are in [1] seqids, [2] seqs (trimmed from the reads), [3] index (IndexJoin)
+    # Assigned records get new sequence ids of the form: sample_count, counted in s2c
+    # Returns [assigned records, number of ambiguous reads]
+    if s2c is None:
+        s2c = {}
+    records = [list(record) for record in records]
+    
+    # Case 1: barcodes are in the sample IDs
+    if mode == 1:
+        # Extract barcodes from sequence ids
+        seqs = [extract_barcode_from_id(record[0]) for record in records]
+    
+    # Case 2: barcodes are in the sequences
+    elif mode == 2:
+        # Search sequences for best barcode
+        seqs = [record[1] for record in records]
+    
+    # Case 3: barcodes are in index file
+    elif mode == 3:
+        # Get barcodes from index file
+        seqs = [index.get(record[0][1:]) for record in records]
+    
+    # Find best matching samples
+    matches = match_barcodes(seqs, b2s, w, matcher)
+    assigned = []
+    n_ambiguous = 0
+    
+    for record, [i,d,b,s] in zip(records, matches):
+        
+        # Trim barcode from sequence
+        if mode == 2 and i != '':
+            record[1] = record[1][i:]
+            if len(record) > 2:
+                record[3] = record[3][i:]
+        
+        # If sample found, replace seqid with new seqid
+        if s is None:
+            n_ambiguous += 1
+        elif s:
+            s2c[s] = s2c.get(s, 0) + 1 # Increment sample count
+            record[0] = '@%s_%d' %(s, s2c[s])
+            assigned.append(record)
+    return [assigned, n_ambiguous]
+
+
+def split_by_barcodes(fn, out_fn, b2s, mode, fmt='fastq', w=5, max_diff=0, indels=False, index_fn='', index_format='fasta', index_order='auto'):
+    # Maps FASTA/FASTQ sequences to samples by finding the best matching barcodes (2.split_by_barcodes.py)
+    # Barcodes are in [1] seqids, [2] seqs (trimmed from the reads), [3] index file
+    # Create new sequence ids of the form: sample_count, for compatibility with QIIME etc.
+    # Returns [number of reads, sample counts, number of ambiguous reads]
+    s2c = {} # count number for a given sample
+    matcher = compile_barcodes(b2s, w=w, max_diff=max_diff, indels=indels)
+    n_seqs = 0
+    n_ambiguous = 0
+    
+    # Get FASTA, FASTQ batch iterators
+    if fmt == 'fasta':
+        iter_batches = util.iter_fst_batches
+    else:
+        iter_batches = util.iter_fsq_batches
+    
+    # Index file is read in step with the reads (or only the entries of these reads are loaded)
+    index = None
+    if mode == 3:
+        index = IndexJoin(index_fn, fn, iter_batches, format=index_format, order=index_order) # seqids to barcodes
+    
+    # For every batch of records in FASTA/FASTQ file...
+    out = open(out_fn, 'w')
+    for records in iter_batches(fn):
+        [assigned, n] = demultiplex(records, b2s, mode, matcher, w=w, index=index, s2c=s2c)
+        n_seqs += len(records)
+        n_ambiguous += n
+        for record in assigned:
+            out.write('\n'.join(record) + '\n')
+    out.close()
+    return [n_seqs, s2c, n_ambiguous]
+
+
+# Step 3 - dereplicate
+
+def iter_dereplicate_batches(fst='', fsq='', sep='', trim_len=''):
+    # Yields [seqs, samples] for every batch of reads to dereplicate (trimmed to trim_len, shorter reads are dropped)
+    # NOTE:
+    #      Separator for barcodes must be specified in summary file. 
+    #      e.g. 'SRR230982_142' the separator is '_'
+    #      
+    if fst:
+        fn = fst
+        iter_batches = util.iter_fst_batches
+    if fsq:
+        fn = fsq
+        iter_batches = util.iter_fsq_batches
+
+    for records in iter_batches(fn, n=derepstore.BATCH_SIZE): # the reads a DerepStore adds at once
+        if trim_len:
+            records = [record for record in records if len(record[1]) >= trim_len]
+            seqs = [record[1][:trim_len] for record in records]
+        else:
+            seqs = [record[1] for record in records]
+        samples = [record[0][1:].rpartition(sep)[0] for record in records] # same as sep.join(sid.split(sep)[:-1])
+        yield [seqs, samples]
+
+
+def dereplicate(fst='', fsq='', sep='', trim_len=''):
+    # Dereplicate sequences
+    # Returns a derepstore.DerepStore (iterates as the {seq: {sample: count}} dict)
+    x = derepstore.DerepStore()
+    for [seqs, samples] in iter_dereplicate_batches(fst=fst, fsq=fsq, sep=sep, trim_len=trim_len):
+        x.add_batch(seqs, samples)
+    return x
+
+
+def dereplicate_part((fn, i, start, end, sep, trim_len, out_prefix, n_parts)):
+    # Map step of dereplicate_parallel: dereplicate the records in bytes start..end-1 (range i) of a FASTA file
+    # Partial map: {seq: [position, {sample: count}, [samples in order of first occurrence]]}, where position is the
+    # (range, record index) of the first occurrence of seq.  Sequences are hash-partitioned into n_parts partial maps,
+    # written to out_prefix.<part> (pickle)
+    # Returns [filenames, memory]: the partial map filenames and the approximate memory of a DerepStore holding them
+    x = {}
+    for j, [sid, seq] in enumerate(util.iter_fst(fn, start=start, end=end)):
+        sa = sid[1:].rpartition(sep)[0] # as in dereplicate
+        if trim_len:
+            if len(seq) >= trim_len:
+                seq = seq[:trim_len]
+            else:
+                continue
+        if seq not in x:
+            x[seq] = [(i, j), {sa: 1}, [sa]]
+            continue
+        counts = x[seq][1]
+        if sa in counts:
+            counts[sa] += 1
+        else:
+            counts[sa] = 1
+            x[seq][2].append(sa)
+    parts = [{} for p in range(n_parts)]
+    for seq in x:
+        parts[(zlib.crc32(seq) & 0xffffffff) % n_parts][seq] = x[seq]
+    filenames = []
+    for p, part in enumerate(parts):
+        filenames.append('%s.%d' %(out_prefix, p))
+        with open(filenames[-1], 'wb') as out:
+            cPickle.dump(part, out, 2)
+    return [filenames, partial_memory(x)]
+
+
+def partial_memory(x):
+    # Approximate memory (bytes) of a DerepStore holding the partial map x, with its sequences unpacked (DerepStore.memory)
+    m = 0
+    for seq in x:
+        n_samples = len(x[seq][2])
+        m += len(seq) + len(seq)/4 + derepstore.SEQ_BYTES + derepstore.STR_BYTES
+        if n_samples > 1:
+            m += derepstore.CELL_BYTES*(n_samples - 1)
+    return m
+
+
+def merge_partial(x, part):
+    # Merge the partial map part (of a later range) into the partial map x
+    for seq in part:
+        if seq not in x:
+            x[seq] = part[seq]
+            continue
+        [pos, counts, samples] = x[seq]
+        for sa in part[seq][2]:
+            if sa in counts:
+                counts[sa] += part[seq][1][sa]
+            else:
+                counts[sa] = part[seq][1][sa]
+                samples.append(sa)
+
+
+def merge_dereplicated(filenames):
+    # Reduce step of dereplicate_parallel: merge the partial maps of one partition (in range order) and delete them
+    # Returns [position, seq, [[sample, count], ...]] for every sequence, sorted by position, with samples in order of first occurrence
+    x = {}
+    for fn in filenames:
+        with open(fn, 'rb') as fid:
+            part = cPickle.load(fid)
+        os.remove(fn)
+        merge_partial(x, part)
+    merged = [[pos, seq, [[sa, counts[sa]] for sa in samples]] for seq, [pos, counts, samples] in x.iteritems()]
+    merged.sort()
+    return merged
+
+
+def spill_merged_dereplicated((filenames, memory, run_prefix)):
+    # Out-of-core reduce step of dereplicate_parallel_and_write: merge the partial maps of one partition (in range order) and
+    # delete them, writing the merged map to a run sorted by sequence (as spill_dereplicated) and emptying it whenever it
+    # outgrows memory bytes
+    # Returns the run filenames, in order
+    x = {}
+    m = 0
+    runs = []
+    for fn in filenames:
+        with open(fn, 'rb') as fid:
+            part = cPickle.load(fid)
+        os.remove(fn)
+        merge_partial(x, part)
+        m += partial_memory(part)
+        if m > memory:
+            runs.append(write_run(((seq, [[sa, x[seq][1][sa]] for sa in x[seq][2]]) for seq in sorted(x)), '%s.%d' %(run_prefix, len(runs))))
+            x = {}
+            m = 0
+    if x:
+        runs.append(write_run(((seq, [[sa, x[seq][1][sa]] for sa in x[seq][2]]) for seq in sorted(x)), '%s.%d' %(run_prefix, len(runs))))
+    return runs
+
+
+def map_dereplicated(fst, pool, n_parts, sep='', trim_len='', tmp_prefix='derep'):
+    # Map step of dereplicate_parallel: record-aligned byte ranges of the file are dereplicated in parallel into n_parts hash
+    # partitions of partial maps
+    # Returns [filenames, memory]: the partial map filenames of every partition (in range order), and an upper bound of the
+    # memory of the merged DerepStore (the sequences found in several ranges are counted once per range)
+    ranges = chunker.record_ranges(fst, fmt='fasta', chunk_size=chunker.chunk_size(os.path.getsize(fst), n_parts))
+    results = pool.map(dereplicate_part, [(fst, i, start, end, sep, trim_len, '%s.%05d' %(tmp_prefix, i), n_parts) for i, [start, end] in enumerate(ranges)])
+    return [[[f[p] for f, m in results] for p in range(n_parts)], sum([m for f, m in results])]
+
+
+def dereplicate_parallel(fst, pool, n_parts, sep='', trim_len='', tmp_prefix='derep'):
+    # Dereplicate the sequences of a FASTA file on a multiprocessing pool (same result as dereplicate)
+    # Map: record-aligned byte ranges of the file are dereplicated in parallel into n_parts hash partitions of partial maps
+    # Reduce: every partition is merged by one worker
+    # The result is rebuilt with every sequence and sample inserted in order of first occurrence, as dereplicate inserts them,
+    # so that iterating over it (write_dereplicated) gives the same order and output
+    [filenames, m] = map_dereplicated(fst, pool, n_parts, sep=sep, trim_len=trim_len, tmp_prefix=tmp_prefix)
+    return reduce_dereplicated(filenames, pool)
+
+
+def reduce_dereplicated(filenames, pool):
+    # Reduce step of dereplicate_parallel: merge the partial maps of every partition (map_dereplicated) into one DerepStore
+    parts = pool.map(merge_dereplicated, filenames)
+    x = derepstore.DerepStore()
+    merged = heapq.merge(*parts)
+    while True:
+        batch = [[seq, sa, count] for [pos, seq, samples] in itertools.islice(merged, util.FST_BATCH_SIZE) for [sa, count] in samples]
+        if not batch:
+            break
+        x.add_batch(*zip(*batch))
+    return x
+
+
+def write_dereplicated(x, map_fn, db_fn, min_size=1, min_samples=1):
+    # Write output (database + mapping file)
+    # Load SeqDB
+    min_samples = 1
+    db = seqdb.SeqDB(fn=db_fn)
+    out = open(map_fn, 'w')
+    for seq, counts in x.iteritems():
+        size = sum(counts.values())
+        if size < min_size:
+            continue
+        if len(counts) < min_samples:
+            continue
+        db.add_seq(seq, size=size)
+        out.write('%s\t%s\n' %(db.db[:seq], ' '.join(['%s:%d' %(sa, counts[sa]) for sa in counts])))
+
+    out.close()
+    db.write(db_fn)
+
+
+def iter_sorted_store(x):
+    # Yields (seq, [[sample, count], ...]) for the sequences of a DerepStore, in sequence order
+    seqs = []
+    for i in xrange(0, len(x), derepstore.BATCH_SIZE):
+        seqs.extend(x.get_seqs(range(i, min(i + derepstore.BATCH_SIZE, len(x)))))
+    order = sorted(xrange(len(x)), key=seqs.__getitem__)
+    for k in xrange(0, len(order), derepstore.BATCH_SIZE):
+        ids = order[k:k + derepstore.BATCH_SIZE]
+        for i, row in zip(ids, x.get_rows(ids)):
+            yield seqs[i], row
+
+
+def write_run(items, fn):
+    # Write (seq, [[sample, count], ...]) items, in sequence order, to a run file
+    # One line per sequence: seq, then sample and count for every sample (in order of first occurrence), tab-separated
+    with open(fn, 'w') as out:
+        for seq, row in items:
+            out.write('%s\t%s\n' %(seq, '\t'.join(['%s\t%d' %(sa, count) for sa, count in row])))
+    return fn
+
+
+def spill_dereplicated(x, fn):
+    # Write the sequences of a DerepStore to a run file, sorted by sequence (write_run)
+    return write_run(iter_sorted_store(x), fn)
+
+
+def iter_run(fn, r):
+    # Yields (seq, r, [sample, count, sample, count, ...]) for every line of run r (spill_dereplicated)
+    with open(fn) as fid:
+        for line in fid:
+            fields = line.rstrip('\n').split('\t')
+            yield (fields[0], r, fields[1:])
+
+
+def iter_merged_runs(filenames):
+    # k-way merge of the runs written by spill_dereplicated
+    # Yields (seq, [[sample, count], ...]) in sequence order, with the samples in order of first occurrence
+    merged = heapq.merge(*[iter_run(fn, r) for r, fn in enumerate(filenames)])
+    for seq, lines in itertools.groupby(merged, key=lambda line: line[0]):
+        counts = {}
+        samples = []
+        for [seq, r, fields] in lines:
+            for k in range(0, len(fields), 2):
+                sa = fields[k]
+                if sa in counts:
+                    counts[sa] += int(fields[k+1])
+                else:
+                    counts[sa] = int(fields[k+1])
+                    samples.append(sa)
+        yield seq, [[sa, counts[sa]] for sa in samples]
+
+
+def fold_prefixes(block):
+    # Fold the sequences of block (a list of (seq, row) in sequence order, where every sequence starts with the first one)
+    # that are a prefix of a more abundant sequence into the longest such sequence (then the most abundant, then the first)
+    # Folding is transitive, and sizes are compared before folding.  Returns the remaining (seq, row), in sequence order.
+    sizes = [sum([count for sa, count in row]) for seq, row in block]
+    parent = [None]*len(block)
+    best = [None]*len(block) # (length, size) of the parent
+    stack = [] # prefixes of the current sequence
+    for j, [seq, row] in enumerate(block):
+        while stack and not seq.startswith(block[stack[-1]][0]):
+            stack.pop()
+        key = (len(seq), sizes[j])
+        for a in stack:
+            if sizes[j] > sizes[a] and (best[a] is None or key > best[a]):
+                parent[a] = j
+                best[a] = key
+        stack.append(j)
+    # parents come after their prefixes, so roots are found from the end
+    root = range(len(block))
+    for a in range(len(block) - 1, -1, -1):
+        if parent[a] is not None:
+            root[a] = root[parent[a]]
+    counts = [dict(row) for seq, row in block]
+    rows = [[sa for sa, count in row] for seq, row in block]
+    for a in range(len(block)):
+        r = root[a]
+        if r != a:
+            for sa, count in block[a][1]:
+                if sa in counts[r]:
+                    counts[r][sa] += count
+                else:
+                    counts[r][sa] = count
+                    rows[r].append(sa)
+    return [(block[r][0], [[sa, counts[r][sa]] for sa in rows[r]]) for r in range(len(block)) if root[r] == r]
+
+
+def iter_folded_prefixes(items):
+    # Prefix dereplication of (seq, [[sample, count], ...]) items in sequence order (iter_sorted_store or iter_merged_runs)
+    # The sequences starting with a given sequence follow it in sequence order, so items are folded (fold_prefixes) in
+    # blocks that start with a sequence that is not an extension of the previous block (empty sequences are not folded)
+    block = []
+    for seq, row in items:
+        if block and (not block[0][0] or not seq.startswith(block[0][0])):
+            for item in fold_prefixes(block):
+                yield item
+            block = []
+        block.append((seq, row))
+    for item in fold_prefixes(block):
+        yield item
+
+
+def write_sorted_run(records, fn):
+    # Sort (-size, OTU, seq) records and write them to a run file
+    records.sort()
+    with open(fn, 'w') as out:
+        out.writelines(['%d\t%d\t%s\n' %(size, otu, seq) for size, otu, seq in records])
+    return fn
+
+
+def iter_sorted_run(fn):
+    # Yields the (-size, OTU, seq) records of a run written by write_sorted_run
+    with open(fn) as fid:
+        for line in fid:
+            [size, otu, seq] = line.rstrip('\n').split('\t')
+            yield (int(size), int(otu), seq)
+
+
+def write_sorted_dereplicated(items, map_fn, db_fn, min_size=1, min_samples=1, memory=None, tmp_prefix='derep'):
+    # Write output (database + mapping file) from (seq, [[sample, count], ...]) items, as write_dereplicated
+    # OTUs are numbered in the order of items, and the database is sorted by size (then OTU) with an external sort of the
+    # kept sequences: they are written to sorted runs of at most memory bytes, then merged
+    min_samples = 1 # as in write_dereplicated
+    db = seqdb.SeqDB(fn=db_fn)
+    next_otu = db.db.next_otu
+    records = []
+    m = 0
+    runs = []
+    out = open(map_fn, 'w')
+    for seq, row in items:
+        size = sum([count for sa, count in row])
+        if size < min_size:
+            continue
+        if len(row) < min_samples:
+            continue
+        if seq in ~db.db:
+            # sequence in the existing database
+            otu = db.db[:seq]
+            db.size[otu] += size
+        else:
+            otu = next_otu
+            next_otu += 1
+            records.append((-size, otu, seq))
+            m += len(seq) + RECORD_BYTES
+            if memory is not None and m > memory:
+                runs.append(write_sorted_run(records, '%s.sorted.%d' %(tmp_prefix, len(runs))))
+                records = []
+                m = 0
+        out.write('%s\t%s\n' %(otu, ' '.join(['%s:%d' %(sa, count) for sa, count in row])))
+    out.close()
+
+    # Merge the sorted runs into the database
+    records.extend([(-db.size[otu], otu, db.db[otu]) for otu in db.db])
+    records.sort()
+    tmp_fn = '%s.tmp' %(db_fn)
+    with open(tmp_fn, 'w') as out:
+        for [size, otu, seq] in heapq.merge(iter(records), *[iter_sorted_run(fn) for fn in runs]):
+            out.write('>%d;size=%d\n%s\n' %(otu, -size, seq))
+    os.rename(tmp_fn, db_fn)
+    for fn in runs:
+        os.remove(fn)
+
+
+def count_sketch(fst='', fsq='', sep='', trim_len=''):
+    # First pass of the prefilter: count the sequences of all the reads in a count-min sketch
+    fn = fst if fst else fsq
+    cms = sketch.CountMinSketch(os.path.getsize(fn) / SKETCH_FILE_BYTES)
+    for [seqs, samples] in iter_dereplicate_batches(fst=fst, fsq=fsq, sep=sep, trim_len=trim_len):
+        cms.add(seqs)
+    return cms
+
+
+def iter_prefiltered(batches, cms, min_size):
+    # Second pass of the prefilter: drop the reads whose sequence has a count-min sketch estimate below min_size
+    for [seqs, samples] in batches:
+        keep = np.flatnonzero(cms.estimate(seqs) >= min_size)
+        yield [[seqs[k] for k in keep], [samples[k] for k in keep]]
+
+
+def dereplicate_and_write(map_fn, db_fn, fst='', fsq='', sep='', trim_len='', min_size=1, min_samples=1, memory=None, tmp_prefix='derep', prefilter=False, prefix=False):
+    # Dereplicate sequences and write the database and mapping file (dereplicate + write_dereplicated) within memory bytes
+    # If the DerepStore outgrows memory (including unpacking its sequences to sort them), it is written to a run sorted by
+    # sequence and emptied, and the runs are merged at the end (write_sorted_dereplicated): same sequences, sizes and counts
+    # per sample, but OTUs numbered in sequence order.  Otherwise, the output is the same as write_dereplicated.
+    # prefilter: read the file twice, and only store the sequences that can reach min_size (count-min sketch of the first
+    # pass); their counts are exact and min_size is checked on them as usual, so the same sequences, sizes and counts per
+    # sample are written, but OTUs are numbered in a different order
+    # prefix: prefix dereplication, the sequences that are a prefix of a more abundant sequence are folded into the longest
+    # one (iter_folded_prefixes) before min_size is applied; OTUs are numbered in sequence order
+    if prefix and prefilter:
+        util.error('Error: the prefilter cannot be used with prefix dereplication (folded reads count towards min_size)')
+    x = derepstore.DerepStore()
+    runs = []
+    batches = iter_dereplicate_batches(fst=fst, fsq=fsq, sep=sep, trim_len=trim_len)
+    store_memory = memory
+    if prefilter and min_size > 1:
+        cms = count_sketch(fst=fst, fsq=fsq, sep=sep, trim_len=trim_len)
+        if memory is not None:
+            store_memory = memory - cms.memory()
+        batches = iter_prefiltered(batches, cms, min_size)
+        cms = None # freed with iter_prefiltered after the second pass
+    for [seqs, samples] in batches:
+        x.add_batch(seqs, samples)
+        if memory is not None and x.memory(unpacked=True) > store_memory:
+            runs.append(spill_dereplicated(x, '%s.%d' %(tmp_prefix, len(runs))))
+            x = derepstore.DerepStore()
+    if not runs:
+        if not prefix:
+            write_dereplicated(x, map_fn=map_fn, db_fn=db_fn, min_size=min_size, min_samples=min_samples)
+            return
+        items = iter_sorted_store(x)
+    else:
+        if len(x) > 0:
+            runs.append(spill_dereplicated(x, '%s.%d' %(tmp_prefix, len(runs))))
+        x = None
+        util.message('Dereplication exceeded %.0f MB, merging %d sorted runs' %(memory/2.0**20, len(runs)))
+        items = iter_merged_runs(runs)
+    if prefix:
+        items = iter_folded_prefixes(items)
+    write_sorted_dereplicated(items, map_fn=map_fn, db_fn=db_fn, min_size=min_size, min_samples=min_samples, memory=memory, tmp_prefix=tmp_prefix)
+    for fn in runs:
+        os.remove(fn)
+
+
+def dereplicate_parallel_and_write(map_fn, db_fn, fst, pool, n_parts, sep='', trim_len='', min_size=1, min_samples=1, memory=None, tmp_prefix='derep', prefix=False):
+    # Dereplicate a FASTA file on a pool and write the database and mapping file (dereplicate_parallel + write_dereplicated)
+    # within memory bytes
+    # If the partial maps of the map step add up to more than memory, every partition is merged into runs sorted by sequence
+    # by its worker (spill_merged_dereplicated, memory/n_parts bytes per worker) and the runs are merged as in
+    # dereplicate_and_write: same sequences, sizes and counts per sample, but OTUs numbered in sequence order.  Otherwise, the
+    # output is the same as write_dereplicated.
+    # prefix: prefix dereplication, as in dereplicate_and_write
+    [filenames, m] = map_dereplicated(fst, pool, n_parts, sep=sep, trim_len=trim_len, tmp_prefix=tmp_prefix + '.part')
+    runs = []
+    if memory is None or m <= memory:
+        x = reduce_dereplicated(filenames, pool)
+        if not prefix:
+            write_dereplicated(x, map_fn=map_fn, db_fn=db_fn, min_size=min_size, min_samples=min_samples)
+            return
+        items = iter_sorted_store(x)
+    else:
+        util.message('Dereplication exceeds %.0f MB, merging the partitions into sorted runs' %(memory/2.0**20))
+        runs = pool.map(spill_merged_dereplicated, [(filenames[p], memory/n_parts, '%s.run.%d' %(tmp_prefix, p)) for p in range(n_parts)])
+        runs = [fn for part in runs for fn in part]
+        items = iter_merged_runs(runs)
+    if prefix:
+        items = iter_folded_prefixes(items)
+    write_sorted_dereplicated(items, map_fn=map_fn, db_fn=db_fn, min_size=min_size, min_samples=min_samples, memory=memory, tmp_prefix=tmp_prefix + '.run')
+    for fn in runs:
+        os.remove(fn)
+
+
+def memory_budget():
+    # Default memory budget of dereplication (bytes): half of the physical memory
+    return os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')/2
+
+
+# Step 4 - dereplication map to OTU table
+
+def derep2counts(map_fn, out_fn, fst='', min_count=None, min_samples=None):
+    # Convert a derep mapping file to an OTU table (4.derep2counts.py)
+    # If fst is given, only the OTUs in this FASTA file are kept
+    import pandas as pd
+    
+    # Load valid fst seqs
+    keep = {}
+    if fst:
+        for [otu, seq] in util.iter_fst(fst):
+            otu = otu[1:]
+            keep[otu] = 1
+    
+    # Keep track of samples and otus
+    samples = {}
+    otus = {}
+    
+    # For every line in the mapping file
+    for line in open(map_fn):
+        # Load otu name and table of sample counts
+        otu, table = line.rstrip().split('\t')
+        if len(keep) > 0 and otu not in keep:
+            continue
+        entries = table.split(' ')
+        count = sum([int(entry.split(':')[1]) >= min_count for entry in entries])
+        if count < min_samples:
+            continue
+        if otu not in otus:
+            otus[otu] = len(otus)
+        for entry in entries:
+            sample, count = entry.split(':')
+            if sample not in samples:
+                samples[sample] = len(samples)
+    
+    x = np.zeros([len(samples), len(otus)])
+    
+    for line in open(map_fn):
+        otu, table = line.rstrip().split('\t')
+        if len(keep) > 0 and otu not in keep:
+            continue
+        if otu in otus:
+            for entry in table.split(' '):
+                sample, count = entry.split(':')
+                i = samples[sample]
+                j = otus[otu]
+                x[i,j] += int(count)
+    
+    x = pd.DataFrame(x)
+    
+    sort_otus = sorted(otus.keys(), key=lambda a: otus[a])
+    sort_samp = sorted(samples.keys(), key=lambda a: samples[a])
+    keep = ((x > 0).sum(axis=0) > min_samples)
+    x = x.ix[:, keep]
+    
+    out = open(out_fn, 'w')
+    out.write( 'sample\t' + '\t'.join(sort_otus) + '\n')
+    for sample in sort_samp:
+        i = samples[sample]
+        out.write( '%s\t%s' %(sample, '\t'.join(['%d' %(xi) for xi in x.ix[i,:]])) + '\n')
+    out.close()
@@ -1,9 +1,59 @@
 from die import *
+import cStringIO
+import gzip
 import subprocess
 import tempfile
 import progress
 
 TRUNC_LABELS=0
+BLOCK_SIZE=1 << 20
+
+# Opens a plain, gzip/BGZF or zstd compressed file (from the magic bytes).
+def OpenSeqFile(FileName):
+	File = open(FileName, "rb")
+	Magic = File.read(4)
+	File.seek(0)
+	if Magic[:2] == "\x1f\x8b":
+		# BGZF blocks are concatenated gzip members
+		return gzip.GzipFile(fileobj=File)
+	if Magic == "\x28\xb5\x2f\xfd":
+		try:
+			import zstandard
+		except ImportError:
+			Die("Reading zstd file '%s' requires the zstandard module" % FileName)
+		Data = File.read()
+		Parts = []
+		while Data:
+			Z = zstandard.ZstdDecompressor().decompressobj()
+			Parts.append(Z.decompress(Data))
+			Data = getattr(Z, "unused_data", "")
+		return cStringIO.StringIO("".join(Parts))
+	return File
+
+# Yields (Label, Seq) for every record of an open FASTA file, Label with its ">".
+# The lines of a sequence are collected in a list and joined once, so that wrapped
+# sequences are assembled in linear time; blank lines are skipped.
+def IterSeqsFile(File):
+	Label = None
+	Lines = []
+	while 1:
+		Block = File.readlines(BLOCK_SIZE)
+		if len(Block) == 0:
+			break
+		for Line in Block:
+			if Line[:1] == ">":
+				if Label != None:
+					yield Label, "".join(Lines)
+				Label = Line.rstrip()
+				Lines = []
+			else:
+				Line = Line.strip()
+				if len(Line) > 0:
+					if Label == None:
+						Die("FASTA file does not start with '>'")
+					Lines.append(Line)
+	if Label != None:
+		yield Label, "".join(Lines)
 
 def isgap(c):
 	return c == '-' or c == '.'
@@ -30,32 +80,21 @@ def ReadSeqsOnSeq(FileName, OnSeq):
 
 def ReadSeqsFastFile(File, Progress = False):
 	Seqs = {}
-	Id = ""
 	N = 0
-	while 1:
+	for Label, Seq in IterSeqsFile(File):
 		if N%10000 == 0 and Progress:
 			sys.stderr.write("%u seqs\r" % (N))
-		Line = File.readline()
-		if len(Line) == 0:
-			if Progress:
-				sys.stderr.write("%u seqs\n" % (N))
-			return Seqs
-		if len(Line) == 0:
-			continue
-		Line = Line.strip()
-		if Line[0] == ">":
-			N += 1
-			Id = Line[1:]
-			if TRUNC_LABELS:
-				Id = Id.split()[0]
-			Seqs[Id] = ""
-		else:
-			if Id == "":
-				Die("FASTA file does not start with '>'")
-			Seqs[Id] = Seqs[Id] + Line
+		N += 1
+		Id = Label[1:]
+		if TRUNC_LABELS:
+			Id = Id.split()[0]
+		Seqs[Id] = Seq
+	if Progress:
+		sys.stderr.write("%u seqs\n" % (N))
+	return Seqs
 
 def ReadSeqsFast(FileName, Progress = True):
-	File = open(FileName)
+	File = OpenSeqFile(FileName)
 	return ReadSeqsFastFile(File, Progress)
 
 def ReadSeqs(FileName, toupper=False, stripgaps=False, Progress=False):
@@ -63,31 +102,20 @@ def ReadSeqs(FileName, toupper=False, stripgaps=False, Progress=False):
 		return ReadSeqsFast(FileName, False)
 
 	Seqs = {}
-	Id = ""
 	File = open(FileName)
-	while 1:
-		Line = File.readline()
-		if len(Line) == 0:
-			return Seqs
-		Line = Line.strip()
-		if len(Line) == 0:
-			continue
-		if Line[0] == ">":
-			Id = Line[1:]
-			if TRUNC_LABELS:
-				Id = Id.split()[0]
-			if Id in Seqs.keys():
-				Die("Duplicate id '%s' in '%s'" % (Id, FileName))
-			Seqs[Id] = ""
-		else:
-			if Id == "":
-				Die("FASTA file '%s' does not start with '>'" % FileName)
-			if toupper:
-				Line = Line.upper()
-			if stripgaps:
-				Line = Line.replace("-", "")
-				Line = Line.replace(".", "")
-			Seqs[Id] = Seqs[Id] + Line
+	for Label, Seq in IterSeqsFile(File):
+		Id = Label[1:]
+		if TRUNC_LABELS:
+			Id = Id.split()[0]
+		if Id in Seqs:
+			Die("Duplicate id '%s' in '%s'" % (Id, FileName))
+		if toupper:
+			Seq = Seq.upper()
+		if stripgaps:
+			Seq = Seq.replace("-", "")
+			Seq = Seq.replace(".", "")
+		Seqs[Id] = Seq
+	return Seqs
 
 def ReadSeqs2(FileName, ShowProgress = True):
 	Seqs = []
@@ -95,54 +123,33 @@ def ReadSeqs2(FileName, ShowProgress = True):
 	File = open(FileName)
 	if ShowProgress:
 		progress.InitFile(File, FileName)
-	while 1:
-		progress.File()
-		Line = File.readline()
-		if len(Line) == 0:
-			if ShowProgress:
-				print >> sys.stderr, "\n"
-			return Labels, Seqs
-		Line = Line.strip()
-		if len(Line) == 0:
-			continue
-		if Line[0] == ">":
-			Id = Line[1:]
-			if TRUNC_LABELS:
-				Id = Id.split()[0]
-			Labels.append(Id)
-			Seqs.append("")
-		else:
-			i = len(Seqs)-1
-			Seqs[i] = Seqs[i] + Line
+	for Label, Seq in IterSeqsFile(File):
+		if ShowProgress:
+			progress.File()
+		Id = Label[1:]
+		if TRUNC_LABELS:
+			Id = Id.split()[0]
+		Labels.append(Id)
+		Seqs.append(Seq)
+	if ShowProgress:
+		print >> sys.stderr, "\n"
+	return Labels, Seqs
 
 def ReadSeqs3(FileName, OnSeq, ShowProgress = True):
 	File = open(FileName)
 	if ShowProgress:
 		progress.InitFile(File, FileName)
-	Label = ""
-	Seq = ""
-	while 1:
-		Line = File.readline()
-		if len(Line) == 0:
-			if Seq != "":
-				OnSeq(Label, Seq)
-			if ShowProgress:
-				print >> sys.stderr, "\n"
-			return
-		Line = Line.strip()
-		if len(Line) == 0:
+	for Label, Seq in IterSeqsFile(File):
+		if Seq == "":
 			continue
-		if Line[0] == ">":
-			if Seq != "":
-				if ShowProgress:
-					progress.File()
-				if TRUNC_LABELS:
-					Label = Label.split()[0]
-				OnSeq(Label, Seq)
-			Label = Line[1:]
-			Seq = ""
-		else:
-			Seq += Line
+		if ShowProgress:
+			progress.File()
+		Label = Label[1:]
+		if TRUNC_LABELS:
+			Label = Label.split()[0]
+		OnSeq(Label, Seq)
+	if ShowProgress:
+		print >> sys.stderr, "\n"
 
 def WriteSeq(File, Seq):
 	BLOCKLENGTH = 80
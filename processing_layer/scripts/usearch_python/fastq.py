@@ -139,13 +139,30 @@ def ReadSeqs(FileName, OnRec):
 def ReadRecs(FileName, OnRec):
 	ReadSeqs(FileName, OnRec)
 
-def WriteRec(File, Label, Seq, Qual):
+def FormatRec(Label, Seq, Qual):
 	assert len(Seq) == len(Qual)
+	return "@" + Label + "\n" + Seq + "\n+\n" + Qual + "\n"
+
+def WriteRec(File, Label, Seq, Qual):
+	File.write(FormatRec(Label, Seq, Qual))
+
+# Buffers records and writes them WRITE_BATCH at a time.
+WRITE_BATCH = 10000
+
+class RecWriter:
+	def __init__(self, File, BatchSize = WRITE_BATCH):
+		self.File = File
+		self.BatchSize = BatchSize
+		self.Recs = []
+
+	def Write(self, Label, Seq, Qual):
+		self.Recs.append(FormatRec(Label, Seq, Qual))
+		if len(self.Recs) >= self.BatchSize:
+			self.Flush()
 
-	print >> File, "@" + Label
-	print >> File, Seq
-	print >> File, "+"
-	print >> File, Qual
+	def Flush(self):
+		self.File.write("".join(self.Recs))
+		self.Recs = []
 
 def PrintTable():
 	for iq in range(2, 41):
@@ -24,18 +24,16 @@ PrimerMismatchCount = 0
 PL = len(Primer)
 
 Barcodes = fasta.ReadSeqsDict(BarcodeFileName)
+BarcodeIndex = primer.MakePrefixIndex(Barcodes)
+Out = fastq.RecWriter(sys.stdout)
 
 def MatchesPrimer(Seq, Primer):
 	return primer.MatchPrefix(Seq, Primer)
 
 def FindBarcode(Seq):
-	global Barcodes
-	for BarcodeLabel in Barcodes.keys():
-		Barcode = Barcodes[BarcodeLabel]
-#		print "Barcode", Barcode, "Seq", Seq
-		if Seq.startswith(Barcode):
-			return Barcode
-	return ""
+	global BarcodeIndex
+	Barcode, BarcodeLabel = primer.FindPrefix(Seq, BarcodeIndex)
+	return Barcode
 	
 def OnRec(Label, Seq, Qual):
 	global PL, LabelPrefix, Barcode, SeqCount, OutCount, BarcodeMismatchCount, PrimerMismatchCount
@@ -60,9 +58,10 @@ def OnRec(Label, Seq, Qual):
 		NewLabel = Label + ";barcodelabel=" + Barcode + ";"
 	else:
 		NewLabel = LabelPrefix + str(OutCount) + ";barcodelabel=" + Barcode + ";"
-	fastq.WriteRec(sys.stdout, NewLabel, Seq[PL:], Qual[PL:])
+	Out.Write(NewLabel, Seq[PL:], Qual[PL:])
 
 fastq.ReadRecs(FileName, OnRec)
+Out.Flush()
 
 print >> sys.stderr, "%10u seqs" % SeqCount
 print >> sys.stderr, "%10u matched" % OutCount
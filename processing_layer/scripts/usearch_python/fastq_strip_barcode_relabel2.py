@@ -26,21 +26,16 @@ PrimerMismatchCount = 0
 PL = len(Primer)
 
 Barcodes = fasta.ReadSeqsDict(BarcodeFileName)
+BarcodeIndex = primer.MakePrefixIndex(Barcodes)
+Out = fastq.RecWriter(sys.stdout)
 
 def MatchesPrimer(Seq, Primer):
 	return primer.MatchPrefix(Seq, Primer)
 
 def FindBarcode(Seq):
-	global Barcodes
-	for BarcodeLabel in Barcodes.keys():
-		Barcode = Barcodes[BarcodeLabel]
-#		print ""
-#		print " BC", Barcode
-#		print "Seq", Seq
-		if Seq.startswith(Barcode):
-#			print "+++++++++++++++++++++"
-			return Barcode, BarcodeLabel
-	return "", ""
+	global BarcodeIndex
+	Barcode, BarcodeLabel = primer.FindPrefix(Seq, BarcodeIndex)
+	return Barcode, BarcodeLabel
 	
 def OnRec(Label, Seq, Qual):
 	global PL, LabelPrefix, Barcode, SeqCount, OutCount, BarcodeMismatchCount, PrimerMismatchCount
@@ -62,9 +57,10 @@ def OnRec(Label, Seq, Qual):
 
 	OutCount += 1
 	Label = LabelPrefix + str(OutCount) + ";barcodelabel=" + BarcodeLabel + ";"
-	fastq.WriteRec(sys.stdout, Label, Seq[PL:], Qual[PL:])
+	Out.Write(Label, Seq[PL:], Qual[PL:])
 
 fastq.ReadRecs(FileName, OnRec)
+Out.Flush()
 
 print >> sys.stderr, "%10u seqs" % SeqCount
 print >> sys.stderr, "%10u matched" % OutCount
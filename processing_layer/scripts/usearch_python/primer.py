@@ -14,49 +14,59 @@ import die
 # 	{ 'X', "GATC", 'X' },		// ACGT		X
 # 	{ 'N', "GATC", 'N' },		// ACGT		N
 
+# Letters matched by each primer letter (table form of the codes above)
+IUPAC = {
+	'A': set("A"),
+	'C': set("C"),
+	'G': set("G"),
+	'T': set("T"),
+	'M': set("AC"),
+	'R': set("AG"),
+	'W': set("AT"),
+	'S': set("CG"),
+	'Y': set("CT"),
+	'K': set("GT"),
+	'V': set("ACG"),
+	'H': set("ACT"),
+	'D': set("AGT"),
+	'B': set("CGT"),
+	'X': set("GATC"),
+	'N': set("GATC"),
+	}
+
 def MatchLetter(a, b):
-	if b == 'A' or b == 'C' or b == 'G' or b == 'T':
-		return a == b
-	elif b == 'S':
-		return a == 'C' or a == 'G'
-	elif b == 'Y':
-		return a == 'T' or a == 'C'
-	elif b == 'K':
-		return a == 'G' or a == 'T'
-	elif b == 'V':
-		return a == 'A' or a == 'C' or a == 'G'
-	elif b == 'H':
-		return a == 'A' or a == 'C' or a == 'T'
-	elif b == 'D':
-		return a == 'A' or a == 'G' or a == 'T'
-	elif b == 'B':
-		return a == 'C' or a == 'G' or a == 'T'
-	elif b == 'X' or b == 'N':
-		return a == 'G' or a == 'A' or a == 'T' or a == 'C'
-	elif b == 'R':
-		return a == 'A' or a == 'G'
-	elif b == 'M':
-		return a == 'A' or a == 'C'
-	elif b == 'H':
-		return a == 'A' or a == 'C' or a == 'T'
-	elif b == 'W':
-		return a == 'A' or a == 'T'
-	else:
+	try:
+		return a in IUPAC[b]
+	except KeyError:
 		die.Die("Bad letter in primer '%c'" % b)
 	return 0
 
 def MatchPrefix(Seq, Primer):
-	L = len(Seq)
-	PrimerLength = len(Primer)
-	n = PrimerLength
-	if L < n:
-		n = L
 	Diffs = 0
-	for i in range(0, n):
-		if not MatchLetter(Seq[i], Primer[i]):
-			Diffs += 1
+	try:
+		for a, b in zip(Seq, Primer):
+			if a not in IUPAC[b]:
+				Diffs += 1
+	except KeyError:
+		die.Die("Bad letter in primer '%c'" % b)
 	return Diffs
 
+# Barcode lookup: one dictionary per barcode length, longest first, so FindPrefix
+# costs one lookup per distinct length whatever the number of barcodes.
+def MakePrefixIndex(Barcodes):
+	Index = {}
+	for Label in sorted(Barcodes.keys()):
+		Barcode = Barcodes[Label]
+		Index.setdefault(len(Barcode), {}).setdefault(Barcode, Label)
+	return sorted(Index.items(), reverse=True)
+
+def FindPrefix(Seq, PrefixIndex):
+	for L, Dict in PrefixIndex:
+		Label = Dict.get(Seq[:L])
+		if Label is not None:
+			return Seq[:L], Label
+	return "", ""
+
 def MatchPos(Seq, Primer):
 	L = len(Seq)
 	PrimerLength = len(Primer)
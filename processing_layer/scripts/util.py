@@ -1,4 +1,4 @@
-import re, string, sys, time
+import itertools, re, string, struct, sys, time, zlib
 
 rctab = string.maketrans('ACGTacgt','TGCAtgca')
 
@@ -38,39 +38,407 @@ def read_tseries(fn):
     return read_dataframe(fn, index_dtype=float, columns_dtype=str)
 
 
-def iter_fst(fn):
-    # generator that iterates through [sid, seq] pairs in a fasta file
-    seq = ''
-    for line in open(fn):
-        line = line.rstrip()
-        if line.startswith('>'):
-            if seq != '':
-                yield [sid, seq]
-            sid = line
-            seq = ''
+GZIP_MAGIC = '\x1f\x8b'
+ZSTD_MAGIC = '\x28\xb5\x2f\xfd'
+
+
+def get_compression(fn):
+    # detect compression from the magic bytes: '' (none), 'gzip', 'bgzf' or 'zstd'
+    fid = open(fn, 'rb')
+    header = fid.read(12)
+    if header.startswith(GZIP_MAGIC):
+        compression = 'gzip'
+        # BGZF = gzip blocks with a 'BC' extra subfield holding the block size
+        if len(header) == 12 and ord(header[3]) & 4:
+            xlen = struct.unpack('<H', header[10:12])[0]
+            if get_bgzf_bsize(fid.read(xlen)) is not None:
+                compression = 'bgzf'
+    elif header.startswith(ZSTD_MAGIC):
+        compression = 'zstd'
+    else:
+        compression = ''
+    fid.close()
+    return compression
+
+
+def get_bgzf_bsize(extra):
+    # parse the gzip extra field of a BGZF block and return BSIZE (total block size - 1)
+    i = 0
+    while i + 4 <= len(extra):
+        slen = struct.unpack('<H', extra[i+2:i+4])[0]
+        if extra[i:i+2] == 'BC' and slen == 2:
+            return struct.unpack('<H', extra[i+4:i+6])[0]
+        i += 4 + slen
+    return None
+
+
+def bgzf_blocks(fn):
+    # read the block index of a BGZF file
+    # returns a list of [offset, size] (compressed offset, uncompressed size) for every block
+    blocks = []
+    fid = open(fn, 'rb')
+    offset = 0
+    while True:
+        fid.seek(offset)
+        header = fid.read(12)
+        if len(header) < 12:
+            break
+        xlen = struct.unpack('<H', header[10:12])[0]
+        bsize = get_bgzf_bsize(fid.read(xlen))
+        if not header.startswith(GZIP_MAGIC) or bsize is None:
+            error('Error: invalid BGZF block at offset %d in %s' %(offset, fn))
+        # last 4 bytes of every block hold its uncompressed size (ISIZE)
+        fid.seek(offset + bsize - 3)
+        size = struct.unpack('<I', fid.read(4))[0]
+        blocks.append([offset, size])
+        offset += bsize + 1
+    fid.close()
+    return blocks
+
+
+class zfile():
+    # read-only file object over a gzip, BGZF or zstd compressed file
+    # concatenated gzip members (e.g. BGZF blocks) and zstd frames are read as one stream
+
+    def __init__(self, fid, compression, block_size=1 << 20):
+        self.fid = fid
+        self.compression = compression
+        self.block_size = block_size
+        self.buf = ''
+        self.pos = 0 # start of the unread bytes of buf (readline)
+        self.eof = False
+        self.z = self.decompressor()
+
+    def decompressor(self):
+        if self.compression in ['gzip', 'bgzf']:
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.compression == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                error('Error: reading zstd files requires the zstandard module')
+            return zstandard.ZstdDecompressor().decompressobj()
+        else:
+            error('Error: unrecognized compression "%s"' %(self.compression))
+
+    def read_block(self):
+        # decompress the next block of input ('' at end of file)
+        while True:
+            data = self.fid.read(self.block_size)
+            if not data:
+                self.eof = True
+                return ''
+            out = []
+            while data:
+                out.append(self.z.decompress(data))
+                # input left over after the end of a gzip member/zstd frame starts the next one
+                data = getattr(self.z, 'unused_data', '')
+                if data:
+                    self.z = self.decompressor()
+            out = ''.join(out)
+            if out:
+                return out
+
+    def unread(self):
+        # drop the bytes of buf already returned by readline
+        if self.pos:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+
+    def read(self, n=-1):
+        self.unread()
+        if n < 0:
+            parts = [self.buf]
+            while not self.eof:
+                parts.append(self.read_block())
+            self.buf = ''
+            return ''.join(parts)
+        parts = [self.buf]
+        size = len(self.buf)
+        while size < n and not self.eof:
+            block = self.read_block()
+            parts.append(block)
+            size += len(block)
+        buf = ''.join(parts)
+        self.buf = buf[n:]
+        return buf[:n]
+
+    def readlines(self, hint=1 << 20):
+        # read complete lines totalling about hint bytes (like file.readlines)
+        self.unread()
+        parts = [self.buf]
+        size = len(self.buf)
+        while not self.eof and (size < hint or '\n' not in parts[-1]):
+            block = self.read_block()
+            parts.append(block)
+            size += len(block)
+        buf = ''.join(parts)
+        i = buf.rfind('\n') + 1
+        if self.eof:
+            i = len(buf)
+        self.buf = buf[i:]
+        return buf[:i].splitlines(True)
+
+    def readline(self):
+        i = self.buf.find('\n', self.pos) + 1
+        while i == 0 and not self.eof:
+            self.unread()
+            self.buf += self.read_block()
+            i = self.buf.find('\n') + 1
+        if i == 0:
+            i = len(self.buf)
+        line = self.buf[self.pos:i]
+        self.pos = i
+        return line
+
+    def __iter__(self):
+        while True:
+            lines = self.readlines()
+            if not lines:
+                break
+            for line in lines:
+                yield line
+
+    def close(self):
+        self.fid.close()
+
+
+def open_file(fn, offset=0):
+    # open a plain or compressed (gzip, BGZF, zstd) file for reading
+    # offset is a compressed offset (e.g. the start of a BGZF block)
+    compression = get_compression(fn)
+    fid = open(fn, 'rb')
+    if offset:
+        fid.seek(offset)
+    if compression:
+        fid = zfile(fid, compression)
+    return fid
+
+
+class rangefile():
+    # read-only file object over the bytes start..end-1 of a plain file (read with seek + bounded reads, no copy on disk)
+    # end should fall on a line boundary (see chunker.record_ranges)
+
+    def __init__(self, fid, start, end):
+        self.fid = fid
+        if start:
+            self.fid.seek(start)
+        self.left = end - start
+
+    def read(self, n=-1):
+        if n < 0 or n > self.left:
+            n = self.left
+        data = self.fid.read(n)
+        self.left -= len(data)
+        return data
+
+    def readline(self):
+        if self.left <= 0:
+            return ''
+        line = self.fid.readline()[:self.left]
+        self.left -= len(line)
+        return line
+
+    def readlines(self, hint=1 << 20):
+        # read complete lines totalling about hint bytes (like file.readlines)
+        data = self.read(max(hint, 1))
+        if data and not data.endswith('\n'):
+            data += self.readline()
+        return data.splitlines(True)
+
+    def __iter__(self):
+        while True:
+            lines = self.readlines()
+            if not lines:
+                break
+            for line in lines:
+                yield line
+
+    def close(self):
+        self.fid.close()
+
+
+BGZF_BLOCKS = {} # filename -> bgzf_blocks, read once per process by open_bgzf
+
+
+def open_bgzf(fn, pos):
+    # open a BGZF file for reading at uncompressed offset pos: the block holding pos is decompressed from its start, and
+    # the bytes before pos are skipped
+    if fn not in BGZF_BLOCKS:
+        BGZF_BLOCKS[fn] = bgzf_blocks(fn)
+    offset = 0
+    for [block_offset, size] in BGZF_BLOCKS[fn]:
+        if pos < size:
+            offset = block_offset
+            break
+        pos -= size
+    fid = open_file(fn, offset=offset)
+    fid.read(pos)
+    return fid
+
+
+def open_range(fn, start=0, end=None):
+    # open a plain or compressed file for reading (open_file)
+    # if end is given, only the bytes start..end-1 are read, for a plain or BGZF file (uncompressed offsets)
+    if end is None:
+        if start:
+            error('Error: byte range of %s has no end' %(fn))
+        return open_file(fn)
+    compression = get_compression(fn)
+    if compression == 'bgzf':
+        return rangefile(open_bgzf(fn, start), 0, end - start)
+    if compression:
+        error('Error: cannot read a byte range of %s file %s' %(compression, fn))
+    return rangefile(open(fn, 'rb'), start, end)
+
+
+BLOCK_SIZE = 1 << 20 # bytes read per block by the fasta/fastq block readers
+FST_BATCH_SIZE = 10000 # records per batch yielded by iter_fst_batches
+FST_SPACE = ' \t\r\x0b\x0c' # whitespace stripped from fasta sequence lines, besides newlines
+FSQ_BATCH_SIZE = 10000 # records per batch yielded by iter_fsq_batches
+
+
+def iter_fst_blocks(fid, block_size=BLOCK_SIZE):
+    # generator that iterates through blocks of an open fasta file
+    # yields lists of [sid, seq] pairs: the file is read in blocks, which are split into records at every '\n>'; the
+    # sequence lines of a record are joined with one replace (or stripped line by line if the block holds other
+    # whitespace), so wrapped sequences are assembled in linear time; blank lines are skipped
+    buf = '\n'
+    first = True
+    while True:
+        data = fid.read(block_size)
+        # CRLF line ends (also split across blocks) are read as LF
+        if buf.endswith('\r') and data.startswith('\n'):
+            buf = buf[:-1]
+        if '\r' in data:
+            data = data.replace('\r\n', '\n')
+        buf += data
+        clean = not any([c in buf for c in FST_SPACE])
+        records = buf.split('\n>')
+        # the last record may continue in the next block
+        buf = records.pop() if data else ''
+        if first and len(records) > 0:
+            if records[0].strip():
+                error('Error: fasta file does not start with ">"')
+            del records[0]
+            first = False
+        records = [record.partition('\n') for record in records]
+        if clean:
+            # no trailing whitespace to strip from the headers either
+            yield [['>' + sid, lines.replace('\n', '')] for sid, sep, lines in records]
+        else:
+            yield [['>' + sid.rstrip(), ''.join([line.strip() for line in lines.split('\n')])] for sid, sep, lines in records]
+        if not data:
+            break
+
+
+def iter_fst_file(fid, block_size=BLOCK_SIZE):
+    # generator that iterates through [sid, seq] pairs in an open fasta file (iter_fst_blocks)
+    for records in iter_fst_blocks(fid, block_size=block_size):
+        for record in records:
+            yield record
+
+
+def iter_fst(fn, start=0, end=None):
+    # generator that iterates through [sid, seq] pairs in a fasta file (plain or compressed)
+    # start, end: read only the records in this byte range of a plain or BGZF file (see open_range)
+    fid = open_range(fn, start, end)
+    for records in iter_fst_blocks(fid):
+        for record in records:
+            yield record
+    fid.close()
+
+
+def iter_fst_batches(fn, n=FST_BATCH_SIZE, start=0, end=None):
+    # generator that iterates through lists of n [sid, seq] pairs in a fasta file
+    # the last batch may be shorter
+    fid = open_range(fn, start, end)
+    batch = []
+    for records in iter_fst_blocks(fid):
+        batch.extend(records)
+        while len(batch) >= n:
+            yield batch[:n]
+            del batch[:n]
+    fid.close()
+    if batch:
+        yield batch
+
+
+def iter_fsq_blocks(fn, block_size=BLOCK_SIZE, start=0, end=None):
+    # generator that iterates through blocks of a fastq file
+    # yields [lines, eol], where lines is a flat list of raw lines (4 per record, newlines
+    # not stripped) and eol is the line terminator length (1 for LF, 2 for CRLF)
+    # blocks only hold complete records; a partial record is carried over to the next block
+    # compressed files (gzip, BGZF, zstd) are decompressed on the fly
+    # start, end: read only the records in this byte range of a plain or BGZF file (see open_range)
+    fid = open_range(fn, start, end)
+    tail = []
+    eol = None
+    while True:
+        lines = fid.readlines(block_size)
+        if not lines:
+            break
+        if tail:
+            lines[:0] = tail
+        if eol is None:
+            eol = 2 if lines[0].endswith('\r\n') else 1
+        # last line of the file may be missing its newline
+        if not lines[-1].endswith('\n'):
+            lines[-1] += '\r\n' if eol == 2 else '\n'
+        k = len(lines) % 4
+        if k:
+            tail = lines[-k:]
+            del lines[-k:]
         else:
-            seq += line
-    yield [sid, seq]
+            tail = []
+        if lines:
+            if lines[0][:1] != '@':
+                error('Error: invalid fastq record in %s: %s' %(fn, lines[0].rstrip()))
+            yield [lines, eol]
+    fid.close()
+    if ''.join(tail).strip():
+        error('Error: truncated fastq record at end of %s' %(fn))
+
+
+def iter_fsq_records(fn, block_size=BLOCK_SIZE):
+    # generator that iterates through (sid, seq, plus, qual) tuples in a fastq file
+    # trailing whitespace is stripped from the header (sid), as in iter_fsq
+    for [lines, eol] in iter_fsq_blocks(fn, block_size=block_size):
+        e = -eol
+        it = iter(lines)
+        for a, b, c, d in itertools.izip(it, it, it, it):
+            yield (a.rstrip(), b[:e], c[:e], d[:e])
+
+
+def iter_fsq_batches(fn, n=FSQ_BATCH_SIZE, block_size=BLOCK_SIZE, start=0, end=None):
+    # generator that iterates through lists of n (sid, seq, plus, qual) tuples in a fastq file
+    # the last batch may be shorter; trailing whitespace is stripped from the header (sid), as in iter_fsq
+    batch = []
+    for [lines, eol] in iter_fsq_blocks(fn, block_size=block_size, start=start, end=end):
+        e = -eol
+        it = iter(lines)
+        batch.extend([(a.rstrip(), b[:e], c[:e], d[:e]) for a, b, c, d in itertools.izip(it, it, it, it)])
+        while len(batch) >= n:
+            yield batch[:n]
+            del batch[:n]
+    if batch:
+        yield batch
 
 
 def iter_fsq(fn):
     # generator that iterates through records in a fastq file
-    record = []
-    i = 0
-    for line in open(fn):
-        i += 1
-        if i % 4 == 1:
-            if len(record) > 0:
-                yield record
-            record = []
-        record.append(line.rstrip())
-    yield record
+    # yields [sid, seq, plus, qual] lists (compatibility wrapper around iter_fsq_blocks)
+    # trailing whitespace is stripped from every line, as the line-by-line reader did
+    for [lines, eol] in iter_fsq_blocks(fn):
+        it = iter(lines)
+        for a, b, c, d in itertools.izip(it, it, it, it):
+            yield [a.rstrip(), b.rstrip(), c.rstrip(), d.rstrip()]
 
 
 def read_fst(fn, reverse=False):
     # read fasta file as dictionary
     fst = {}
-    for [sid, seq] in iter_fst(fst):
+    for [sid, seq] in iter_fst(fn):
         if reverse == False:
             fst[sid] = seq
         elif reverse == True:
@@ -78,6 +446,27 @@ def read_fst(fn, reverse=False):
     return fst
 
 
+def reservoir_sample(batches, k, seed=None):
+    # uniform random sample of k items from an iterator of lists (e.g. iter_fsq_batches), in one pass
+    # (reservoir sampling; replacement indices are drawn for a whole batch at once)
+    import numpy as np
+    rng = np.random.RandomState(seed)
+    sample = []
+    n = 0
+    for batch in batches:
+        # fill the reservoir
+        i = min(len(batch), k - len(sample))
+        if i > 0:
+            sample.extend(batch[:i])
+        # item m (0-based) replaces a random slot j < k with probability k/(m+1)
+        m = np.arange(n + i, n + len(batch))
+        j = (rng.random_sample(len(m))*(m + 1)).astype(np.int64)
+        for b in np.flatnonzero(j < k):
+            sample[j[b]] = batch[i + b]
+        n += len(batch)
+    return sample
+
+
 def cycle(x):
     # an efficient way to cycle through a list (similar to itertools.cycle)
     while True: